@@ -0,0 +1,114 @@
+"""
+Microbenchmark for the text cleaning engines in etl_spark.py
+
+Runs each cleaning function with each engine over a synthetic SPL inventory and
+reports the throughput in rows/sec.
+
+Example:
+
+    spark-submit benchmark_cleaning_engines.py --num-rows 1000000
+"""
+import argparse
+import time
+
+from pyspark.sql import SparkSession
+import pyspark.sql.functions as F
+
+from cleaning_corpus import AUTHOR_SUFFIXES, FIRST_NAMES, LAST_NAMES, PUBLICATION_YEARS, PUBLISHERS, TITLES
+from etl_spark import CLEANING_ENGINES, create_text_cleaners
+
+
+DEFAULT_NUM_ROWS = 1000000
+DEFAULT_NUM_PARTITIONS = 8
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark text cleaning engines")
+    parser.add_argument("--num-rows", type=int, default=DEFAULT_NUM_ROWS)
+    parser.add_argument("--num-partitions", type=int, default=DEFAULT_NUM_PARTITIONS)
+    parser.add_argument("--engines", nargs="+", choices=CLEANING_ENGINES, default=list(CLEANING_ENGINES))
+    args = parser.parse_args()
+
+    spark = SparkSession.builder.appName("SPL-Benchmark-Cleaning-Engines").getOrCreate()
+
+    try:
+        inventory_df = create_synthetic_inventory(spark, args.num_rows, args.num_partitions)
+        inventory_df.cache().count()
+
+        print(f"{'engine':<8} {'function':<24} {'seconds':>8} {'rows/sec':>12}")
+        for engine in args.engines:
+            cleaners = create_text_cleaners(engine)
+            benchmarks = {
+                "normalize_text": [cleaners.normalize_text(inventory_df.raw_author)],
+                "format_spl_author": [cleaners.format_spl_author(inventory_df.raw_author)],
+                "clean_title": [cleaners.clean_title(inventory_df.raw_title, inventory_df.gr_title)],
+                "clean_publication_year": [
+                    cleaners.clean_publication_year(inventory_df.raw_publication_year, inventory_df.gr_publication_date),
+                ],
+                "clean_publisher": [cleaners.clean_publisher(inventory_df.raw_publisher)],
+            }
+            benchmarks["all"] = [col for cols in list(benchmarks.values()) for col in cols]
+
+            # Warm up the JVM and Python workers so the first timing is not penalized
+            time_select(inventory_df, benchmarks["all"])
+
+            for name, cols in benchmarks.items():
+                seconds = time_select(inventory_df, cols)
+                print(f"{engine:<8} {name:<24} {seconds:>8.2f} {args.num_rows / seconds:>12,.0f}")
+    finally:
+        spark.stop()
+
+
+def create_synthetic_inventory(spark, num_rows, num_partitions):
+    """Creates a synthetic inventory with the same text formats as the SPL inventory
+
+    Args:
+        spark: Spark session
+        num_rows: Number of books to generate
+        num_partitions: Number of partitions to generate the books in
+
+    Returns:
+        - Synthetic inventory
+        - Columns:
+          - raw_author
+          - raw_title
+          - raw_publication_year
+          - raw_publisher
+          - gr_title: Populated for roughly one in ten books
+          - gr_publication_date: Populated for roughly one in ten books
+    """
+    df = spark.range(0, num_rows, numPartitions=num_partitions)
+    has_goodreads = df.id % 10 == 0
+    return df.select(
+        F.concat(
+            pick(LAST_NAMES, df.id),
+            F.lit(", "),
+            pick(FIRST_NAMES, df.id * 7),
+            pick(AUTHOR_SUFFIXES, df.id * 13),
+        ).alias("raw_author"),
+        F.concat(pick(TITLES, df.id), F.lit(" / "), pick(FIRST_NAMES, df.id * 3), F.lit(" "), pick(LAST_NAMES, df.id))
+        .alias("raw_title"),
+        pick(PUBLICATION_YEARS, df.id).alias("raw_publication_year"),
+        F.concat(pick(PUBLISHERS, df.id), F.lit(" "), (df.id % 1000).cast("string")).alias("raw_publisher"),
+        F.when(has_goodreads, pick(TITLES, df.id * 11)).alias("gr_title"),
+        F.when(has_goodreads, F.to_timestamp(F.lit("2001-01-01"))).alias("gr_publication_date"),
+    )
+
+
+def pick(values, seed_col):
+    """Deterministically picks a value from a list of strings based on an integer column"""
+    return F.array(*[F.lit(v) for v in values]).getItem((seed_col % len(values)).cast("int"))
+
+
+def time_select(df, cols):
+    """Times how long it takes to compute the given columns over the dataframe
+
+    The noop data source forces every row to be computed without the cost of writing output.
+    """
+    start = time.perf_counter()
+    df.select(*cols).write.format("noop").mode("overwrite").save()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
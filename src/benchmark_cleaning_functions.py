@@ -0,0 +1,215 @@
+"""
+Microbenchmark for the Python text cleaning functions in etl_spark.py
+
+The Python UDFs call these functions once per row, so small changes to them add up over the
+tens of millions of rows of a full run. Each function is run over a corpus of strings in the
+formats of the SPL inventory without Spark, and the time per row and the memory allocated by
+the function are reported.
+
+Save the results of the current code as a baseline, then check a change against it:
+
+    python benchmark_cleaning_functions.py --output baseline.json
+    python benchmark_cleaning_functions.py --baseline baseline.json --threshold 0.3
+
+The check exits with an error if a function got slower by more than the threshold. Run both on
+the same machine, since the timings are not comparable between machines.
+"""
+import argparse
+import datetime
+import gc
+import json
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+from cleaning_corpus import (
+    AUTHOR_SUFFIXES,
+    CORPORATE_AUTHORS,
+    FIRST_NAMES,
+    LAST_NAMES,
+    PUBLICATION_YEARS,
+    PUBLISHERS,
+    TITLE_CREDITS,
+    TITLES,
+)
+from etl_spark import (
+    clean_publication_year_text,
+    clean_publisher_text,
+    clean_title_text,
+    format_spl_author,
+    normalize_text,
+)
+
+
+DEFAULT_NUM_ROWS = 100000
+DEFAULT_REPEATS = 15
+# Runs of the same code on the same machine still differ by up to about 20%, mostly for the fastest functions
+DEFAULT_REGRESSION_THRESHOLD = 0.3
+CORPUS_SEED = 20210201
+
+# Roughly one in ten SPL books is linked to Goodreads, and some of the SPL columns are empty
+GOODREADS_SHARE = 0.1
+NULL_SHARE = 0.02
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Python text cleaning functions")
+    parser.add_argument("--num-rows", type=int, default=DEFAULT_NUM_ROWS)
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help="The median of the repeats is reported")
+    parser.add_argument("--output", help="Path to save the results as JSON, e.g. to use as a baseline")
+    parser.add_argument("--baseline", help="Results of an earlier run to check for regressions")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_REGRESSION_THRESHOLD,
+        help="Relative increase of the time per row that is flagged as a regression",
+    )
+    args = parser.parse_args()
+
+    corpus = create_corpus(args.num_rows)
+    benchmarks = {
+        "normalize_text": (normalize_text, [(row["author"],) for row in corpus]),
+        "format_spl_author": (format_spl_author, [(row["author"],) for row in corpus]),
+        "clean_title_text": (clean_title_text, [(row["title"], row["gr_title"]) for row in corpus]),
+        "clean_publication_year_text": (
+            clean_publication_year_text,
+            [(row["publication_year"], row["gr_publication_date"]) for row in corpus],
+        ),
+        "clean_publisher_text": (clean_publisher_text, [(row["publisher"],) for row in corpus]),
+    }
+
+    results = {}
+    for name, (func, rows) in benchmarks.items():
+        results[name] = benchmark_function(func, rows, args.repeats)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print(f"{'function':<28} {'ns/row':>10} {'baseline':>10} {'change':>8} {'bytes/row':>10} {'peak bytes':>11}")
+    regressions = []
+    for name, result in results.items():
+        baseline_ns = baseline["results"][name]["ns_per_row"] if baseline and name in baseline["results"] else None
+        change = result["ns_per_row"] / baseline_ns - 1 if baseline_ns else None
+        flag = ""
+        if change is not None and change > args.threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:<28} {result['ns_per_row']:>10.0f} "
+            f"{'' if baseline_ns is None else f'{baseline_ns:.0f}':>10} "
+            f"{'' if change is None else f'{change:+.1%}':>8} "
+            f"{result['result_bytes_per_row']:>10.0f} {result['peak_bytes']:>11}{flag}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"num_rows": args.num_rows, "python_version": sys.version, "results": results}, f, indent=2)
+
+    if baseline:
+        print(f"{len(regressions)} regressions with a threshold of {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+def create_corpus(num_rows: int) -> List[Dict[str, Any]]:
+    """Creates rows with the text formats of the SPL inventory
+
+    Args:
+        num_rows: Number of rows
+
+    Returns:
+        Rows with author, title, gr_title, publication_year, gr_publication_date, and publisher
+    """
+    rng = random.Random(CORPUS_SEED)
+
+    def maybe_null(text):
+        return None if rng.random() < NULL_SHARE else text
+
+    corpus = []
+    for _ in range(num_rows):
+        if rng.random() < 0.1:
+            author = rng.choice(CORPORATE_AUTHORS)
+        else:
+            author = f"{rng.choice(LAST_NAMES)}, {rng.choice(FIRST_NAMES)}{rng.choice(AUTHOR_SUFFIXES)}"
+        title = f"{rng.choice(TITLES)} / {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}{rng.choice(TITLE_CREDITS)}"
+        has_goodreads = rng.random() < GOODREADS_SHARE
+        corpus.append({
+            "author": maybe_null(author),
+            "title": maybe_null(title),
+            "gr_title": rng.choice(TITLES) if has_goodreads else None,
+            "publication_year": maybe_null(rng.choice(PUBLICATION_YEARS)),
+            "gr_publication_date": datetime.datetime(rng.randint(1950, 2017), 1, 1) if has_goodreads else None,
+            "publisher": maybe_null(rng.choice(PUBLISHERS)),
+        })
+    return corpus
+
+
+def benchmark_function(func: Callable, rows: List[Tuple], repeats: int) -> Dict[str, float]:
+    """Times a function over the rows and measures the memory it allocates
+
+    Args:
+        func: Function to benchmark
+        rows: Arguments of each call
+        repeats: Number of times to time the rows. The median time is used, since it varies less
+            between runs than the fastest time.
+
+    Returns:
+        - ns_per_row: Time per row in nanoseconds
+        - result_bytes_per_row: Memory kept by the results per row
+        - peak_bytes: Most memory in use at one time while the results are discarded. This
+          includes the temporary strings, lists, and regex matches of a call.
+    """
+    # The loop overhead is subtracted so the time is only the function
+    empty_ns = statistics.median(time_rows(lambda *args: None, rows) for _ in range(repeats))
+    ns = statistics.median(time_rows(func, rows) for _ in range(repeats))
+
+    tracemalloc.start()
+    try:
+        for args in rows:
+            func(*args)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    tracemalloc.start()
+    try:
+        results = [func(*args) for args in rows]
+        result_bytes, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del results
+
+    return {
+        "ns_per_row": max(ns - empty_ns, 0) / len(rows),
+        "result_bytes_per_row": result_bytes / len(rows),
+        "peak_bytes": peak_bytes,
+    }
+
+
+def time_rows(func: Callable, rows: List[Tuple]) -> int:
+    """Times calling a function with each row of arguments
+
+    The garbage collector is disabled while timing, like in timeit, so that its pauses do not
+    land on whichever function happens to be running.
+
+    Returns:
+        Time in nanoseconds
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter_ns()
+        for args in rows:
+            func(*args)
+        return time.perf_counter_ns() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+Benchmarks the full ETL on synthetic data in local Spark mode.
+
+Generates the synthetic input data with generate_synthetic_data.py, runs etl_spark.py on it
+with a run report, and writes the wall time and throughput of each ETL stage as JSON. Running
+the benchmark at several scales shows how each stage grows with the number of checkouts, e.g.
+for the 100x growth scenario in the README:
+
+    python benchmark_etl.py /tmp/spl-benchmark --num-checkouts 1M
+    python benchmark_etl.py /tmp/spl-benchmark --num-checkouts 50M
+
+The generated data is reused by later runs with the same scale and seed. Settings in the etl.cfg
+[main] section can be changed with --set, e.g. --set persist_mode=disk.
+"""
+import argparse
+import configparser
+import glob
+import json
+import os
+import platform
+import shutil
+import time
+from typing import Any, Dict, List
+
+from pyspark.sql import SparkSession
+
+import etl_spark
+import generate_synthetic_data
+from generate_synthetic_data import DEFAULT_END_YEAR, DEFAULT_NUM_CHECKOUTS, DEFAULT_SEED, DEFAULT_START_YEAR, parse_count
+
+
+# Tables written by the ETL, by etl.cfg [output] key
+OUTPUT_TABLES = [
+    "br_book_author_path",
+    "br_book_subject_path",
+    "dim_author_path",
+    "dim_book_path",
+    "dim_checkout_time_path",
+    "dim_publisher_path",
+    "dim_subject_path",
+    "fact_spl_book_checkout_path",
+]
+
+# Functions that run the ETL stages are named run_<stage>_stage
+STAGE_FUNCTION_PREFIX = "run_"
+STAGE_FUNCTION_SUFFIX = "_stage"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ETL on synthetic data in local Spark mode")
+    parser.add_argument("work_path", help="Local directory for the synthetic data, ETL outputs, and benchmark results")
+    parser.add_argument(
+        "--num-checkouts",
+        type=parse_count,
+        default=DEFAULT_NUM_CHECKOUTS,
+        help="Number of checkouts, e.g. 1M, 50M, or 500M",
+    )
+    parser.add_argument("--start-year", type=int, default=DEFAULT_START_YEAR)
+    parser.add_argument("--end-year", type=int, default=DEFAULT_END_YEAR)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument(
+        "--set",
+        dest="settings",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Setting of the etl.cfg [main] section. Can be repeated.",
+    )
+    parser.add_argument("--regenerate", action="store_true", help="Generate the synthetic data even if it exists")
+    args = parser.parse_args()
+
+    # The ETL stages run in threads that need to keep their Spark scheduler pools
+    os.environ.setdefault("PYSPARK_PIN_THREAD", "true")
+
+    work_path = os.path.abspath(args.work_path)
+    data_path = prepare_synthetic_data(
+        work_path,
+        args.num_checkouts,
+        args.start_year,
+        args.end_year,
+        args.seed,
+        args.regenerate,
+    )
+
+    run_path = os.path.join(work_path, "runs", time.strftime("%Y%m%dT%H%M%S"))
+    config_path = create_config(data_path, run_path, parse_settings(args.settings))
+
+    start = time.time()
+    etl_spark.main(["--config", config_path])
+    run_time = time.time() - start
+
+    report_paths = sorted(glob.glob(os.path.join(run_path, "reports", "*.json")))
+    with open(report_paths[-1]) as f:
+        report = json.load(f)
+
+    benchmark = create_benchmark(report, args.num_checkouts, run_time)
+    benchmark["output_bytes"] = measure_output_sizes(run_path)
+    benchmark_path = os.path.join(work_path, f"benchmark-{args.num_checkouts}-{time.strftime('%Y%m%dT%H%M%S')}.json")
+    with open(benchmark_path, "w") as f:
+        json.dump(benchmark, f, indent=2)
+
+    print_benchmark(benchmark)
+    print(f"Wrote benchmark to {benchmark_path}")
+
+    # The outputs are only needed for the output sizes
+    shutil.rmtree(os.path.join(run_path, "output"))
+
+
+def prepare_synthetic_data(
+    work_path: str,
+    num_checkouts: int,
+    start_year: int,
+    end_year: int,
+    seed: int,
+    regenerate: bool = False,
+) -> str:
+    """Generates the synthetic data unless it was already generated with the same arguments
+
+    Args:
+        work_path: Local directory for the synthetic data
+        num_checkouts: Number of checkouts
+        start_year: First year of checkouts
+        end_year: Last year of checkouts
+        seed: Different seeds generate different data
+        regenerate: Generate the data even if it exists
+
+    Returns:
+        Path to the synthetic data
+    """
+    data_path = os.path.join(work_path, "data", f"{num_checkouts}-{start_year}-{end_year}-{seed}")
+    if regenerate or not os.path.exists(os.path.join(data_path, generate_synthetic_data.CHECKOUTS_PATH)):
+        spark = SparkSession.builder.appName("SPL-Generate-Synthetic-Data").getOrCreate()
+        try:
+            start = time.time()
+            generate_synthetic_data.generate_synthetic_data(spark, data_path, num_checkouts, start_year, end_year, seed)
+            print(f"Generated the synthetic data in {time.time() - start:.1f}s")
+        finally:
+            spark.stop()
+    return data_path
+
+
+def parse_settings(settings: List[str]) -> Dict[str, str]:
+    """Parses KEY=VALUE settings
+
+    Args:
+        settings: Settings from the command line
+
+    Returns:
+        Values by key
+    """
+    parsed = {}
+    for setting in settings:
+        key, separator, value = setting.partition("=")
+        if not separator:
+            raise ValueError(f"Expected KEY=VALUE setting, got: {setting}")
+        parsed[key.strip()] = value.strip()
+    return parsed
+
+
+def create_config(data_path: str, run_path: str, settings: Dict[str, str], spark_settings: Dict[str, str] = None) -> str:
+    """Writes the etl.cfg of a benchmark run
+
+    Every stage is run, since the outputs of each run are written to a new directory and there
+    are no success markers. The raw data is parsed by every run unless staging_path is set.
+
+    Args:
+        data_path: Path to the synthetic data
+        run_path: Path to the outputs and run report of the run
+        settings: Settings of the [main] section
+        spark_settings: Settings of the [spark] section
+
+    Returns:
+        Path to the config file
+    """
+    output_path = os.path.join(run_path, "output")
+    config = configparser.ConfigParser()
+    # Spark setting names are case sensitive
+    config.optionxform = str
+    config["main"] = settings
+    config["aws"] = {"key": "", "secret": ""}
+    config["spl"] = {
+        "checkouts_path": os.path.join(
+            data_path,
+            generate_synthetic_data.CHECKOUTS_PATH,
+            generate_synthetic_data.CHECKOUTS_FILE_PATTERN,
+        ),
+        "data_dict_path": os.path.join(data_path, generate_synthetic_data.DATA_DICT_PATH),
+        "inventory_path": os.path.join(data_path, generate_synthetic_data.INVENTORY_PATH, "*.csv"),
+    }
+    config["goodreads"] = {"data_path": os.path.join(data_path, generate_synthetic_data.GOODREADS_PATH, "*.csv")}
+    config["weather"] = {"data_path": os.path.join(data_path, generate_synthetic_data.WEATHER_PATH)}
+    config["publishers"] = {"data_path": os.path.join(data_path, generate_synthetic_data.PUBLISHERS_PATH)}
+    config["output"] = {
+        **{key: os.path.join(output_path, key[:-len("_path")]) for key in OUTPUT_TABLES},
+        "processed_checkouts_path": os.path.join(output_path, "processed_checkouts"),
+        "run_reports_path": os.path.join(run_path, "reports"),
+    }
+    config["spark"] = spark_settings or {}
+
+    os.makedirs(run_path, exist_ok=True)
+    config_path = os.path.join(run_path, "etl.cfg")
+    with open(config_path, "w") as f:
+        config.write(f)
+    return config_path
+
+
+def create_benchmark(report: Dict[str, Any], num_checkouts: int, run_time: float) -> Dict[str, Any]:
+    """Calculates the wall time and throughput of each stage from a run report
+
+    The rows of a stage are the records read from its input files and the records it wrote. They
+    are only available when the Spark UI is enabled.
+
+    Args:
+        report: Run report of the ETL run
+        num_checkouts: Number of synthetic checkouts
+        run_time: Wall time of the ETL run in seconds
+
+    Returns:
+        Benchmark results
+    """
+    stages = []
+    for call in report["calls"]:
+        function = call["function"]
+        if not (function.startswith(STAGE_FUNCTION_PREFIX) and function.endswith(STAGE_FUNCTION_SUFFIX)):
+            continue
+        wall_time = call.get("wall_time", 0.0)
+        metrics = call.get("total_metrics", {})
+        stages.append({
+            "stage": call["stage"],
+            "wall_time": wall_time,
+            "input_records": metrics.get("inputRecords", 0),
+            "output_records": metrics.get("outputRecords", 0),
+            "shuffle_write_bytes": metrics.get("shuffleWriteBytes", 0),
+            "spill_bytes": metrics.get("diskBytesSpilled", 0),
+            "input_records_per_second": metrics.get("inputRecords", 0) / wall_time if wall_time else None,
+            "output_records_per_second": metrics.get("outputRecords", 0) / wall_time if wall_time else None,
+        })
+
+    return {
+        "num_checkouts": num_checkouts,
+        "status": report["status"],
+        "app_id": report["app_id"],
+        "settings": report["settings"],
+        "cpu_count": os.cpu_count(),
+        "python_version": platform.python_version(),
+        "created_at": report["created_at"],
+        "run_time": run_time,
+        "checkouts_per_second": num_checkouts / run_time,
+        "total_stage_time": sum(stage["wall_time"] for stage in stages),
+        "stages": sorted(stages, key=lambda stage: stage["wall_time"], reverse=True),
+    }
+
+
+def measure_output_sizes(run_path: str) -> Dict[str, int]:
+    """Measures the size of each output table of a run
+
+    Args:
+        run_path: Path to the outputs of the run
+
+    Returns:
+        Bytes by table name
+    """
+    sizes = {}
+    output_path = os.path.join(run_path, "output")
+    for table_name in sorted(os.listdir(output_path)):
+        sizes[table_name] = sum(
+            os.path.getsize(os.path.join(dir_path, file_name))
+            for dir_path, _, file_names in os.walk(os.path.join(output_path, table_name))
+            for file_name in file_names
+        )
+    return sizes
+
+
+def print_benchmark(benchmark: Dict[str, Any]):
+    """Prints the throughput of each stage
+
+    Args:
+        benchmark: Benchmark results
+    """
+    stage_width = max([len("Stage")] + [len(stage["stage"]) for stage in benchmark["stages"]])
+    print(f"{'Stage':<{stage_width}}  {'Time (s)':>9}  {'Input rows':>12}  {'Input rows/s':>13}  {'Output rows':>12}")
+    for stage in benchmark["stages"]:
+        rows_per_second = stage["input_records_per_second"] or 0
+        print(
+            f"{stage['stage']:<{stage_width}}  {stage['wall_time']:>9.1f}  {stage['input_records']:>12}  "
+            f"{rows_per_second:>13.0f}  {stage['output_records']:>12}"
+        )
+    print(
+        f"{benchmark['num_checkouts']} checkouts in {benchmark['run_time']:.1f}s "
+        f"({benchmark['checkouts_per_second']:.0f} checkouts/s), "
+        f"total stage time: {benchmark['total_stage_time']:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Checks that the text cleaning engines in etl_spark.py produce the same output
+
+The Python UDFs are the reference implementation. Each of the other engines is run
+against the examples from the UDF docstrings and a set of randomly generated strings
+using a local Spark session.
+
+Run this script in the src directory after changing any of the cleaning functions:
+
+    python check_cleaning_engines.py
+"""
+import datetime
+import random
+
+from pyspark.sql import SparkSession
+from pyspark.sql.types import IntegerType, StringType, StructField, StructType, TimestampType
+
+from cleaning_corpus import EXAMPLE_AUTHORS, EXAMPLE_TITLES, PUBLICATION_YEARS, PUBLISHERS
+from etl_spark import CLEANING_ENGINES, clean_publication_year_text, create_text_cleaners
+
+
+REFERENCE_ENGINE = "udf"
+
+NUM_RANDOM_ROWS = 5000
+RANDOM_SEED = 20210201
+
+# Max number of mismatches to print when a check fails
+MAX_MISMATCHES_SHOWN = 10
+
+# Use small Arrow batches so that the pandas UDFs also get checked against batches where
+# every row takes the same branch
+ARROW_MAX_RECORDS_PER_BATCH = 3
+
+# Expected publication years of the reference engine. Python's regex also matches other Unicode
+# digits, which have to be compared as numbers rather than as text. The native engine only
+# matches ASCII digits, so these are not compared between the engines.
+EXPECTED_PUBLICATION_YEARS = [
+    ("1991, c1988.", 1988),
+    ("2003, c1999.", 1999),
+    ("١٩٩٩, 2008", 1999),
+    ("2008, １９９９", 1999),
+    ("no year", None),
+]
+
+# Random strings are built from these fragments so that the branches of each cleaning
+# function are exercised more often than they would be with random characters alone.
+RANDOM_FRAGMENTS = [
+    "a", "Z", "ö", "É", "İ", "Σ", "name", "Smith", "Jane", "1952", "1938-", "2014", "c1988", "98360", "12345",
+    ", ", ",", " / ", "/", " : ", " ; ", "(", ")", "[", "]", "{", "}", "<", ">", "'", "\"", ".", "-", "_", "©",
+    "&", "|", "\\", "!", "#", "*", "+", "?", "@", " ", "  ", "\t", "\n", "\r", "\xa0", "\x1c", " ",
+    ", 1952-", ", 1858-1940", " (Volker Rolf)", "x" * 40,
+]
+
+
+def main():
+    print("Running data check: has_expected_publication_years (udf)...", end=" ")
+    has_expected_publication_years()
+    print("OK")
+
+    spark = (
+        SparkSession.builder
+        .appName("SPL-Check-Cleaning-Engines")
+        .config("spark.sql.execution.arrow.maxRecordsPerBatch", ARROW_MAX_RECORDS_PER_BATCH)
+        .getOrCreate()
+    )
+
+    data_checks = [
+        has_same_normalized_text,
+        has_same_formatted_spl_authors,
+        has_same_cleaned_titles,
+        has_same_cleaned_publication_years,
+        has_same_cleaned_publishers,
+    ]
+
+    try:
+        df = create_examples_df(spark)
+        df.cache()
+
+        reference = create_text_cleaners(REFERENCE_ENGINE)
+        for engine in CLEANING_ENGINES:
+            if engine == REFERENCE_ENGINE:
+                continue
+            cleaners = create_text_cleaners(engine)
+            for data_check in data_checks:
+                print(f"Running data check: {data_check.__name__} ({engine})...", end=" ")
+                data_check(df, reference, cleaners)
+                print("OK")
+    finally:
+        spark.stop()
+
+
+def create_examples_df(spark):
+    """Creates dataframe of docstring examples, edge cases, and random strings"""
+    rng = random.Random(RANDOM_SEED)
+    examples = EXAMPLE_AUTHORS + EXAMPLE_TITLES + PUBLICATION_YEARS + PUBLISHERS + [None, "", " ", ","]
+    rows = [(text, None, text, None, text) for text in examples]
+    rows.append(("Smith, Jane", "Goodreads Title", "2008.", datetime.datetime(1999, 5, 1), "Knopf,"))
+    rows.append((None, "", None, None, None))
+    for _ in range(NUM_RANDOM_ROWS):
+        rows.append((
+            random_text(rng),
+            rng.choice([None, "", random_text(rng)]),
+            random_text(rng),
+            rng.choice([None, datetime.datetime(rng.randint(1900, 2020), rng.randint(1, 12), rng.randint(1, 28))]),
+            random_text(rng),
+        ))
+
+    schema = StructType([
+        StructField("text", StringType(), True),
+        StructField("gr_text", StringType(), True),
+        StructField("publication_year", StringType(), True),
+        StructField("gr_publication_date", TimestampType(), True),
+        StructField("publisher", StringType(), True),
+    ])
+    return spark.createDataFrame(rows, schema)
+
+
+def random_text(rng):
+    """Generates a random string from the fragments list"""
+    if rng.random() < 0.05:
+        return None
+    return "".join(rng.choice(RANDOM_FRAGMENTS) for _ in range(rng.randint(0, 8)))
+
+
+def has_expected_publication_years():
+    """Checks that the reference engine picks the earliest publication year"""
+    for spl_publication_year, expected in EXPECTED_PUBLICATION_YEARS:
+        year = clean_publication_year_text(spl_publication_year, None)
+        assert year == expected, f"Expected {expected} for {spl_publication_year!r}, got {year}"
+
+
+def has_same_normalized_text(df, reference, cleaners):
+    """Checks that normalize_text matches the reference engine"""
+    assert_same_output(df, df.text, reference.normalize_text(df.text), cleaners.normalize_text(df.text))
+
+
+def has_same_formatted_spl_authors(df, reference, cleaners):
+    """Checks that format_spl_author matches the reference engine"""
+    assert_same_output(df, df.text, reference.format_spl_author(df.text), cleaners.format_spl_author(df.text))
+
+
+def has_same_cleaned_titles(df, reference, cleaners):
+    """Checks that clean_title matches the reference engine"""
+    assert_same_output(
+        df,
+        df.text,
+        reference.clean_title(df.text, df.gr_text),
+        cleaners.clean_title(df.text, df.gr_text),
+    )
+
+
+def has_same_cleaned_publication_years(df, reference, cleaners):
+    """Checks that clean_publication_year matches the reference engine
+
+    The publication year is cast to an integer the same way generate_books does.
+    """
+    assert_same_output(
+        df,
+        df.publication_year,
+        reference.clean_publication_year(df.publication_year, df.gr_publication_date).cast(IntegerType()),
+        cleaners.clean_publication_year(df.publication_year, df.gr_publication_date).cast(IntegerType()),
+    )
+
+
+def has_same_cleaned_publishers(df, reference, cleaners):
+    """Checks that clean_publisher matches the reference engine"""
+    assert_same_output(df, df.publisher, reference.clean_publisher(df.publisher), cleaners.clean_publisher(df.publisher))
+
+
+def assert_same_output(df, input_col, expected_col, actual_col):
+    """Asserts that two cleaning functions return the same value for every row"""
+    rows = df.select(
+        input_col.alias("input"),
+        expected_col.alias("expected"),
+        actual_col.alias("actual"),
+    ).collect()
+    mismatches = [row for row in rows if row.expected != row.actual]
+    for row in mismatches[:MAX_MISMATCHES_SHOWN]:
+        print(f"\n  input={row.input!r} expected={row.expected!r} actual={row.actual!r}", end="")
+    assert not mismatches, f"{len(mismatches)} of {len(rows)} rows did not match the reference engine"
+
+
+if __name__ == "__main__":
+    main()
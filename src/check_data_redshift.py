@@ -59,7 +59,12 @@ def main():
         has_valid_ratings,
         has_valid_barcode,
         has_valid_checkout_year,
+        has_unique_dimension_ids,
     ]
+    # The compact schema stores the barcodes as integers and the checkout IDs as 64-bit hashes
+    if config.getboolean("main", "compact_schema", fallback=False):
+        data_checks[data_checks.index(has_valid_barcode)] = has_valid_compact_barcode
+        data_checks.append(has_unique_checkout_ids)
 
     with conn.cursor() as cursor:
         for data_check in data_checks:
@@ -96,9 +101,7 @@ def has_valid_temperature(cursor):
     cursor.execute(query)
     row = cursor.fetchone()
 
-    # TODO(richard-to): There is a data quality error here where there was a temperature -99
-    #                   degrees. Commenting out for now. I hope that is OK.
-    # assert row[0] > -20, "Temperature in Seattle shouldn't be less than -20 degrees"
+    assert row[0] > -20, "Temperature in Seattle shouldn't be less than -20 degrees"
     assert row[1] < 120, "Temperature in Seattle shouldn't be higher than -120 degrees"
 
 
@@ -123,6 +126,16 @@ def has_valid_barcode(cursor):
     assert row[0] == 0, "Item barcode should be 13 digits long"
 
 
+def has_valid_compact_barcode(cursor):
+    """Checks that the item barcode has at most 13 digits in the compact schema"""
+
+    query = "SELECT COUNT(item_barcode) FROM fact_spl_book_checkout WHERE item_barcode NOT BETWEEN 0 AND 9999999999999"
+    cursor.execute(query)
+    row = cursor.fetchone()
+
+    assert row[0] == 0, "Item barcode should be 13 digits long"
+
+
 def has_valid_checkout_year(cursor):
     """Checks that the checkout year is between 2005 and 2017"""
 
@@ -133,5 +146,36 @@ def has_valid_checkout_year(cursor):
     assert row[0] == 0, "Checkout year data should span from 2005 to 2017"
 
 
+def has_unique_dimension_ids(cursor):
+    """Checks that the generated dimension IDs do not have hash collisions"""
+
+    queries = [
+        "SELECT COUNT(id) - COUNT(DISTINCT id) FROM dim_publisher",
+        "SELECT COUNT(id) - COUNT(DISTINCT id) FROM dim_author",
+        "SELECT COUNT(id) - COUNT(DISTINCT id) FROM dim_subject",
+    ]
+    for query in queries:
+        cursor.execute(query)
+        row = cursor.fetchone()
+        assert row[0] == 0, f"Query failed data check: {query}"
+
+
+def has_unique_checkout_ids(cursor):
+    """Checks that the 64-bit checkout IDs of the compact schema do not have hash collisions
+
+    Checkouts of the same item at the same time have the same ID, so only the distinct
+    checkouts are compared.
+    """
+
+    query = """
+    SELECT COUNT(DISTINCT id) - COUNT(*)
+    FROM (SELECT DISTINCT bib_num, item_barcode, checkout_datetime, id FROM fact_spl_book_checkout) AS checkouts
+    """
+    cursor.execute(query)
+    row = cursor.fetchone()
+
+    assert row[0] == 0, "Checkout IDs should be unique"
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,143 @@
+"""
+Checks that the physical plans of the ETL tables match the golden plans
+
+Runs etl_spark.py in dry run mode on a small synthetic dataset and compares the operator tree
+of each table's plan with the golden plan in golden_plans/. The check fails when a plan
+changed, or when a table gained a nested loop join, cartesian product, Python UDF, or shuffle,
+so a change that regresses a join strategy is caught before it runs on the full data.
+
+Run this script in the src directory after changing how the tables are built:
+
+    python check_plans.py
+
+If the plans changed on purpose, review the differences and update the golden plans:
+
+    python check_plans.py --update
+
+Spark picks different operators in different versions, so the golden plans are kept for each
+Spark version. Automatic broadcast joins are turned off, so the small synthetic tables are
+joined the same way as the full tables. Only the joins the code broadcasts explicitly are
+broadcast.
+"""
+import argparse
+import difflib
+import os
+import sys
+import tempfile
+
+import pyspark
+
+import etl_spark
+from benchmark_etl import create_config, prepare_synthetic_data
+from plan_inspector import count_shuffles, extract_plan_tree, find_plan_issues
+
+
+GOLDEN_PLANS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden_plans")
+
+NUM_CHECKOUTS = 20000
+START_YEAR = 2016
+END_YEAR = 2017
+SEED = 0
+
+# Settings that make the plans the same on every machine and at every scale
+SPARK_SETTINGS = {"spark.sql.autoBroadcastJoinThreshold": "-1"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the physical plans of the ETL tables")
+    parser.add_argument("--update", action="store_true", help="Replace the golden plans with the current plans")
+    parser.add_argument("--work-path", help="Local directory for the synthetic data. Defaults to a temporary directory.")
+    args = parser.parse_args()
+
+    # The ETL stages run in threads that need to keep their Spark scheduler pools
+    os.environ.setdefault("PYSPARK_PIN_THREAD", "true")
+
+    work_path = os.path.abspath(args.work_path or tempfile.mkdtemp(prefix="spl-check-plans-"))
+    data_path = prepare_synthetic_data(work_path, NUM_CHECKOUTS, START_YEAR, END_YEAR, SEED)
+    run_path = os.path.join(work_path, "check_plans")
+    plans_path = os.path.join(run_path, "plans")
+    config_path = create_config(data_path, run_path, {}, SPARK_SETTINGS)
+    etl_spark.main(["--config", config_path, "--dry-run", plans_path])
+
+    plans = {}
+    for file_name in sorted(os.listdir(plans_path)):
+        with open(os.path.join(plans_path, file_name)) as f:
+            plans[os.path.splitext(file_name)[0]] = extract_plan_tree(f.read())
+
+    golden_path = os.path.join(GOLDEN_PLANS_PATH, "spark-{}.{}".format(*pyspark.__version__.split(".")[:2]))
+    if args.update:
+        update_golden_plans(plans, golden_path)
+        return
+
+    if not os.path.isdir(golden_path):
+        print(f"There are no golden plans for Spark {pyspark.__version__}. Create them with --update.")
+        sys.exit(1)
+
+    golden_plans = load_golden_plans(golden_path)
+    failures = []
+    for name in sorted(plans.keys() | golden_plans.keys()):
+        problems = compare_plans(golden_plans.get(name), plans.get(name))
+        print(f"{name}: {'OK' if not problems else 'FAILED'}")
+        for problem in problems:
+            print(f"  {problem}")
+        if problems:
+            failures.append(name)
+
+    print(f"{len(failures)} of {len(plans.keys() | golden_plans.keys())} plans failed. Full plans: {plans_path}")
+    sys.exit(1 if failures else 0)
+
+
+def compare_plans(golden_plan: str, plan: str) -> list:
+    """Compares the operator tree of a table's plan with its golden plan
+
+    Args:
+        golden_plan: Golden operator tree, or None if the table is new
+        plan: Current operator tree, or None if the table is no longer built
+
+    Returns:
+        Descriptions of the problems. Empty if the plans match.
+    """
+    if plan is None:
+        return ["The table is no longer built"]
+    if golden_plan is None:
+        return ["There is no golden plan for the table"] + find_plan_issues(plan)
+
+    problems = [f"New {issue}" for issue in find_plan_issues(plan) if issue not in find_plan_issues(golden_plan)]
+    golden_shuffles, shuffles = count_shuffles(golden_plan), count_shuffles(plan)
+    if shuffles > golden_shuffles:
+        problems.append(f"{shuffles} shuffles instead of {golden_shuffles}")
+    if plan != golden_plan:
+        problems.append("The plan changed:")
+        problems.extend(difflib.unified_diff(golden_plan.splitlines(), plan.splitlines(), "golden", "current", lineterm=""))
+    return problems
+
+
+def load_golden_plans(golden_path: str) -> dict:
+    """Loads the golden operator trees by table name"""
+    golden_plans = {}
+    for file_name in sorted(os.listdir(golden_path)):
+        with open(os.path.join(golden_path, file_name)) as f:
+            golden_plans[os.path.splitext(file_name)[0]] = f.read().rstrip("\n")
+    return golden_plans
+
+
+def update_golden_plans(plans: dict, golden_path: str):
+    """Replaces the golden operator trees with the current ones
+
+    Args:
+        plans: Current operator trees by table name
+        golden_path: Directory of the golden plans for the Spark version
+    """
+    os.makedirs(golden_path, exist_ok=True)
+    for file_name in os.listdir(golden_path):
+        os.remove(os.path.join(golden_path, file_name))
+    for name, plan in plans.items():
+        with open(os.path.join(golden_path, f"{name}.txt"), "w") as f:
+            f.write(plan + "\n")
+        issues = find_plan_issues(plan)
+        print(f"{name}: {count_shuffles(plan)} shuffles{', ' if issues else ''}{'; '.join(issues)}")
+    print(f"Updated the golden plans in {golden_path}")
+
+
+if __name__ == "__main__":
+    main()
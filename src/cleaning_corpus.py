@@ -0,0 +1,51 @@
+"""
+Text in the formats of the SPL inventory, for checking and benchmarking the text cleaning functions
+
+The examples are taken from the docstrings of the cleaning functions in etl_spark.py. The
+names, titles, and credits are fragments that the benchmarks combine into synthetic authors and
+titles in the same formats.
+"""
+
+
+EXAMPLE_AUTHORS = [
+    "Brand Miller, Janette, 1952-",
+    "Cabatingan, Erin",
+    "Berghahn, Volker R. (Volker Rolf), 1938-",
+    "Avi, 1937-",
+    "Lagerlöf, Selma, 1858-1940",
+    "United States. Maritime Commission",
+]
+
+EXAMPLE_TITLES = [
+    "The only child : a novel / Andrew Pyper.",
+    "The great powers outage / William Boniface ; illustrations by Stephen Gilpin.",
+    "The Paris pilgrims : a novel / Clancy Carlile.",
+    "Big Bill Haywood and the radical union movement [by] Joseph R. Conlin.",
+    "Japanese arms & armor. Introd. by H. Russell Robinson",
+]
+
+PUBLICATION_YEARS = ["2008.", "[2014]", "©2014", "1991, c1988.", "2003, c1999.", "114 So. Washington, Orting 98360-0040)"]
+
+PUBLISHERS = [
+    "Schocken Books,",
+    "Schocken : Nextbook,",
+    "Bloomsbury,",
+    "Crowell ; HarperCollins,",
+    "Knopf : distributed by Random House,",
+    "American Elsevier Pub. Co.",
+    "Westminster/John Knox Press ; Saint Andrew Press",
+    "Frick Collection in association with Yale University Press,",
+]
+
+LAST_NAMES = ["Brand Miller", "Cabatingan", "Berghahn", "Lagerlöf", "Pyper", "Boniface", "Carlile", "Conlin", "Avi"]
+FIRST_NAMES = ["Janette", "Erin", "Volker R. (Volker Rolf)", "Selma", "Andrew", "William", "Clancy", "Joseph R."]
+AUTHOR_SUFFIXES = ["", "", ", 1952-", ", 1858-1940", ", 1938-"]
+CORPORATE_AUTHORS = ["United States. Maritime Commission", "Seattle (Wash.). Office of Planning", "Marvel Comics Group"]
+TITLES = [
+    "The only child : a novel",
+    "The great powers outage",
+    "The Paris pilgrims : a novel",
+    "Big Bill Haywood and the radical union movement [by] Joseph R. Conlin.",
+    "Japanese arms & armor. Introd. by H. Russell Robinson",
+]
+TITLE_CREDITS = ["", " ; illustrations by Stephen Gilpin.", " ; translated by Anthea Bell.", "."]
@@ -53,7 +53,11 @@ def main():
     with conn.cursor() as cursor:
         # Drop tables before recreating them to ensure a clean environment
         cursor.execute(open("sql/delete_tables.sql", "r").read())
-        cursor.execute(open("sql/create_tables.sql", "r").read())
+        # The compact schema stores the keys as integers. See compact_schema in etl.cfg.
+        if config.getboolean("main", "compact_schema", fallback=False):
+            cursor.execute(open("sql/create_tables_compact.sql", "r").read())
+        else:
+            cursor.execute(open("sql/create_tables.sql", "r").read())
 
     conn.commit()
 
@@ -2,11 +2,46 @@
 Loads star schema data in S3 into Redshift.
 """
 import configparser
+import json
+from urllib.parse import urlparse
 
 import boto3
 import psycopg2
 
 
+# Tables that are partitioned by checkout year and month. These tables are loaded with a
+# manifest that lists the parquet files in each partition.
+PARTITIONED_TABLES = [
+    "dim_checkout_time",
+    "fact_spl_book_checkout",
+]
+
+# Tables that only get new rows in incremental mode. Only the new rows are loaded.
+APPEND_TABLES = [
+    "dim_checkout_time",
+    "fact_spl_book_checkout",
+]
+
+# etl_spark.py writes the new rows of each incremental run to a batch directory under the new
+# path of each append table, and writes this marker once all of the tables of the batch have
+# been written. The loaded batches are recorded in the load log table.
+BATCH_COMPLETE_MARKER = "_BATCH_COMPLETE"
+LOAD_LOG_TABLE = "etl_loaded_batch"
+
+# Tables that are rebuilt in incremental mode and the columns used to replace existing rows.
+#
+# The bridge tables replace all rows for a book, so that removed authors and subjects are
+# removed too.
+UPSERT_TABLES = {
+    "dim_book": "bib_num",
+    "dim_author": "id",
+    "dim_subject": "id",
+    "dim_publisher": "id",
+    "br_book_author": "bib_num",
+    "br_book_subject": "bib_num",
+}
+
+
 def main():
     """Entrypoint to drop/create Redshift tables"""
 
@@ -23,6 +58,8 @@ def main():
     db_password = config.get("redshift", "db_password")
     db_port = config.get("redshift", "db_port")
 
+    incremental = config.getboolean("main", "incremental", fallback=False)
+
     redshift = boto3.client(
         "redshift",
         region_name="us-west-2",
@@ -52,6 +89,18 @@ def main():
     # Dynamically retrieve Role ARN so we can access S3 buckets
     role_arn = cluster_props["IamRoles"][0]["IamRoleArn"]
 
+    s3 = boto3.client(
+        "s3",
+        region_name="us-west-2",
+        aws_access_key_id=aws_key,
+        aws_secret_access_key=aws_secret,
+    )
+
+    if incremental:
+        load_new_data(conn, s3, config, role_arn)
+        conn.close()
+        return
+
     # Drop tables before recreating them to ensure a clean environment
     with conn.cursor() as cursor:
         tables = [
@@ -66,22 +115,175 @@ def main():
         ]
         for table in tables:
             print(f"Loading data for {table}...", end=" ")
-            query = """
-            COPY {table}
-            FROM '{s3_path}'
-            IAM_ROLE '{role_arn}'
-            FORMAT AS PARQUET
-            """.format(
-                table=table,
-                s3_path=config.get("output", f"{table}_path"),
-                role_arn=role_arn,
-            )
-            cursor.execute(query)
+            copy_table(cursor, s3, config, table, config.get("output", f"{table}_path"), role_arn)
             print("OK")
             conn.commit()
 
+        # The full tables already have the rows of the incremental batches
+        for batch_id in sorted(list_unloaded_batches(cursor, s3, config)):
+            cursor.execute(f"INSERT INTO {LOAD_LOG_TABLE} (batch_id) VALUES (%s)", (batch_id,))
+        conn.commit()
+
     conn.close()
 
 
+def load_new_data(conn, s3, config, role_arn):
+    """Loads the data exported by the incremental runs of etl_spark.py
+
+    The new checkout times and checkouts of each batch that has not been loaded yet are
+    appended. A batch is appended and recorded in the load log in one transaction, so a failed
+    load can be rerun without appending any rows twice. The other tables are upserted using a
+    staging table in a transaction per table, since they are rebuilt on every run.
+
+    Args:
+        conn: Connection to Redshift
+        s3: S3 client
+        config: ETL config
+        role_arn: Role used to access S3 buckets
+    """
+    with conn.cursor() as cursor:
+        for batch_id in sorted(list_unloaded_batches(cursor, s3, config)):
+            print(f"Appending new data of batch {batch_id}...", end=" ")
+            for table in APPEND_TABLES:
+                copy_table(cursor, s3, config, table, get_batch_path(config, table, batch_id), role_arn)
+            cursor.execute(f"INSERT INTO {LOAD_LOG_TABLE} (batch_id) VALUES (%s)", (batch_id,))
+            conn.commit()
+            print("OK")
+
+        for table, key in UPSERT_TABLES.items():
+            print(f"Upserting data for {table}...", end=" ")
+            cursor.execute(f"CREATE TEMP TABLE {table}_staging (LIKE {table})")
+            copy_table(cursor, s3, config, table, config.get("output", f"{table}_path"), role_arn, f"{table}_staging")
+            cursor.execute(f"DELETE FROM {table} USING {table}_staging WHERE {table}.{key} = {table}_staging.{key}")
+            cursor.execute(f"INSERT INTO {table} SELECT * FROM {table}_staging")
+            cursor.execute(f"DROP TABLE {table}_staging")
+            conn.commit()
+            print("OK")
+
+
+def list_unloaded_batches(cursor, s3, config):
+    """Lists the complete batches of new rows that are not in the load log
+
+    Args:
+        cursor: Redshift cursor
+        s3: S3 client
+        config: ETL config
+
+    Returns:
+        Set of batch IDs
+    """
+    new_paths = [config.get("output", f"{table}_new_path", fallback="") for table in APPEND_TABLES]
+    if not all(new_paths):
+        return set()
+    batch_ids = set.intersection(*[list_complete_batches(s3, new_path) for new_path in new_paths])
+    cursor.execute(f"SELECT batch_id FROM {LOAD_LOG_TABLE}")
+    return batch_ids - {row[0] for row in cursor.fetchall()}
+
+
+def list_complete_batches(s3, s3_path):
+    """Lists the batches under a new path that have the complete marker
+
+    Args:
+        s3: S3 client
+        s3_path: New path of an append table in S3
+
+    Returns:
+        Set of batch IDs
+    """
+    url = urlparse(s3_path)
+    prefix = url.path.strip("/") + "/"
+
+    batch_ids = set()
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=url.netloc, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            batch_id, _, name = obj["Key"][len(prefix):].partition("/")
+            if name == BATCH_COMPLETE_MARKER:
+                batch_ids.add(batch_id)
+    return batch_ids
+
+
+def get_batch_path(config, table, batch_id):
+    """Gets the path to the new rows of a table in a batch"""
+    return "{}/{}".format(config.get("output", f"{table}_new_path").rstrip("/"), batch_id)
+
+
+def copy_table(cursor, s3, config, table, s3_path, role_arn, target_table=None):
+    """Copies parquet data in S3 into a Redshift table
+
+    Partitioned tables are copied with a manifest that lists the parquet files in each
+    partition directory.
+
+    Args:
+        cursor: Redshift cursor
+        s3: S3 client
+        config: ETL config
+        table: Table the data was exported for
+        s3_path: Path to the parquet data in S3
+        role_arn: Role used to access S3 buckets
+        target_table: Optionally, table to copy the data into. Defaults to the table.
+    """
+    manifest_option = ""
+    if table in PARTITIONED_TABLES:
+        manifest_path = "{}/{}.manifest".format(
+            config.get("output", "manifests_path").rstrip("/"),
+            urlparse(s3_path).path.strip("/").replace("/", "_"),
+        )
+        # A batch may have no new rows for a table, e.g. when all of its checkout times already
+        # exist, so there is nothing to copy
+        if not create_manifest(s3, s3_path, manifest_path):
+            return
+        s3_path = manifest_path
+        manifest_option = "MANIFEST"
+
+    query = """
+    COPY {table}
+    FROM '{s3_path}'
+    IAM_ROLE '{role_arn}'
+    FORMAT AS PARQUET
+    {manifest_option}
+    """.format(
+        table=target_table or table,
+        s3_path=s3_path,
+        role_arn=role_arn,
+        manifest_option=manifest_option,
+    )
+    cursor.execute(query)
+
+
+def create_manifest(s3, s3_path, manifest_path):
+    """Creates a Redshift manifest of the parquet files in a partitioned table
+
+    Args:
+        s3: S3 client
+        s3_path: Path to the partitioned table in S3
+        manifest_path: Path to write the manifest to in S3
+
+    Returns:
+        Number of parquet files in the manifest
+    """
+    url = urlparse(s3_path)
+    prefix = url.path.strip("/") + "/"
+
+    entries = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=url.netloc, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            # Skip the _SUCCESS files written by Spark
+            if obj["Key"].endswith(".parquet"):
+                entries.append({
+                    "url": f"s3://{url.netloc}/{obj['Key']}",
+                    "mandatory": True,
+                    # Redshift requires the content length when loading parquet files with a manifest
+                    "meta": {"content_length": obj["Size"]},
+                })
+
+    manifest_url = urlparse(manifest_path)
+    s3.put_object(
+        Bucket=manifest_url.netloc,
+        Key=manifest_url.path.lstrip("/"),
+        Body=json.dumps({"entries": entries}).encode("utf-8"),
+    )
+    return len(entries)
+
+
 if __name__ == "__main__":
     main()
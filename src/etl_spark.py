@@ -1,26 +1,260 @@
 """
 Performs ETL on raw SPL checkout data and create star schema in S3 in parquet format.
 """
+import argparse
 import configparser
+import datetime
+import hashlib
+import math
 import os
 import re
-from typing import Tuple
+from typing import Callable, Dict, List, NamedTuple, Set, Union
 
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 import pyspark.sql.functions as F
-from pyspark.sql.types import IntegerType, FloatType, StringType, StructField, StructType
+from pyspark.sql.column import Column
+from pyspark.sql.types import (
+    BinaryType,
+    BooleanType,
+    ByteType,
+    DateType,
+    DoubleType,
+    FloatType,
+    IntegerType,
+    LongType,
+    ShortType,
+    StringType,
+    StructField,
+    StructType,
+    TimestampType,
+)
 from pyspark.sql.dataframe import DataFrame
 
+from instrumentation import create_run_report, enable_instrumentation, instrument, output_run_report
+from plan_inspector import capture_plan, captured_plans, enable_plan_capture, is_capturing_plans, output_plans
+from scheduler import DEFAULT_MAX_CONCURRENT_STAGES, Stage, check_pinned_threads, run_stages
+from staging import create_marker, list_file_statuses, load_staged_data, path_exists
+from tuning import create_session_builder, tune_session
+
 
 GOODREADS_DATE_FORMAT = "M/d/yyyy"
 SPL_CHECKOUT_DATETIME_FORMAT = "MM/dd/yyyy h:m:s a"
+WEATHER_DATE_FORMAT = "yyyy-M-d"
+
+# The weather data uses -99 for days with a missing temperature
+WEATHER_MISSING_TEMPERATURE = -99.0
+
+# Weather station used for the checkout temperatures. The station ID is the name of the weather
+# data file without the extension.
+DEFAULT_WEATHER_STATION_ID = "WASEATTL"
+
+# Columns in the weather data are separated by a varying amount of whitespace
+WEATHER_DATA_SEP_PATTERN = r"\s+"
+
+# Station ID from the name of the weather data file
+WEATHER_STATION_ID_PATTERN = r"([^/]+?)(\.[^./]*)?$"
+
+# The fact and checkout time tables are partitioned by the year and month of the checkout, so that
+# queries on a time range only need to read the matching files.
+#
+# The partition columns are derived from checkout_datetime, since partition columns are not stored
+# in the parquet files and Redshift needs all the table columns in the files.
+CHECKOUT_PARTITION_COLUMNS = ["checkout_year", "checkout_month"]
+
+# Engines that can be used to run the text cleaning functions
+#
+# - udf: Row at a time Python UDFs
+# - pandas: Vectorized pandas UDFs that process batches of rows with Arrow
+# - native: Spark SQL column expressions that run in the JVM
+CLEANING_ENGINES = ("udf", "pandas", "native")
+DEFAULT_CLEANING_ENGINE = "native"
+
+# ISBN-10s are converted to ISBN-13s so that books can be matched by one ISBN key
+ISBN_10_PATTERN = r"^[0-9]{9}[0-9X]$"
+ISBN_13_PATTERN = r"^[0-9]{13}$"
+ISBN_13_PREFIX = "978"
+
+# Sources of the raw authors. Only SPL authors need to be formatted.
+SPL_AUTHOR_SOURCE = "spl"
+GOODREADS_AUTHOR_SOURCE = "goodreads"
+
+# SPL authors are only swapped to first name, last name if both parts are shorter than this
+SPL_AUTHOR_MAX_NAME_LEN = 36
+
+# Year of birth and/or death suffix on SPL authors (e.g. ", 1858-1940")
+SPL_AUTHOR_YEARS_PATTERN = r", \d{4}-(\d{4})?$"
+
+# Four digit years in the SPL publication year text
+PUBLICATION_YEAR_PATTERN = r"(\d{4})"
+
+# Text in parenthesis at the end of the text that is removed when normalizing text
+NORMALIZE_TEXT_PARENTHESIS_PATTERN = r"(\s*\(.+\)\s*)$"
+
+# Punctuation that is replaced by spaces when normalizing text
+NORMALIZE_TEXT_PUNCTUATION_PATTERN = r"[\[\]<>{}|\\!\"#&()*+,./:;?@_-]"
+
+# Consecutive whitespace that is collapsed into one space when normalizing text
+NORMALIZE_TEXT_EXTRA_SPACES_PATTERN = r"\s{2,}"
+
+# The Python cleaning functions run once per row, so their regexes are only compiled once
+SPL_AUTHOR_YEARS_REGEX = re.compile(SPL_AUTHOR_YEARS_PATTERN)
+PUBLICATION_YEAR_REGEX = re.compile(PUBLICATION_YEAR_PATTERN)
+NORMALIZE_TEXT_PARENTHESIS_REGEX = re.compile(NORMALIZE_TEXT_PARENTHESIS_PATTERN)
+NORMALIZE_TEXT_PUNCTUATION_REGEX = re.compile(NORMALIZE_TEXT_PUNCTUATION_PATTERN)
+NORMALIZE_TEXT_EXTRA_SPACES_REGEX = re.compile(NORMALIZE_TEXT_EXTRA_SPACES_PATTERN)
+
+# Java regexes need some help to match the same whitespace as Python's re module and str.strip().
+#
+# The (?U) flag makes \s match Unicode whitespace, but unlike Python it does not include the
+# \x1c-\x1f separator characters.
+JAVA_WHITESPACE_PATTERN = r"[\s\x1c-\x1f]"
+
+# Dev runs can use a sample of the books. A book is sampled if the hash of its bib number falls in
+# the first sample_fraction of the hash buckets, so the same books are sampled on every run.
+SAMPLE_HASH_BUCKETS = 1000000
+DEFAULT_SAMPLE_SEED = 0
+
+# What to do with checkouts of books that are not in the print book inventory
+#
+# - keep: Keep the checkouts in the fact table
+# - drop: Remove the checkouts before building the checkout tables
+# - reject: Remove the checkouts and write them to a separate rejected checkouts table
+ORPHAN_CHECKOUT_POLICIES = ("keep", "drop", "reject")
+DEFAULT_ORPHAN_CHECKOUT_POLICY = "keep"
+
+# Bib number lookups with more rows than this are joined to the checkouts with a shuffle join
+# instead of being broadcast
+DEFAULT_MAX_BROADCAST_ROWS = 5000000
+
+# Popular books can have far more checkouts than the rest, which overloads the task that joins
+# their bib number in a shuffle join. The hot bib numbers are found from a sample of the checkouts.
+SKEW_SAMPLE_FRACTION = 0.01
+SKEW_SAMPLE_SEED = 0
+# Share of the sampled checkouts a bib number needs to be treated as skewed. Small samples are
+# too noisy, so the bib number also needs a minimum number of sampled checkouts.
+SKEW_MIN_KEY_SHARE = 0.001
+SKEW_MIN_KEY_SAMPLE_COUNT = 10
+# The hot rows of the lookup are broadcast, so the number of skewed keys is capped
+SKEW_MAX_KEYS = 1000
+
+# How the dataframes that are used by several tables are materialized, so that each raw source is
+# only read and processed once per run
+#
+# - memory: Cache in executor memory. Partitions that do not fit are recomputed when needed.
+# - memory_and_disk: Cache in executor memory and spill the partitions that do not fit to local disk
+# - disk: Cache on executor local disk
+# - checkpoint: Local checkpoint on the executors, which also truncates the lineage. The data is
+#   lost if an executor is lost, since it cannot be recomputed.
+# - none: Recompute the dataframes for each table
+PERSIST_STORAGE_LEVELS = {
+    "memory": StorageLevel.MEMORY_ONLY,
+    "memory_and_disk": StorageLevel.MEMORY_AND_DISK,
+    "disk": StorageLevel.DISK_ONLY,
+}
+PERSIST_MODES = tuple(PERSIST_STORAGE_LEVELS) + ("checkpoint", "none")
+DEFAULT_PERSIST_MODE = "memory_and_disk"
+
+# In the compact schema, the bib numbers and item barcodes are stored as integers instead of text,
+# and the fact table ID is a 64-bit hash instead of an md5 hex string.
+#
+# Item barcodes are 13 digits with leading zeros, so they are stored without the zeros and can be
+# padded back with LPAD(item_barcode, 13, '0'). Only keys that match their pattern are converted,
+# so a bib number with a leading zero does not turn into a different bib number, and the integer
+# always fits its type. A run with other keys fails in check_compact_keys, since a null key would
+# cut the checkouts off from their books.
+COMPACT_KEY_TYPES = {
+    "bib_num": IntegerType(),
+    "item_barcode": LongType(),
+}
+COMPACT_KEY_PATTERNS = {
+    "bib_num": r"^[1-9][0-9]{0,8}$",
+    "item_barcode": r"^[0-9]{13}$",
+}
+# Number of distinct values that did not convert that are printed for each column
+MAX_UNCONVERTED_EXAMPLES = 10
+
+# Separates the path, size, and modification time of a file in the list of processed checkout files
+PROCESSED_FILE_SEP = "\t"
+
+# Each incremental run writes its new rows to a batch directory, which is marked with this file
+# once all of its tables have been written. etl_redshift.py only loads complete batches.
+BATCH_COMPLETE_MARKER = "_BATCH_COMPLETE"
+BATCH_ID_LENGTH = 16
+
+# Default size of the parquet files and the row groups within them
+DEFAULT_TARGET_FILE_SIZE_MB = 128
+DEFAULT_ROW_GROUP_SIZE_MB = 32
+
+# The number of files of a table is estimated from Spark's plan statistics. See estimate_table_size.
+# Spark sizes the inputs it cannot measure, such as some checkpoints, with spark.sql.defaultSizeInBytes,
+# which defaults to this.
+UNKNOWN_SIZE_IN_BYTES = 2 ** 63 - 1
+# When the inputs cannot be measured, the size is estimated from the size of the rows in a sample of
+# the table. Text and binary values are measured, and the other values have a fixed size in bytes.
+ROW_SIZE_SAMPLE_ROWS = 10000
+FIXED_VALUE_SIZES = {
+    BooleanType: 1,
+    ByteType: 1,
+    ShortType: 2,
+    IntegerType: 4,
+    FloatType: 4,
+    DateType: 4,
+    LongType: 8,
+    DoubleType: 8,
+    TimestampType: 8,
+}
+DEFAULT_VALUE_SIZE = 8
+
+MB = 1024 * 1024
+
+
+class WriteOptions(NamedTuple):
+    """Options for writing tables in parquet format
+
+    See output_table.
+    """
+    target_file_size: int
+    row_group_size: int
+
+
+class TextCleaners(NamedTuple):
+    """Column functions used to clean up and normalize the SPL inventory text
+
+    See create_text_cleaners.
+    """
+    normalize_text: Callable[[Column], Column]
+    format_spl_author: Callable[[Column], Column]
+    clean_title: Callable[[Column, Column], Column]
+    clean_publication_year: Callable[[Column, Column], Column]
+    clean_publisher: Callable[[Column], Column]
 
 
-def main():
+def main(argv: List[str] = None):
     """ETL script
 
     Processes raw data into star schema for querying SPL checkouts.
 
+    In incremental mode, only the checkout files that have not been processed yet are loaded.
+    The new fact and checkout time rows are written to separate paths so they can be appended
+    in Redshift, and then appended to the existing tables. The other dimensions are small
+    enough to be rebuilt, and since their IDs are generated from their natural keys, the IDs of
+    existing rows stay the same.
+
+    The tables are built by stages that are run concurrently when they do not depend on each
+    other. Stages whose outputs are current are skipped, so a failed run can be retried without
+    rebuilding the tables that were already written. Use --only or --from to rerun stages.
+
+    Use --dry-run to check the physical plans of the tables without writing them. A dry run does
+    not write the tables, staged copies, stage markers, or run report, and does not materialize
+    any dataframes. It still runs the small jobs that the plans depend on: reading the data
+    dictionary and the processed checkout files, checking the weather station, counting the
+    lookups and sampling the skewed bib numbers to pick the join strategies, and, in an
+    incremental run, finding the time range of the new checkouts.
+
+    Args:
+        argv: Command line arguments. Defaults to the arguments of the script.
+
     Data sources:
       - SPL checkouts data
       - Goodreads data
@@ -39,74 +273,376 @@ def main():
         - dim_book
         - checkout_datetime
     """
+    parser = argparse.ArgumentParser(description="Process the raw data into the star schema tables")
+    parser.add_argument("--config", default="etl.cfg", help="Path to the ETL config file")
+    stage_group = parser.add_mutually_exclusive_group()
+    stage_group.add_argument("--only", dest="only_stage", help="Only run this stage, even if its outputs are current")
+    stage_group.add_argument(
+        "--from",
+        dest="from_stage",
+        help="Run this stage and the stages that depend on it, even if their outputs are current",
+    )
+    parser.add_argument(
+        "--dry-run",
+        metavar="PLANS_PATH",
+        help="Build every table without writing it, and write the physical plans of the tables to this local directory",
+    )
+    args = parser.parse_args(argv)
+
     config = configparser.ConfigParser()
-    config.read("etl.cfg")
+    # Spark setting names in the [spark] section are case sensitive
+    config.optionxform = str
+    config.read(args.config)
+
+    # The threads of the concurrent stages have to be pinned before the session is created
+    max_concurrent_stages = config.getint("main", "max_concurrent_stages", fallback=DEFAULT_MAX_CONCURRENT_STAGES)
+    check_pinned_threads(max_concurrent_stages)
 
     # Store AWS access key and secret as environment variables so we can access private S3 buckets
     os.environ["AWS_ACCESS_KEY_ID"] = config.get("aws", "key")
     os.environ["AWS_SECRET_ACCESS_KEY"] = config.get("aws", "secret")
 
-    spark = SparkSession.builder.appName("SPL-Checkouts").getOrCreate()
+    # The FAIR scheduler shares the executors between the stages that are run concurrently
+    spark_overrides = dict(config.items("spark")) if config.has_section("spark") else {}
+    spark = create_session_builder("SPL-Checkouts", {"spark.scheduler.mode": "FAIR", **spark_overrides}).getOrCreate()
+    enable_instrumentation(spark)
+    if args.dry_run:
+        enable_plan_capture()
+    run_status = "failed"
+    tuned_settings = {}
 
     try:
-        limit_records = config.getint("main", "limit_records")
-        num_write_partitions = config.getint("main", "num_write_partitions")
-
-        data_dict_df = spark.read.option("header", "true").csv(config.get("spl", "data_dict_path"))
-        inventory_df = load_inventory_data(spark, data_dict_df, config.get("spl", "inventory_path"), limit_records)
-        goodreads_df = load_goodreads_data(spark, config.get("goodreads", "data_path"))
-        books_df = link_goodreads_data(inventory_df, goodreads_df)
-
-        # Dimension tables
-        create_dim_subjects(
-            books_df,
-            config.get("output", "dim_subject_path"),
-            config.get("output", "br_book_subject_path"),
-            num_write_partitions,
-        )
-
-        create_dim_authors(
-            books_df,
-            config.get("output", "dim_author_path"),
-            config.get("output", "br_book_author_path"),
-            num_write_partitions,
-        )
-
-        publishers_map_df = load_publishers_data(spark, config.get("publishers", "data_path"))
-        bib_num_publisher_lookup_df, publishers_df = create_dim_publishers(
-            books_df,
-            publishers_map_df,
-            config.get("output", "dim_publisher_path"),
-            num_write_partitions,
-        )
-
-        create_dim_books(
-            books_df,
-            config.get("output", "dim_book_path"),
-            num_write_partitions,
-        )
-
-        checkouts_df = load_checkouts_data(spark, data_dict_df, config.get("spl", "checkouts_path"), limit_records)
-        create_dim_checkout_datetimes(
-            checkouts_df,
-            config.get("output", "dim_checkout_time_path"),
-            num_write_partitions,
+        if config.getint("main", "limit_records", fallback=0):
+            raise ValueError("limit_records was replaced by sample_fraction")
+        sample_fraction = config.getfloat("main", "sample_fraction", fallback=0.0)
+        if not 0 <= sample_fraction <= 1:
+            raise ValueError(f"Invalid sample fraction: {sample_fraction}. Expected a number from 0 to 1.")
+        sample_seed = config.getint("main", "sample_seed", fallback=DEFAULT_SAMPLE_SEED)
+        cleaners = create_text_cleaners(config.get("main", "cleaning_engine", fallback=DEFAULT_CLEANING_ENGINE))
+        incremental = config.getboolean("main", "incremental", fallback=False)
+        staging_path = config.get("main", "staging_path", fallback="")
+        orphan_checkout_policy = config.get("main", "orphan_checkouts", fallback=DEFAULT_ORPHAN_CHECKOUT_POLICY)
+        if orphan_checkout_policy not in ORPHAN_CHECKOUT_POLICIES:
+            raise ValueError(
+                f"Unknown orphan checkouts policy: {orphan_checkout_policy}. "
+                f"Expected one of: {', '.join(ORPHAN_CHECKOUT_POLICIES)}"
+            )
+        max_broadcast_rows = config.getint("main", "max_broadcast_rows", fallback=DEFAULT_MAX_BROADCAST_ROWS)
+        persist_mode = config.get("main", "persist_mode", fallback=DEFAULT_PERSIST_MODE)
+        if persist_mode not in PERSIST_MODES:
+            raise ValueError(f"Unknown persist mode: {persist_mode}. Expected one of: {', '.join(PERSIST_MODES)}")
+        compact_schema = config.getboolean("main", "compact_schema", fallback=False)
+
+        bib_num_publisher_path = config.get("output", "bib_num_publisher_path", fallback="")
+        rejected_checkouts_path = config.get("output", "rejected_checkouts_path", fallback="")
+        # Full runs only record the processed files if the path is set, so that a later incremental run can
+        # continue from them
+        processed_checkouts_path = config.get("output", "processed_checkouts_path", fallback="")
+        if incremental and not processed_checkouts_path:
+            raise ValueError("Incremental runs need processed_checkouts_path in the output section")
+
+        dim_checkout_time_path = config.get("output", "dim_checkout_time_path")
+        fact_path = config.get("output", "fact_spl_book_checkout_path")
+
+        checkouts_file_versions = list_file_versions(spark, config.get("spl", "checkouts_path"))
+        changed_checkouts_files = []
+        if incremental:
+            processed_files = load_processed_files(spark, processed_checkouts_path)
+            checkouts_file_versions = {
+                path: version
+                for path, version in checkouts_file_versions.items()
+                if not is_processed(processed_files, path, version)
+            }
+            # Files that grew or were replaced since they were processed, e.g. the file of the current year
+            changed_checkouts_files = [path for path in checkouts_file_versions if path in processed_files]
+            if changed_checkouts_files:
+                print(f"Checkout files that changed since they were processed: {', '.join(changed_checkouts_files)}")
+            if not checkouts_file_versions:
+                # The batches of the previous runs are kept until etl_redshift.py has loaded them
+                print("No new checkout files to process.")
+                run_status = "succeeded"
+                return
+        checkouts_files = list(checkouts_file_versions)
+
+        # In incremental mode, the new checkout time and fact rows are written to a batch of their
+        # own and then appended to the existing tables
+        if incremental:
+            batch_id = create_batch_id(checkouts_file_versions)
+            print(f"Writing the new rows to batch {batch_id}")
+            dim_checkout_time_output_path = "{}/{}".format(
+                config.get("output", "dim_checkout_time_new_path").rstrip("/"),
+                batch_id,
+            )
+            fact_output_path = "{}/{}".format(config.get("output", "fact_spl_book_checkout_new_path").rstrip("/"), batch_id)
+        else:
+            dim_checkout_time_output_path = dim_checkout_time_path
+            fact_output_path = fact_path
+
+        target_file_size_mb = config.getint("main", "target_file_size_mb", fallback=0)
+        target_file_size = (target_file_size_mb or DEFAULT_TARGET_FILE_SIZE_MB) * MB
+        if config.getboolean("main", "adaptive_tuning", fallback=True):
+            input_paths = checkouts_files + [
+                config.get(section, key)
+                for section, key in [
+                    ("spl", "data_dict_path"),
+                    ("spl", "inventory_path"),
+                    ("goodreads", "data_path"),
+                    ("weather", "data_path"),
+                    ("publishers", "data_path"),
+                ]
+            ]
+            # A target file size set in etl.cfg is used as is
+            tuning_overrides = dict(spark_overrides)
+            if target_file_size_mb:
+                tuning_overrides["target_file_size"] = str(target_file_size)
+            tuned_settings = tune_session(spark, input_paths, tuning_overrides, target_file_size)
+        write_options = WriteOptions(
+            target_file_size=int(tuned_settings.get("target_file_size", target_file_size)),
+            row_group_size=config.getint("main", "row_group_size_mb", fallback=DEFAULT_ROW_GROUP_SIZE_MB) * MB,
         )
 
-        # Fact table
-        weather_df = load_weather_data(spark, config.get("weather", "data_path"))
-        create_fact_spl_book_checkouts(
-            checkouts_df,
-            weather_df,
-            bib_num_publisher_lookup_df,
-            publishers_df,
-            config.get("output", "fact_spl_book_checkout_path"),
-            num_write_partitions,
+        data_dict_df = load_data_dict(spark, config.get("spl", "data_dict_path"), staging_path)
+        print_book_item_types = find_print_book_item_types(data_dict_df)
+
+        @instrument
+        def run_books_stage(results):
+            inventory_df = load_inventory_data(
+                spark,
+                print_book_item_types,
+                config.get("spl", "inventory_path"),
+                sample_fraction,
+                sample_seed,
+                staging_path,
+            )
+            goodreads_df = load_goodreads_data(spark, config.get("goodreads", "data_path"), staging_path)
+
+            # The inventory is read twice when linking the Goodreads data, and the books are used by
+            # all of the dimensions and to filter the checkouts
+            inventory_df = materialize(inventory_df, persist_mode)
+            books_df = materialize(link_goodreads_data(inventory_df, goodreads_df), persist_mode)
+            inventory_df.unpersist()
+            # The bib numbers are checked before any of the tables are written
+            if compact_schema:
+                check_compact_keys(books_df.select(books_df.bib_num), "dim_book")
+            return books_df
+
+        @instrument
+        def run_dim_subject_stage(results):
+            create_dim_subjects(
+                results["books"],
+                config.get("output", "dim_subject_path"),
+                config.get("output", "br_book_subject_path"),
+                write_options,
+                compact_schema,
+            )
+
+        @instrument
+        def run_dim_author_stage(results):
+            create_dim_authors(
+                results["books"],
+                config.get("output", "dim_author_path"),
+                config.get("output", "br_book_author_path"),
+                write_options,
+                cleaners,
+                persist_mode,
+                compact_schema,
+            )
+
+        @instrument
+        def run_dim_publisher_stage(results):
+            publishers_map_df = load_publishers_data(spark, config.get("publishers", "data_path"))
+            return create_dim_publishers(
+                results["books"],
+                publishers_map_df,
+                config.get("output", "dim_publisher_path"),
+                write_options,
+                cleaners,
+                bib_num_publisher_path,
+                persist_mode,
+            )
+
+        @instrument
+        def run_dim_book_stage(results):
+            create_dim_books(
+                results["books"],
+                config.get("output", "dim_book_path"),
+                write_options,
+                cleaners,
+                compact_schema,
+            )
+
+        @instrument
+        def run_checkouts_stage(results):
+            # The checkouts are read twice when the orphan checkouts are rejected, and they are used
+            # by the checkout time and fact tables when the orphan checkouts are kept
+            checkouts_df = materialize(
+                load_checkouts_data(
+                    spark,
+                    print_book_item_types,
+                    checkouts_files,
+                    sample_fraction,
+                    sample_seed,
+                    staging_path,
+                ),
+                persist_mode,
+            )
+            if 0 < sample_fraction < 1:
+                print_checkouts_by_year(checkouts_df)
+            filtered_checkouts_df = filter_orphan_checkouts(
+                checkouts_df,
+                results["books"],
+                orphan_checkout_policy,
+                rejected_checkouts_path,
+                write_options,
+                max_broadcast_rows,
+            )
+            if filtered_checkouts_df is not checkouts_df:
+                # The orphan checkouts are only filtered once for the checkout time and fact tables
+                filtered_checkouts_df = materialize(filtered_checkouts_df, persist_mode)
+                checkouts_df.unpersist()
+            if compact_schema:
+                check_compact_keys(filtered_checkouts_df, "fact_spl_book_checkout")
+            return filtered_checkouts_df
+
+        @instrument
+        def run_dim_checkout_time_stage(results):
+            existing_checkout_times_df = None
+            if incremental:
+                existing_checkout_times_df = load_existing_parquet(spark, dim_checkout_time_path)
+            create_dim_checkout_datetimes(
+                results["checkouts"],
+                dim_checkout_time_output_path,
+                write_options,
+                existing_checkout_times_df,
+            )
+            if incremental:
+                append_parquet(spark, dim_checkout_time_output_path, dim_checkout_time_path, CHECKOUT_PARTITION_COLUMNS)
+
+        @instrument
+        def run_fact_stage(results):
+            weather_df = filter_weather_station(
+                load_weather_data(spark, config.get("weather", "data_path"), staging_path),
+                config.get("weather", "station_id", fallback=DEFAULT_WEATHER_STATION_ID),
+            )
+            # The checkouts of the changed files that were appended before are not appended again
+            existing_checkouts_df = None
+            if changed_checkouts_files:
+                existing_checkouts_df = load_existing_parquet(spark, fact_path)
+            create_fact_spl_book_checkouts(
+                results["checkouts"],
+                weather_df,
+                results["dim_publisher"],
+                fact_output_path,
+                write_options,
+                max_broadcast_rows,
+                compact_schema,
+                existing_checkouts_df,
+            )
+            if incremental:
+                append_parquet(spark, fact_output_path, fact_path, CHECKOUT_PARTITION_COLUMNS)
+
+        @instrument
+        def run_processed_checkouts_stage(results):
+            # The batch is marked complete before the files are recorded, so that a batch of
+            # processed files is never left without its marker
+            if incremental:
+                mark_batch_complete(spark, [dim_checkout_time_output_path, fact_output_path])
+            output_processed_files(spark, checkouts_file_versions, processed_checkouts_path, append=incremental)
+
+        # The publisher map only needs to be recomputed for the fact table if it was not exported
+        def load_bib_num_publisher_ids():
+            return spark.read.parquet(bib_num_publisher_path)
+
+        book_inputs = [
+            config.get("spl", "data_dict_path"),
+            config.get("spl", "inventory_path"),
+            config.get("goodreads", "data_path"),
+        ]
+
+        def unpersist(df):
+            df.unpersist()
+
+        stages = [
+            Stage("books", run_books_stage, inputs=book_inputs, release=unpersist),
+            Stage(
+                "dim_subject",
+                run_dim_subject_stage,
+                ["books"],
+                outputs=[config.get("output", "dim_subject_path"), config.get("output", "br_book_subject_path")],
+            ),
+            Stage(
+                "dim_author",
+                run_dim_author_stage,
+                ["books"],
+                outputs=[config.get("output", "dim_author_path"), config.get("output", "br_book_author_path")],
+            ),
+            Stage(
+                "dim_publisher",
+                run_dim_publisher_stage,
+                ["books"],
+                inputs=[config.get("publishers", "data_path")],
+                outputs=[path for path in [config.get("output", "dim_publisher_path"), bib_num_publisher_path] if path],
+                returns_result=True,
+                load=load_bib_num_publisher_ids if bib_num_publisher_path else None,
+                release=unpersist,
+            ),
+            Stage("dim_book", run_dim_book_stage, ["books"], outputs=[config.get("output", "dim_book_path")]),
+            Stage(
+                "checkouts",
+                run_checkouts_stage,
+                ["books"],
+                inputs=checkouts_files,
+                outputs=[rejected_checkouts_path] if orphan_checkout_policy == "reject" else [],
+                release=unpersist,
+            ),
+            Stage("dim_checkout_time", run_dim_checkout_time_stage, ["checkouts"], outputs=[dim_checkout_time_path]),
+            # The fact table needs the bib number to publisher ID map
+            Stage(
+                "fact",
+                run_fact_stage,
+                ["checkouts", "dim_publisher"],
+                inputs=[config.get("weather", "data_path")],
+                outputs=[fact_path],
+            ),
+        ]
+        if processed_checkouts_path:
+            # Only record the checkout files once all of the tables have been written, so that
+            # a failed run will process the same files again
+            stages.append(Stage(
+                "processed_checkouts",
+                run_processed_checkouts_stage,
+                ["dim_checkout_time", "fact"],
+                outputs=[processed_checkouts_path],
+            ))
+
+        # Independent stages are run concurrently, and stages whose outputs are current are
+        # skipped. The shared dataframes are unpersisted once the stages that use them have
+        # finished. See scheduler.py.
+        run_stages(
+            spark,
+            stages,
+            max_concurrent_stages,
+            # A dry run does not write any outputs, so every stage is run
+            "" if args.dry_run else config.get("output", "stage_markers_path", fallback=""),
+            # The number of concurrent stages does not change the outputs
+            {key: value for key, value in config.items("main") if key != "max_concurrent_stages"},
+            args.only_stage,
+            args.from_stage,
         )
+        if args.dry_run:
+            output_plans(captured_plans(), args.dry_run)
+        run_status = "succeeded"
     finally:
+        # The report is also written for failed runs, to see how far they got. A dry run does
+        # not write any outputs, and its timings are not comparable with the other runs.
+        run_reports_path = "" if args.dry_run else config.get("output", "run_reports_path", fallback="")
+        if run_reports_path:
+            report = create_run_report(spark, run_status, {**dict(config.items("main")), **tuned_settings})
+            print(f"Wrote run report to {output_run_report(spark, report, run_reports_path)}")
         spark.stop()
 
 
+@instrument
 def load_publishers_data(spark: SparkSession, data_path: str) -> DataFrame:
     """Loads publishers map data into spark dataframe
 
@@ -130,43 +666,172 @@ def load_publishers_data(spark: SparkSession, data_path: str) -> DataFrame:
     )
 
 
-def load_weather_data(spark: SparkSession, data_path: str) -> DataFrame:
+@instrument
+def load_data_dict(spark: SparkSession, data_path: str, staging_path: str = None) -> DataFrame:
+    """Loads SPL data dictionary into spark dataframe
+
+    Args:
+        spark: Spark session
+        data_path: Path to SPL data dictionary
+        staging_path: Optionally, path to store the staged copy of the CSV data
+
+    Returns:
+        - SPL data dictionary
+        - Columns: code, code_type, format_group, format_subgroup
+    """
+    return load_staged_data(spark, "data_dict", data_path, parse_data_dict_csv, staging_path)
+
+
+def parse_data_dict_csv(spark: SparkSession, data_path: str) -> DataFrame:
+    """Parses SPL data dictionary CSV data
+
+    Args:
+        spark: Spark session
+        data_path: Path to SPL data dictionary
+
+    Returns:
+        SPL data dictionary with the columns needed to filter print books
+    """
+    df = spark.read.option("header", "true").csv(data_path)
+    return df.select(
+        df.Code.alias("code"),
+        df["Code Type"].alias("code_type"),
+        df["Format Group"].alias("format_group"),
+        df["Format Subgroup"].alias("format_subgroup"),
+    )
+
+
+def find_print_book_item_types(data_dict_df: DataFrame) -> List[str]:
+    """Finds the ItemType codes of print books
+
+    The data dictionary is tiny, so the codes are collected once and shared by the loaders.
+    Filtering on a list of codes can be pushed down to the file scan, which is cheaper than
+    joining the data dictionary with every row.
+
+    Args:
+        data_dict_df: SPL data dictionary
+
+    Returns:
+        Sorted list of ItemType codes
+    """
+    rows = (
+        data_dict_df
+        .filter(data_dict_df.code_type == "ItemType")
+        .filter(data_dict_df.format_group == "Print")
+        .filter(data_dict_df.format_subgroup == "Book")
+        .select(data_dict_df.code)
+        .distinct()
+        .collect()
+    )
+    return sorted(row.code for row in rows)
+
+
+def filter_print_books(df: DataFrame, print_book_item_types: List[str]) -> DataFrame:
+    """Filters SPL data to print books
+
+    Args:
+        df: SPL data with an item_type column
+        print_book_item_types: ItemType codes of print books
+
+    Returns:
+        Print books
+    """
+    return df.filter(df.item_type.isin(print_book_item_types))
+
+
+@instrument
+def load_weather_data(spark: SparkSession, data_path: str, staging_path: str = None) -> DataFrame:
     """Loads weather data into spark dataframe
 
+    Args:
+        spark: Spark session
+        weather_path: Path to weather data. Can include wildcards to load multiple stations.
+        staging_path: Optionally, path to store the staged copies of the weather data
+
+    Returns:
+        - Weather data
+        - Columns:
+          - station_id
+          - date
+          - temperature: Average temperature or null if the temperature is missing
+    """
+    df = load_staged_data(spark, "weather", data_path, parse_weather_data, staging_path)
+    return df.select(
+        df.station_id,
+        df.date,
+        F.when(df.temperature != WEATHER_MISSING_TEMPERATURE, df.temperature).alias("temperature"),
+    )
+
+
+def filter_weather_station(weather_df: DataFrame, station_id: str) -> DataFrame:
+    """Filters weather data to a single station
+
+    Args:
+        weather_df: Weather data
+        station_id: Station used for the checkout temperatures
+
+    Raises:
+        ValueError: If there is no data for the station. Otherwise every checkout temperature would be null.
+
+    Returns:
+        Weather data of the station
+    """
+    station_weather_df = weather_df.filter(weather_df.station_id == station_id)
+    if not station_weather_df.take(1):
+        station_ids = sorted(row.station_id for row in weather_df.select("station_id").distinct().collect())
+        raise ValueError(
+            f"No weather data for station: {station_id}. Found stations: {', '.join(station_ids) or 'none'}"
+        )
+    return station_weather_df
+
+
+def parse_weather_data(spark: SparkSession, data_path: str) -> DataFrame:
+    """Parses weather text data
+
+    Each line has the month, day, year, and average temperature separated by whitespace. The
+    lines are split with column expressions, so the data does not need to go through Python.
+
     Args:
         spark: Spark session
         weather_path: Path to weather data
 
     Returns:
-        Weather data
+        - Weather data
+        - Columns: station_id, date, temperature
     """
-    # The weather data delimits columns by spaces, but there can be a different
-    # amount of spaces between each column.
-    #
-    # Amazon EMR is not on Spark 3, so multi-character delimiters aren't supported
-    # WEATHER_DATA_SEP = "         "
-    # df = spark.read.option("sep", WEATHER_DATA_SEP).csv(data_path)
-    # return df.select(
-    #    F.trim(df._c0).cast(IntegerType()).alias("month"),
-    #    F.trim(df._c1).cast(IntegerType()).alias("day"),
-    #    F.trim(df._c2).cast(IntegerType()).alias("year"),
-    #    F.trim(df._c3).cast(FloatType()).alias("temperature"),
-    # )
-
-    # Spark 2 compatible approach
-    lines = spark.sparkContext.textFile(data_path)
-    df = lines.map(lambda l: l.split()).toDF()
+    lines_df = spark.read.text(data_path)
+    df = lines_df.select(
+        F.regexp_extract(F.input_file_name(), WEATHER_STATION_ID_PATTERN, 1).alias("station_id"),
+        F.split(F.trim(lines_df.value), WEATHER_DATA_SEP_PATTERN).alias("parts"),
+    )
     return df.select(
-        F.trim(df._1).cast(IntegerType()).alias("month"),
-        F.trim(df._2).cast(IntegerType()).alias("day"),
-        F.trim(df._3).cast(IntegerType()).alias("year"),
-        F.trim(df._4).cast(FloatType()).alias("temperature"),
+        df.station_id,
+        F.to_date(
+            F.concat_ws("-", df.parts.getItem(2), df.parts.getItem(0), df.parts.getItem(1)),
+            WEATHER_DATE_FORMAT,
+        ).alias("date"),
+        df.parts.getItem(3).cast(FloatType()).alias("temperature"),
     )
 
 
-def load_goodreads_data(spark: SparkSession, data_path: str) -> DataFrame:
+@instrument
+def load_goodreads_data(spark: SparkSession, data_path: str, staging_path: str = None) -> DataFrame:
     """Loads Goodreads CSV data into a spark dataframe
 
+    Args:
+        spark: Spark session
+        data_path: Path to Goodreads data
+        staging_path: Optionally, path to store the staged copy of the CSV data
+
+    Returns:
+        Goodreads dataframe
+    """
+    return load_staged_data(spark, "goodreads", data_path, parse_goodreads_csv, staging_path)
+
+
+def parse_goodreads_csv(spark: SparkSession, data_path: str) -> DataFrame:
+    """Parses Goodreads CSV data
+
     Args:
         spark: Spark session
         data_path: Path to Goodreads data
@@ -201,19 +866,24 @@ def load_goodreads_data(spark: SparkSession, data_path: str) -> DataFrame:
     )
 
 
+@instrument
 def load_inventory_data(
     spark: SparkSession,
-    data_dict_df: DataFrame,
+    print_book_item_types: List[str],
     data_path: str,
-    limit_records: int = 0,
+    sample_fraction: float = 0.0,
+    sample_seed: int = DEFAULT_SAMPLE_SEED,
+    staging_path: str = None,
 ) -> DataFrame:
     """Loads SPL inventory filtered to print books into spark dataframe
 
     Args:
         spark: Spark session
-        data_dict_df: Used for filtering on print books
+        print_book_item_types: Used for filtering on print books
         data_path: Path to SPL inventory data
-        limit_records: Work with a subset of records. Use 0 for all records.
+        sample_fraction: Only load the books in this sample of the bib numbers. See sample_bib_nums.
+        sample_seed: Different seeds sample different books
+        staging_path: Optionally, path to store the staged copy of the CSV data
 
     Returns:
         - SPL inventory filtered by print books
@@ -226,17 +896,14 @@ def load_inventory_data(
           - raw_publisher
           - raw_subjects
     """
-    df = spark.read.option("header", "true").csv(data_path)
-
-    if limit_records:
-        df = df.limit(limit_records)
+    df = sample_bib_nums(
+        load_staged_data(spark, "inventory", data_path, parse_inventory_csv, staging_path),
+        sample_fraction,
+        sample_seed,
+    )
 
     return (
-        df
-        .join(data_dict_df, data_dict_df.Code == df.ItemType)
-        .filter(data_dict_df["Code Type"] == "ItemType")
-        .filter(data_dict_df["Format Group"] == "Print")
-        .filter(data_dict_df["Format Subgroup"] == "Book")
+        filter_print_books(df, print_book_item_types)
         # Multiple bib numbers can appear due to variations in ItemType, ItemCollection, and especially
         # ItemLocation.
         #
@@ -245,57 +912,145 @@ def load_inventory_data(
         #
         # Instead we'll drop the duplicates, since we don't care about the location of the item. We only
         # care that it's the same book
-        .drop_duplicates(["BibNum"])
+        .drop_duplicates(["bib_num"])
         .select(
-            df.BibNum.alias("bib_num"),
-            df.ISBN.alias("isbns"),
-            df.Title.alias("raw_title"),
-            df.Author.alias("raw_author"),
-            df.PublicationYear.alias("raw_publication_year"),
-            df.Publisher.alias("raw_publisher"),
-            df.Subjects.alias("raw_subjects"),
+            df.bib_num,
+            df.isbns,
+            df.raw_title,
+            df.raw_author,
+            df.raw_publication_year,
+            df.raw_publisher,
+            df.raw_subjects,
         )
     )
 
 
+def parse_inventory_csv(spark: SparkSession, data_path: str) -> DataFrame:
+    """Parses SPL inventory CSV data
+
+    Args:
+        spark: Spark session
+        data_path: Path to SPL inventory data
+
+    Returns:
+        - SPL inventory
+        - Columns: bib_num, isbns, raw_title, raw_author, raw_publication_year, raw_publisher,
+          raw_subjects, item_type
+    """
+    df = spark.read.option("header", "true").csv(data_path)
+    return df.select(
+        df.BibNum.alias("bib_num"),
+        df.ISBN.alias("isbns"),
+        df.Title.alias("raw_title"),
+        df.Author.alias("raw_author"),
+        df.PublicationYear.alias("raw_publication_year"),
+        df.Publisher.alias("raw_publisher"),
+        df.Subjects.alias("raw_subjects"),
+        df.ItemType.alias("item_type"),
+    )
+
+
+@instrument
 def load_checkouts_data(
     spark: SparkSession,
-    data_dict_df: DataFrame,
-    data_path: str,
-    limit_records: int = 0,
+    print_book_item_types: List[str],
+    data_path: Union[str, List[str]],
+    sample_fraction: float = 0.0,
+    sample_seed: int = DEFAULT_SAMPLE_SEED,
+    staging_path: str = None,
 ) -> DataFrame:
     """Loads SPL checkouts filtered to print books into spark dataframe
 
     Args:
         spark: Spark session
-        data_dict_df: Used for filtering on print books
-        data_path: Path to SPL checkouts data
-        limit_records: Work with a subset of records. Use 0 for all records.
+        print_book_item_types: Used for filtering on print books
+        data_path: Path or list of paths to SPL checkouts data
+        sample_fraction: Only load the checkouts of this sample of the bib numbers. See sample_bib_nums.
+        sample_seed: Different seeds sample different books
+        staging_path: Optionally, path to store the staged copies of the CSV data
 
     Returns:
         - SPL checkouts filtered by print books
         - Columns: bib_num, item_barcode, checkout_datetime
     """
-    df = spark.read.option("header", "true").csv(data_path)
+    df = sample_bib_nums(
+        load_staged_data(spark, "checkouts", data_path, parse_checkouts_csv, staging_path),
+        sample_fraction,
+        sample_seed,
+    )
 
-    if limit_records:
-        df = df.limit(limit_records)
+    return filter_print_books(df, print_book_item_types).select(
+        df.bib_num,
+        df.item_barcode,
+        df.checkout_datetime,
+    )
 
-    return (
-        df
-        .join(data_dict_df, data_dict_df.Code == df.ItemType)
-        .filter(data_dict_df["Code Type"] == "ItemType")
-        .filter(data_dict_df["Format Group"] == "Print")
-        .filter(data_dict_df["Format Subgroup"] == "Book")
-        .select(
-            df.BibNumber.alias("bib_num"),
-            df.ItemBarcode.alias("item_barcode"),
-            # Convert checkout date time string into a timestamp
-            F.to_timestamp(df.CheckoutDateTime, SPL_CHECKOUT_DATETIME_FORMAT).alias("checkout_datetime"),
-        )
+
+def sample_bib_nums(df: DataFrame, sample_fraction: float, sample_seed: int = DEFAULT_SAMPLE_SEED) -> DataFrame:
+    """Keeps the rows of a deterministic sample of the bib numbers
+
+    The inventory and checkouts are sampled by the same bib numbers, so all of the inventory and
+    checkout rows of the sampled books are kept and the sampled checkouts join to the sampled
+    inventory as often as the full data does. The books are picked by their bib number alone, so
+    each year of checkouts keeps its share of the checkouts, instead of the sample coming from
+    the first checkout files.
+
+    Args:
+        df: Dataframe with a bib_num column
+        sample_fraction: Share of the bib numbers to keep. Use 0 or 1 for all rows.
+        sample_seed: Different seeds sample different books
+
+    Returns:
+        Rows of the sampled bib numbers
+    """
+    if not 0 < sample_fraction < 1:
+        return df
+
+    bib_num_hash = F.xxhash64(F.lit(sample_seed), df.bib_num.cast(StringType()))
+    # The hash can be negative, so the modulo is shifted to get a bucket from 0 to SAMPLE_HASH_BUCKETS - 1
+    bucket = (bib_num_hash % SAMPLE_HASH_BUCKETS + SAMPLE_HASH_BUCKETS) % SAMPLE_HASH_BUCKETS
+    return df.filter(bucket < int(sample_fraction * SAMPLE_HASH_BUCKETS))
+
+
+@instrument
+def print_checkouts_by_year(checkouts_df: DataFrame):
+    """Prints the number of sampled checkouts in each year, to check that every year is sampled
+
+    Args:
+        checkouts_df: Materialized checkouts
+    """
+    rows = (
+        checkouts_df
+        .groupBy(F.year(checkouts_df.checkout_datetime).alias("checkout_year"))
+        .count()
+        .orderBy("checkout_year")
+        .collect()
+    )
+    print("Sampled checkouts by year: " + ", ".join(f"{row.checkout_year}: {row['count']}" for row in rows))
+
+
+def parse_checkouts_csv(spark: SparkSession, data_path: str) -> DataFrame:
+    """Parses SPL checkouts CSV data
+
+    Args:
+        spark: Spark session
+        data_path: Path to SPL checkouts data
+
+    Returns:
+        - SPL checkouts
+        - Columns: bib_num, item_type, item_barcode, checkout_datetime
+    """
+    df = spark.read.option("header", "true").csv(data_path)
+    return df.select(
+        df.BibNumber.alias("bib_num"),
+        df.ItemType.alias("item_type"),
+        df.ItemBarcode.alias("item_barcode"),
+        # Convert checkout date time string into a timestamp
+        F.to_timestamp(df.CheckoutDateTime, SPL_CHECKOUT_DATETIME_FORMAT).alias("checkout_datetime"),
     )
 
 
+@instrument
 def link_goodreads_data(inventory_df: DataFrame, goodreads_df: DataFrame) -> DataFrame:
     """Links goodreads data with SPL books inventory
 
@@ -330,10 +1085,21 @@ def link_goodreads_data(inventory_df: DataFrame, goodreads_df: DataFrame) -> Dat
         F.explode(F.split(inventory_df.isbns, ", ")).alias("spl_isbn"),
         inventory_df.bib_num.alias("spl_bib_num"),
     )
+    book_isbn_df = (
+        book_isbn_df
+        .select(
+            book_isbn_df.spl_bib_num,
+            normalize_isbn_expr(book_isbn_df.spl_isbn).alias("isbn_key"),
+        )
+        .dropna(subset=["isbn_key"])
+    )
 
+    # The Goodreads data is small enough to be broadcast, so the ISBNs can be matched
+    # without shuffling the inventory
+    goodreads_isbn_index_df = generate_goodreads_isbn_index(goodreads_df)
     with_goodreads_df = (
         book_isbn_df
-        .join(goodreads_df, (goodreads_df.isbn == book_isbn_df.spl_isbn) | (goodreads_df.isbn13 == book_isbn_df.spl_isbn))
+        .join(F.broadcast(goodreads_isbn_index_df), goodreads_isbn_index_df.isbn_key == book_isbn_df.isbn_key)
         # If there are multiple editions, we're going to take one matching Goodreads book
         .drop_duplicates(["spl_bib_num"])
     )
@@ -353,38 +1119,197 @@ def link_goodreads_data(inventory_df: DataFrame, goodreads_df: DataFrame) -> Dat
     )
 
 
+@instrument
+def generate_goodreads_isbn_index(goodreads_df: DataFrame) -> DataFrame:
+    """Generates an index of Goodreads books by normalized ISBN
+
+    A Goodreads book has an ISBN and ISBN13 column. Matching against either column would
+    require an OR join condition, which Spark can only run as a nested loop join. Instead we
+    unpivot both columns into one ISBN-13 key so the books can be matched with an equi-join.
+
+    Args:
+        goodreads_df: Goodreads data
+
+    Returns:
+        - Goodreads books by ISBN-13. Each ISBN-13 maps to one Goodreads book.
+        - Columns:
+          - isbn_key: ISBN-13
+          - title
+          - authors
+          - publication_date
+          - average_rating
+          - ratings_count
+          - text_reviews_count
+    """
+    goodreads_isbns_df = goodreads_df.select(
+        F.explode(F.array(goodreads_df.isbn, goodreads_df.isbn13)).alias("isbn"),
+        goodreads_df.title,
+        goodreads_df.authors,
+        goodreads_df.publication_date,
+        goodreads_df.average_rating,
+        goodreads_df.ratings_count,
+        goodreads_df.text_reviews_count,
+    )
+    return (
+        goodreads_isbns_df
+        .withColumn("isbn_key", normalize_isbn_expr(goodreads_isbns_df.isbn))
+        .drop("isbn")
+        # Non ISBNs such as ratings that were entered in the ISBN column will be dropped
+        .dropna(subset=["isbn_key"])
+        # The ISBN and ISBN13 of a book will usually normalize to the same key
+        .drop_duplicates(["isbn_key"])
+    )
+
+
+def normalize_isbn_expr(isbn: Column) -> Column:
+    """Normalizes an ISBN-10 or ISBN-13 to an ISBN-13
+
+    ISBN-10s are converted by adding the 978 prefix and recomputing the check digit. Text that is
+    not an ISBN will be null.
+
+    Examples:
+        - 0439023483 -> 9780439023481
+        - 156384155X -> 9781563841552
+        - 9780439023481 -> 9780439023481
+        - 3.63 -> null
+    """
+    isbn = F.upper(F.regexp_replace(isbn, r"[\s-]", ""))
+
+    # The ISBN-13 check digit weights the digits by alternating ones and threes
+    isbn_12_digits = F.concat(F.lit(ISBN_13_PREFIX), F.substring(isbn, 1, 9))
+    weighted_sum = sum(
+        F.substring(isbn_12_digits, i + 1, 1).cast(IntegerType()) * (3 if i % 2 else 1)
+        for i in range(12)
+    )
+    check_digit = (10 - weighted_sum % 10) % 10
+
+    return (
+        F.when(isbn.rlike(ISBN_13_PATTERN), isbn)
+        .when(isbn.rlike(ISBN_10_PATTERN), F.concat(isbn_12_digits, check_digit.cast(StringType())))
+    )
+
+
+@instrument
+def filter_orphan_checkouts(
+    checkouts_df: DataFrame,
+    inventory_df: DataFrame,
+    policy: str,
+    reject_output_path: str,
+    write_options: WriteOptions,
+    max_broadcast_rows: int = DEFAULT_MAX_BROADCAST_ROWS,
+) -> DataFrame:
+    """Applies the orphan checkouts policy to checkouts of books that are not in the inventory
+
+    The inventory bib numbers are usually broadcast, so the checkouts can be filtered before the
+    checkout tables are built without shuffling the checkouts. See join_bib_num_lookup.
+
+    Args:
+        checkouts_df: SPL checkouts data
+        inventory_df: SPL inventory data
+        policy: See ORPHAN_CHECKOUT_POLICIES
+        reject_output_path: Path to export the rejected checkouts. Only used by the reject policy.
+        write_options: Target file and row group sizes
+        max_broadcast_rows: Shuffle the inventory bib numbers if there are more than this
+
+    Returns:
+        Checkouts after applying the policy
+    """
+    if policy == "keep":
+        return checkouts_df
+
+    bib_nums_df = inventory_df.select(inventory_df.bib_num)
+    if policy == "reject":
+        orphan_checkouts_df = join_bib_num_lookup(
+            checkouts_df,
+            bib_nums_df,
+            "left_anti",
+            max_broadcast_rows,
+            "orphan checkouts",
+        )
+        output_checkouts_parquet(orphan_checkouts_df, reject_output_path, write_options)
+
+    return join_bib_num_lookup(checkouts_df, bib_nums_df, "left_semi", max_broadcast_rows, "orphan checkouts")
+
+
+@instrument
 def create_fact_spl_book_checkouts(
     checkouts_df: DataFrame,
     weather_df: DataFrame,
-    bib_num_publisher_lookup_df: DataFrame,
-    publishers_df: DataFrame,
+    bib_num_publisher_ids_df: DataFrame,
     output_path: str,
-    num_write_partitions: int,
+    write_options: WriteOptions,
+    max_broadcast_rows: int = DEFAULT_MAX_BROADCAST_ROWS,
+    compact_schema: bool = False,
+    existing_checkouts_df: DataFrame = None,
 ):
     """Creates fact_spl_book_checkout table in parquet format
 
     Args:
         checkouts_df: SPL checkouts data
         weather_df: Weather data
-        bib_num_publisher_lookup_df: Bib number, publisher, and normalized key
-        publishers_df: Publisher data,
+        bib_num_publisher_ids_df: Map of bib number to publisher ID
         output_path: Path to export fact table. Can be S3, local, etc
-        num_write_partitions: Use less partitions when writing to S3 to improve perf
+        write_options: Target file and row group sizes
+        max_broadcast_rows: Shuffle the publisher ID map if it has more rows than this
+        compact_schema: Store the bib numbers and item barcodes as integers and the ID as a 64-bit
+            hash. See COMPACT_KEY_TYPES.
+        existing_checkouts_df: Optionally, checkouts that have already been exported. Only checkouts
+            that are not in this table will be exported.
     """
+    # The links are left joins on unique keys, so the fact table has at most as many rows as the
+    # checkouts. They are only counted if they are cached, so they are not computed again.
+    num_rows = checkouts_df.count() if checkouts_df.is_cached and not is_capturing_plans() else None
     checkouts_df = link_temperature_to_checkouts(checkouts_df, weather_df)
-    checkouts_df = link_publisher_id_to_checkouts(checkouts_df, bib_num_publisher_lookup_df, publishers_df)
-    checkouts_df = checkouts_df.withColumn(
-        "id",
-        F.md5(F.concat_ws("=", checkouts_df.bib_num, checkouts_df.item_barcode, checkouts_df.checkout_datetime).alias("id")),
-    )
-    output_parquet(checkouts_df.coalesce(num_write_partitions), output_path)
+    checkouts_df = link_publisher_id_to_checkouts(checkouts_df, bib_num_publisher_ids_df, max_broadcast_rows)
+    if compact_schema:
+        # The ID is hashed from the text keys, so checkouts whose keys did not convert still get unique IDs
+        checkout_id = F.xxhash64(checkouts_df.bib_num, checkouts_df.item_barcode, checkouts_df.checkout_datetime)
+        checkouts_df = convert_compact_keys(checkouts_df.withColumn("id", checkout_id))
+    else:
+        checkouts_df = checkouts_df.withColumn(
+            "id",
+            F.md5(F.concat_ws("=", checkouts_df.bib_num, checkouts_df.item_barcode, checkouts_df.checkout_datetime)),
+        )
+    if existing_checkouts_df is not None:
+        checkouts_df = filter_new_checkouts(checkouts_df, existing_checkouts_df)
+    output_checkouts_parquet(checkouts_df, output_path, write_options, num_rows)
+
 
+def filter_new_checkouts(checkouts_df: DataFrame, existing_checkouts_df: DataFrame) -> DataFrame:
+    """Filters out checkouts that have already been exported
 
+    A checkout file that changed since it was processed is processed again, so the checkouts
+    it had before are already in the fact table. They are found by their ID, which is generated
+    from the checkout. Like filter_new_checkout_times, the existing checkouts are limited to the
+    time range of the checkouts.
+
+    Args:
+        checkouts_df: Checkouts with IDs
+        existing_checkouts_df: Checkouts that have already been exported
+
+    Returns:
+        New checkouts
+    """
+    time_range = checkouts_df.select(
+        F.min(checkouts_df.checkout_datetime),
+        F.max(checkouts_df.checkout_datetime),
+        F.min(F.year(checkouts_df.checkout_datetime)),
+        F.max(F.year(checkouts_df.checkout_datetime)),
+    ).first()
+    existing_ids_df = existing_checkouts_df.filter(
+        existing_checkouts_df.checkout_year.between(time_range[2], time_range[3]) &
+        existing_checkouts_df.checkout_datetime.between(time_range[0], time_range[1])
+    ).select(existing_checkouts_df.id)
+    return checkouts_df.join(existing_ids_df, on="id", how="left_anti")
+
+
+@instrument
 def create_dim_subjects(
     books_df: DataFrame,
     dim_output_path: str,
     br_output_path: str,
-    num_write_partitions: int,
+    write_options: WriteOptions,
+    compact_schema: bool = False,
 ):
     """Creates dim_subject and br_book_subject tables in parquet format
 
@@ -395,15 +1320,17 @@ def create_dim_subjects(
         books_df: SPL inventory with Goodreads data
         dim_output_path: Path to export dimension table. Can be S3, local, etc
         br_output_path: Path to export bridge table. Can be S3, local, etc
-        num_write_partitions: Use less partitions when writing to S3 to improve perf
+        write_options: Target file and row group sizes
+        compact_schema: Store the bib numbers as integers. See COMPACT_KEY_TYPES.
     """
     dim_subjects_df = generate_subjects(books_df)
-    output_parquet(dim_subjects_df.coalesce(num_write_partitions), dim_output_path)
+    output_table(dim_subjects_df, dim_output_path, ["subject"], write_options)
 
-    br_book_subjects = generate_book_subjects(books_df, dim_subjects_df)
-    output_parquet(br_book_subjects.coalesce(num_write_partitions), br_output_path)
+    br_book_subjects = generate_book_subjects(books_df, compact_schema)
+    output_table(br_book_subjects, br_output_path, ["bib_num"], write_options)
 
 
+@instrument
 def generate_subjects(books_df: DataFrame) -> DataFrame:
     """Generates book subjects from inventory
 
@@ -412,7 +1339,7 @@ def generate_subjects(books_df: DataFrame) -> DataFrame:
 
     Returns:
         - A unique set of subjects across all books in the inventory
-        - Will include an autogenerated primary key ID
+        - Will include a primary key ID generated from the subject
         - Columns: id, subject
     """
     df = (
@@ -420,23 +1347,24 @@ def generate_subjects(books_df: DataFrame) -> DataFrame:
         # The subjects column can contain multiple subjects separated by commas
         .select(F.explode(F.split(books_df.raw_subjects, ", ")).alias("subject"))
         .drop_duplicates(["subject"])
-        .sort(F.col("subject"))
     )
 
-    # Since the number of subjects is a reasonable number, we can create a
-    # sequentially incrementing ID column by using one partition
-    return df.coalesce(1).select(
-        F.monotonically_increasing_id().alias("id"),
+    return df.select(
+        generate_id_expr(df.subject).alias("id"),
         df.subject,
     )
 
 
-def generate_book_subjects(books_df: DataFrame, subjects_df: DataFrame) -> DataFrame:
+@instrument
+def generate_book_subjects(books_df: DataFrame, compact_schema: bool = False) -> DataFrame:
     """Makes a bridge table to connect a book to multiple subjects
 
+    Since the subject IDs are generated from the subject, we do not need to join with the
+    subjects dimension to look up the IDs.
+
     Args:
         books_df: SPL inventory with Goodreads data
-        subjects_df: SPL subjects
+        compact_schema: Store the bib numbers as integers. See COMPACT_KEY_TYPES.
 
     Returns:
         - Bridge table referencing bib number to subject IDs
@@ -451,17 +1379,23 @@ def generate_book_subjects(books_df: DataFrame, subjects_df: DataFrame) -> DataF
         )
     )
 
-    return (
-        book_subjects_df
-        .join(subjects_df, subjects_df.subject == book_subjects_df.subject)
-        .select(
-            book_subjects_df.bib_num,
-            subjects_df.id.alias("subject_id"),
-        )
+    book_subjects_df = book_subjects_df.select(
+        book_subjects_df.bib_num,
+        generate_id_expr(book_subjects_df.subject).alias("subject_id"),
     )
+    return convert_compact_keys(book_subjects_df) if compact_schema else book_subjects_df
 
 
-def create_dim_authors(books_df: DataFrame, dim_output_path: str, br_output_path: str, num_write_partitions: int):
+@instrument
+def create_dim_authors(
+    books_df: DataFrame,
+    dim_output_path: str,
+    br_output_path: str,
+    write_options: WriteOptions,
+    cleaners: TextCleaners,
+    persist_mode: str = DEFAULT_PERSIST_MODE,
+    compact_schema: bool = False,
+):
     """Creates dim_author and br_book_author tables in parquet format
 
     Since a book can be linked to multiple authors, we will need to generate both a bridge
@@ -471,201 +1405,312 @@ def create_dim_authors(books_df: DataFrame, dim_output_path: str, br_output_path
         books_df: SPL inventory
         dim_output_path: Path to export dimension table. Can be S3, local, etc
         br_output_path: Path to export bridge table. Can be S3, local, etc
-        num_write_partitions: Use less partitions when writing to S3 to improve perf
+        write_options: Target file and row group sizes
+        cleaners: Text cleaning functions
+        persist_mode: How the author lookup table is materialized. See PERSIST_MODES.
+        compact_schema: Store the bib numbers as integers. See COMPACT_KEY_TYPES.
     """
-    authors_df = generate_authors(books_df)
+    # Both tables need the formatted and normalized authors, so we only want to compute them once
+    author_lookup_df = materialize(generate_author_lookup_table(books_df, cleaners), persist_mode)
+    authors_df = generate_authors(author_lookup_df)
 
     dim_authors_df = authors_df.select(authors_df.id, authors_df.author.alias("name"))
-    output_parquet(dim_authors_df.coalesce(num_write_partitions), dim_output_path)
+    output_table(dim_authors_df, dim_output_path, ["name"], write_options)
 
-    br_book_subjects = generate_book_authors(books_df, authors_df)
-    output_parquet(br_book_subjects.coalesce(num_write_partitions), br_output_path)
+    br_book_subjects = generate_book_authors(books_df, author_lookup_df, compact_schema)
+    output_table(br_book_subjects, br_output_path, ["bib_num"], write_options)
 
+    author_lookup_df.unpersist()
 
-def generate_authors(books_df):
-    """Generates authors from inventory and linked Goodreads data
+
+@instrument
+def generate_book_raw_authors(books_df: DataFrame) -> DataFrame:
+    """Generates the raw SPL and Goodreads authors of each book
 
     Args:
         books_df: SPL inventory with Goodreads data
 
     Returns:
-        - A unique set of authors across all books in the inventory
-        - Will include an autogenerated primary key ID
+        - Raw authors for each book
         - Columns:
-          - id: Autogenerated primary key ID
-          - author: Raw author name if from Goodreads or formatted if from SPL
-          - key: Normalized author is a used as join key for reducing duplicates
+          - bib_num
+          - source: SPL_AUTHOR_SOURCE or GOODREADS_AUTHOR_SOURCE
+          - raw_author
     """
-    # Custom functions to help with formatting
-    format_spl_author_udf = create_format_spl_author_udf()
-    normalize_text_udf = create_normalize_text_udf()
-
-    spl_authors_df = (
-        books_df
-        # Attempt to reformat the SPL authors into first name and last name.
-        # The current implementation is a naive approach that only handles
-        # the common cases. False positives will occur.
-        .select(format_spl_author_udf(books_df.raw_author).alias("author"))
+    spl_authors_df = books_df.select(
+        books_df.bib_num,
+        F.lit(SPL_AUTHOR_SOURCE).alias("source"),
+        books_df.raw_author,
     )
-    gr_authors_df = (
-        books_df
+    gr_authors_df = books_df.select(
+        books_df.bib_num,
+        F.lit(GOODREADS_AUTHOR_SOURCE).alias("source"),
         # The goodreads author data can contain multiple authors
-        .select(F.explode(F.split(books_df.gr_authors, ", ")).alias("author"))
+        F.explode(F.split(books_df.gr_authors, "/")).alias("raw_author"),
     )
-    authors_df = spl_authors_df.union(gr_authors_df).dropna()
+    return spl_authors_df.union(gr_authors_df).dropna(subset=["raw_author"])
 
-    norm_authors_df = (
-        authors_df
-        .select(
-            authors_df.author,
-            # The normalized author will be used for joining raw authors from the inventory data
-            normalize_text_udf(authors_df.author).alias("key"),
-        )
-        .drop_duplicates(["key"])
-    )
 
-    # Since the number of authors is a reasonable number, we can create a
-    # sequentially incrementing ID column by using one partition
-    return norm_authors_df.coalesce(1).withColumn("id", F.monotonically_increasing_id())
+@instrument
+def generate_author_lookup_table(books_df: DataFrame, cleaners: TextCleaners) -> DataFrame:
+    """Generates a look up table of formatted and normalized authors
 
-
-def generate_book_authors(books_df, authors_df):
-    """Makes a bridge table to connect a book to multiple authors
+    There are far fewer distinct authors than books, so the authors are formatted and normalized
+    once per distinct raw author. The look up table can then be joined back to the books.
 
     Args:
         books_df: SPL inventory with Goodreads data
-        authors_df: SPL/Goodreads authors
+        cleaners: Text cleaning functions
 
     Returns:
-        - Bridge table referencing bib number to author IDs
-        - Columns: bib_num, author_id
+        - A look up table between raw authors and authors
+        - Columns:
+          - source: SPL_AUTHOR_SOURCE or GOODREADS_AUTHOR_SOURCE
+          - raw_author: Author as it appears in the SPL inventory or Goodreads data
+          - author: Raw author name if from Goodreads or formatted if from SPL
+          - key: Normalized author is a used as join key for reducing duplicates
     """
-    # Custom functions to help with formatting
-    format_spl_author_udf = create_format_spl_author_udf()
-    normalize_text_udf = create_normalize_text_udf()
+    raw_authors_df = generate_book_raw_authors(books_df).select("source", "raw_author").distinct()
 
     spl_authors_df = (
-        books_df
+        raw_authors_df
+        .filter(raw_authors_df.source == SPL_AUTHOR_SOURCE)
+        # Attempt to reformat the SPL authors into first name and last name.
+        # The current implementation is a naive approach that only handles
+        # the common cases. False positives will occur.
         .select(
-            books_df.bib_num,
-            format_spl_author_udf(books_df.raw_author).alias("author"),
+            raw_authors_df.source,
+            raw_authors_df.raw_author,
+            cleaners.format_spl_author(raw_authors_df.raw_author).alias("author"),
         )
     )
     gr_authors_df = (
-        books_df
+        raw_authors_df
+        .filter(raw_authors_df.source == GOODREADS_AUTHOR_SOURCE)
         .select(
-            books_df.bib_num,
-            F.explode(F.split(books_df.gr_authors, "/")).alias("author"),
+            raw_authors_df.source,
+            raw_authors_df.raw_author,
+            raw_authors_df.raw_author.alias("author"),
         )
     )
-    book_authors_df = spl_authors_df.union(gr_authors_df).dropna()
-    book_authors_df = book_authors_df.withColumn("key", normalize_text_udf(book_authors_df.author))
+    authors_df = spl_authors_df.union(gr_authors_df).dropna(subset=["author"])
 
-    return (
-        book_authors_df
-        .join(authors_df, authors_df.key == book_authors_df.key)
-        .select(
-            book_authors_df.bib_num,
-            authors_df.id.alias("authors_id"),
-        )
+    return authors_df.select(
+        authors_df["*"],
+        # The normalized author will be used for joining raw authors from the inventory data
+        cleaners.normalize_text(authors_df.author).alias("key"),
     )
 
 
-def create_dim_publishers(
-    books_df: DataFrame,
-    publishers_map_df: DataFrame,
-    output_path: str,
-    num_write_partitions: int,
-) -> Tuple[DataFrame, DataFrame]:
-    """Creates dim_publisher table in parquet format
-
-    Since a book can be linked to multiple authors, we will need to generate both a bridge
-    table and a dimension table.
+@instrument
+def generate_authors(author_lookup_df: DataFrame) -> DataFrame:
+    """Generates authors from inventory and linked Goodreads data
+
+    Args:
+        author_lookup_df: Raw author, formatted author, and normalized key
+
+    Returns:
+        - A unique set of authors across all books in the inventory
+        - Will include a primary key ID generated from the normalized author
+        - Columns:
+          - id: Primary key ID generated from the normalized author
+          - author: Raw author name if from Goodreads or formatted if from SPL
+          - key: Normalized author is a used as join key for reducing duplicates
+    """
+    norm_authors_df = author_lookup_df.select(author_lookup_df.author, author_lookup_df.key).drop_duplicates(["key"])
+    return norm_authors_df.withColumn("id", generate_id_expr(norm_authors_df.key))
+
+
+@instrument
+def generate_book_authors(books_df: DataFrame, author_lookup_df: DataFrame, compact_schema: bool = False) -> DataFrame:
+    """Makes a bridge table to connect a book to multiple authors
+
+    Since the author IDs are generated from the normalized author, we do not need to join with
+    the authors dimension to look up the IDs.
+
+    Args:
+        books_df: SPL inventory with Goodreads data
+        author_lookup_df: Raw author, formatted author, and normalized key
+        compact_schema: Store the bib numbers as integers. See COMPACT_KEY_TYPES.
+
+    Returns:
+        - Bridge table referencing bib number to author IDs
+        - Columns: bib_num, author_id
+    """
+    book_authors_df = generate_book_raw_authors(books_df)
+    book_authors_df = (
+        book_authors_df
+        .join(
+            author_lookup_df,
+            (author_lookup_df.source == book_authors_df.source) &
+            (author_lookup_df.raw_author == book_authors_df.raw_author),
+        )
+        .select(
+            book_authors_df.bib_num,
+            generate_id_expr(author_lookup_df.key).alias("authors_id"),
+        )
+    )
+    return convert_compact_keys(book_authors_df) if compact_schema else book_authors_df
+
+
+@instrument
+def create_dim_publishers(
+    books_df: DataFrame,
+    publishers_map_df: DataFrame,
+    output_path: str,
+    write_options: WriteOptions,
+    cleaners: TextCleaners,
+    map_output_path: str = None,
+    persist_mode: str = DEFAULT_PERSIST_MODE,
+) -> DataFrame:
+    """Creates dim_publisher table in parquet format
 
     Args:
         books_df: SPL inventory
         publishers_map_df: Map of raw publishers to "official" publishers
         output_path: Path to export dimension table. Can be S3, local, etc
-        num_write_partitions: Use less partitions when writing to S3 to improve perf
+        write_options: Target file and row group sizes
+        cleaners: Text cleaning functions
+        map_output_path: Optionally, path to export the bib number to publisher ID map
+        persist_mode: How the publisher lookup table and the map are materialized. See PERSIST_MODES.
 
     Returns:
-        We need bib_num_publisher_lookup_df and publishers_df to link publisher_id to checkouts
+        We need the bib number to publisher ID map to link publisher_id to checkouts
     """
-    bib_num_publisher_lookup_df = generate_bib_num_publisher_lookup_table(books_df, publishers_map_df)
-    publishers_df = generate_publishers(bib_num_publisher_lookup_df)
+    publisher_lookup_df = materialize(
+        generate_publisher_lookup_table(books_df, publishers_map_df, cleaners),
+        persist_mode,
+    )
 
+    publishers_df = generate_publishers(publisher_lookup_df, cleaners)
     dim_publishers_df = publishers_df.select(publishers_df.id, publishers_df.publisher.alias("name"))
-    output_parquet(dim_publishers_df.coalesce(num_write_partitions), output_path)
+    output_table(dim_publishers_df, output_path, ["name"], write_options)
+
+    # The map is small enough to keep in memory, so the fact table does not need to recompute it
+    bib_num_publisher_ids_df = materialize(generate_bib_num_publisher_ids(books_df, publisher_lookup_df), persist_mode)
+    publisher_lookup_df.unpersist()
 
-    return bib_num_publisher_lookup_df, publishers_df
+    if map_output_path:
+        output_table(bib_num_publisher_ids_df, map_output_path, ["bib_num"], write_options)
 
+    return bib_num_publisher_ids_df
 
-def generate_bib_num_publisher_lookup_table(books_df: DataFrame, publishers_map_df: DataFrame) -> DataFrame:
-    """Generates a look up table that can map bib_nums and publishers
+
+@instrument
+def generate_publisher_lookup_table(
+    books_df: DataFrame,
+    publishers_map_df: DataFrame,
+    cleaners: TextCleaners,
+) -> DataFrame:
+    """Generates a look up table of official and normalized publishers
+
+    There are far fewer distinct publishers than books, so the publishers are normalized
+    once per distinct raw publisher. The look up table can then be joined back to the books.
 
     Args:
         book_df: SPL book data with Goodreads data
         publishers_map_df: Official publishers map data
+        cleaners: Text cleaning functions
 
     Returns:
-        - A look up table between bib number and publisher
+        - A look up table between raw publisher and publisher
         - Columns:
-          - bib_num
+          - raw_publisher: Publisher as it appears in the SPL inventory
           - publisher: Official publisher or raw publisher
           - key: Normalized publisher to remove duplicates
     """
-    normalize_text_udf = create_normalize_text_udf()
+    raw_publishers_df = books_df.select(books_df.raw_publisher).distinct()
+    publishers_df = (
+        raw_publishers_df
+        .join(publishers_map_df, publishers_map_df.publisher == raw_publishers_df.raw_publisher, how="left")
+        .select(
+            raw_publishers_df.raw_publisher,
+            F.coalesce(publishers_map_df.official_publisher, raw_publishers_df.raw_publisher).alias("publisher"),
+        )
+    )
+    return publishers_df.select(
+        publishers_df["*"],
+        cleaners.normalize_text(publishers_df.publisher).alias("key"),
+    )
+
+
+@instrument
+def generate_bib_num_publisher_ids(books_df: DataFrame, publisher_lookup_df: DataFrame) -> DataFrame:
+    """Generates a map of bib numbers to publisher IDs
+
+    Since the publisher IDs are generated from the normalized publisher, we do not need to join
+    with the publishers dimension to look up the IDs.
+
+    Args:
+        book_df: SPL book data with Goodreads data
+        publisher_lookup_df: Raw publisher, publisher, and normalized key
+
+    Returns:
+        - A map of bib numbers to publisher IDs. Books without a publisher are left out.
+        - Columns: bib_num, publisher_id
+    """
     return (
         books_df
-        .join(publishers_map_df, publishers_map_df.publisher == books_df.raw_publisher, how="left")
+        .join(publisher_lookup_df, publisher_lookup_df.raw_publisher == books_df.raw_publisher)
+        .dropna(subset=["key"])
         .select(
             books_df.bib_num,
-            F.coalesce(publishers_map_df.official_publisher, books_df.raw_publisher).alias("publisher"),
-            normalize_text_udf(F.coalesce(publishers_map_df.official_publisher, books_df.raw_publisher)).alias("key")
+            generate_id_expr(publisher_lookup_df.key).alias("publisher_id"),
         )
     )
 
 
-def generate_publishers(bib_num_publisher_lookup_df: DataFrame) -> DataFrame:
-    """Generates publishers list from bib_num, publisher lookup table
+@instrument
+def generate_publishers(publisher_lookup_df: DataFrame, cleaners: TextCleaners) -> DataFrame:
+    """Generates publishers list from the publisher lookup table
 
     Args:
-        bib_num_publisher_lookup_df: Bib number, publisher, and normalized key
+        publisher_lookup_df: Raw publisher, publisher, and normalized key
+        cleaners: Text cleaning functions
 
     Returns:
         - Unique list of publishers with generated primary key
         - Columns:
-          - id: Autogenerated primary key ID
+          - id: Primary key ID generated from the normalized publisher
           - publisher: Cleaned up official publisher or raw publisher
           - key: Normalized publisher to remove duplicates
     """
-    clean_publisher_udf = create_clean_publisher_udf()
     return (
-        bib_num_publisher_lookup_df
+        publisher_lookup_df
+        # Books without a publisher do not need a publisher row
+        .dropna(subset=["key"])
         .drop_duplicates(["key"])
-        .coalesce(1)
         .select(
-            # Since the number of publishers is a reasonable number, we can create a
-            # sequentially incrementing ID column by using one partition
-            F.monotonically_increasing_id().alias("id"),
-            clean_publisher_udf(bib_num_publisher_lookup_df.publisher).alias("publisher"),
-            bib_num_publisher_lookup_df.key,
+            generate_id_expr(publisher_lookup_df.key).alias("id"),
+            cleaners.clean_publisher(publisher_lookup_df.publisher).alias("publisher"),
+            publisher_lookup_df.key,
         )
     )
 
 
-def create_dim_checkout_datetimes(book_checkouts_df: DataFrame, output_path: str, num_write_partitions: int):
+@instrument
+def create_dim_checkout_datetimes(
+    book_checkouts_df: DataFrame,
+    output_path: str,
+    write_options: WriteOptions,
+    existing_checkout_times_df: DataFrame = None,
+):
     """Creates dim_checkout_time table in parquet format
 
     Args:
         book_checkouts_df: SPL book checkouts
         output_path: Path to export parquet data. Can be S3, local, etc
-        num_write_partitions: Use less partitions when writing to S3 to improve perf
+        write_options: Target file and row group sizes
+        existing_checkout_times_df: Optionally, checkout times that have already been exported.
+            Only checkout times that are not in this table will be exported.
     """
     dim_checkout_time_df = generate_checkout_times(book_checkouts_df)
-    output_parquet(dim_checkout_time_df.coalesce(num_write_partitions), output_path)
+    if existing_checkout_times_df is not None:
+        dim_checkout_time_df = filter_new_checkout_times(dim_checkout_time_df, existing_checkout_times_df)
+    output_checkouts_parquet(dim_checkout_time_df, output_path, write_options)
 
 
+@instrument
 def generate_checkout_times(book_checkouts_df: DataFrame) -> DataFrame:
     """Generates checkout time data from book checkouts
 
@@ -695,34 +1740,75 @@ def generate_checkout_times(book_checkouts_df: DataFrame) -> DataFrame:
     )
 
 
-def create_dim_books(books_df: DataFrame, output_path: str, num_write_partitions: int):
+def filter_new_checkout_times(checkout_times_df: DataFrame, existing_checkout_times_df: DataFrame) -> DataFrame:
+    """Filters out checkout times that have already been exported
+
+    Since the checkout files are split by year, the existing checkout times are limited to
+    the time range of the new checkout times. This lets the parquet reader skip the partitions
+    of the other years.
+
+    Args:
+        checkout_times_df: Checkout times from the new checkouts
+        existing_checkout_times_df: Checkout times that have already been exported
+
+    Returns:
+        New checkout times
+    """
+    time_range = checkout_times_df.select(
+        F.min(checkout_times_df.checkout_datetime),
+        F.max(checkout_times_df.checkout_datetime),
+        F.min(F.year(checkout_times_df.checkout_datetime)),
+        F.max(F.year(checkout_times_df.checkout_datetime)),
+    ).first()
+    existing_checkout_times_df = existing_checkout_times_df.filter(
+        existing_checkout_times_df.checkout_year.between(time_range[2], time_range[3]) &
+        existing_checkout_times_df.checkout_datetime.between(time_range[0], time_range[1])
+    )
+    return checkout_times_df.join(
+        existing_checkout_times_df,
+        existing_checkout_times_df.checkout_datetime == checkout_times_df.checkout_datetime,
+        how="left_anti",
+    )
+
+
+@instrument
+def create_dim_books(
+    books_df: DataFrame,
+    output_path: str,
+    write_options: WriteOptions,
+    cleaners: TextCleaners,
+    compact_schema: bool = False,
+):
     """Creates books dimension in parquet format
 
     Args:
         book_df: SPL book data with Goodreads data
         output_path: Path to export dimension table. Can be S3, local, etc
-        num_write_partitions: Use less partitions when writing to S3 to improve perf
+        write_options: Target file and row group sizes
+        cleaners: Text cleaning functions
+        compact_schema: Store the bib numbers as integers. See COMPACT_KEY_TYPES.
     """
-    dim_book_df = generate_books(books_df)
-    output_parquet(dim_book_df.coalesce(num_write_partitions), output_path)
+    dim_book_df = generate_books(books_df, cleaners, compact_schema)
+    output_table(dim_book_df, output_path, ["bib_num"], write_options)
 
 
-def generate_books(books_df):
+@instrument
+def generate_books(books_df: DataFrame, cleaners: TextCleaners, compact_schema: bool = False) -> DataFrame:
     """Generates book data from inventory
 
     Args:
         book_df: SPL book data with Goodreads data
+        cleaners: Text cleaning functions
+        compact_schema: Store the bib numbers as integers. See COMPACT_KEY_TYPES.
 
     Returns:
         Books dimension
     """
-    clean_title_udf = create_clean_title_udf()
-    clean_publication_year_udf = create_clean_publication_year_udf()
     return books_df.select(
-        books_df.bib_num,
-        clean_title_udf(books_df.raw_title, books_df.gr_title).alias("title"),
+        compact_key_expr(books_df.bib_num, "bib_num").alias("bib_num") if compact_schema else books_df.bib_num,
+        cleaners.clean_title(books_df.raw_title, books_df.gr_title).alias("title"),
         books_df.isbns,
-        clean_publication_year_udf(
+        cleaners.clean_publication_year(
             books_df.raw_publication_year,
             books_df.gr_publication_date).cast(IntegerType()).alias("publication_year"),
         books_df.gr_average_rating.alias("average_rating"),
@@ -735,9 +1821,13 @@ def generate_books(books_df):
     )
 
 
+@instrument
 def link_temperature_to_checkouts(checkouts_df: DataFrame, weather_df: DataFrame) -> DataFrame:
     """Links temperature for the day to SPL checkout data
 
+    The weather data only has one row per day, so it is broadcast to avoid shuffling the
+    checkouts.
+
     Args:
         checkouts_df: SPL checkouts data
         weather_df: Weather data
@@ -748,10 +1838,8 @@ def link_temperature_to_checkouts(checkouts_df: DataFrame, weather_df: DataFrame
     return (
         checkouts_df
         .join(
-            weather_df,
-            (weather_df.month == F.month(checkouts_df.checkout_datetime)) &
-            (weather_df.day == F.dayofmonth(checkouts_df.checkout_datetime)) &
-            (weather_df.year == F.year(checkouts_df.checkout_datetime)),
+            F.broadcast(weather_df),
+            weather_df.date == F.to_date(checkouts_df.checkout_datetime),
             how="left",
         )
         .select(
@@ -761,34 +1849,124 @@ def link_temperature_to_checkouts(checkouts_df: DataFrame, weather_df: DataFrame
     )
 
 
+@instrument
 def link_publisher_id_to_checkouts(
     checkouts_df: DataFrame,
-    bib_num_publisher_lookup_df: DataFrame,
-    publishers_df: DataFrame,
+    bib_num_publisher_ids_df: DataFrame,
+    max_broadcast_rows: int = DEFAULT_MAX_BROADCAST_ROWS,
 ) -> DataFrame:
     """Links publisher ID to SPL checkouts data
 
+    The map only has one row per book, so it is usually broadcast to avoid shuffling the
+    checkouts. See join_bib_num_lookup.
+
     Args:
         checkouts_df: SPL checkouts data
-        bib_num_publisher_lookup_df: Bib number, publisher, and normalized key
-        publishers_df: Publisher data
+        bib_num_publisher_ids_df: Map of bib number to publisher ID
+        max_broadcast_rows: Shuffle the map if it has more rows than this
 
     Returns:
         Checkouts with publisher ID
     """
-    return (
+    return join_bib_num_lookup(
+        checkouts_df,
+        bib_num_publisher_ids_df.select(bib_num_publisher_ids_df.bib_num, bib_num_publisher_ids_df.publisher_id),
+        "left",
+        max_broadcast_rows,
+        "publisher IDs",
+    )
+
+
+def join_bib_num_lookup(
+    checkouts_df: DataFrame,
+    lookup_df: DataFrame,
+    how: str,
+    max_broadcast_rows: int,
+    lookup_name: str,
+) -> DataFrame:
+    """Joins a lookup with one row per bib number to the checkouts
+
+    Small lookups are broadcast. Larger lookups need a shuffle join, where all the checkouts of
+    a book are joined by the same task, so the tasks with popular books take much longer than
+    the rest. To avoid this, the bib numbers that are skewed in a sample of the checkouts are
+    split off and joined to a broadcast of their lookup rows, and only the remaining checkouts
+    are shuffled.
+
+    Args:
+        checkouts_df: SPL checkouts data
+        lookup_df: Lookup with a bib_num column and one row per bib number
+        how: Join type. The lookup columns are only added to the checkouts for left joins.
+        max_broadcast_rows: Shuffle the lookup if it has more rows than this
+        lookup_name: Name of the lookup for the skewed keys report
+
+    Returns:
+        Joined checkouts with the checkout columns in the same order
+    """
+    columns = checkouts_df.columns + [column for column in lookup_df.columns if column != "bib_num"]
+    if how in ("left_semi", "left_anti"):
+        columns = checkouts_df.columns
+
+    def join(left_df: DataFrame, right_df: DataFrame) -> DataFrame:
+        return left_df.join(right_df, on="bib_num", how=how).select(*columns)
+
+    if lookup_df.count() <= max_broadcast_rows:
+        return join(checkouts_df, F.broadcast(lookup_df))
+
+    skewed_bib_nums = find_skewed_bib_nums(checkouts_df)
+    print(f"Skewed bib numbers in the {lookup_name} join: {len(skewed_bib_nums)}")
+    for bib_num, share in skewed_bib_nums:
+        print(f"  {bib_num}: {share:.2%} of the sampled checkouts")
+
+    if not skewed_bib_nums:
+        return join(checkouts_df, lookup_df)
+
+    # Checkouts without a bib number are not skewed, since null keys do not match anything
+    is_skewed = F.coalesce(checkouts_df.bib_num.isin([bib_num for bib_num, _ in skewed_bib_nums]), F.lit(False))
+    skewed_lookup_df = lookup_df.filter(lookup_df.bib_num.isin([bib_num for bib_num, _ in skewed_bib_nums]))
+    return join(checkouts_df.filter(is_skewed), F.broadcast(skewed_lookup_df)).unionByName(
+        join(checkouts_df.filter(~is_skewed), lookup_df)
+    )
+
+
+@instrument
+def find_skewed_bib_nums(checkouts_df: DataFrame) -> List[tuple]:
+    """Finds the bib numbers with a large share of the checkouts from a sample of the checkouts
+
+    Args:
+        checkouts_df: SPL checkouts data
+
+    Returns:
+        Skewed bib numbers and their share of the sampled checkouts, most checked out first.
+        At most SKEW_MAX_KEYS are returned.
+    """
+    bib_num_counts_df = (
         checkouts_df
-        .join(bib_num_publisher_lookup_df, bib_num_publisher_lookup_df.bib_num == checkouts_df.bib_num, how="left")
-        .join(publishers_df, publishers_df.key == bib_num_publisher_lookup_df.key, how="left")
-        .select(
-            checkouts_df["*"],
-            publishers_df.id.alias("publisher_id"),
-        )
+        .select(checkouts_df.bib_num)
+        .sample(fraction=SKEW_SAMPLE_FRACTION, seed=SKEW_SAMPLE_SEED)
+        .dropna()
+        .groupBy("bib_num")
+        .count()
+        .persist()
+    )
+    total_count = bib_num_counts_df.agg(F.sum("count")).first()[0] or 0
+    skewed_rows = (
+        bib_num_counts_df
+        .filter(F.col("count") >= F.greatest(F.lit(total_count * SKEW_MIN_KEY_SHARE), F.lit(SKEW_MIN_KEY_SAMPLE_COUNT)))
+        .orderBy(F.col("count").desc(), F.col("bib_num"))
+        .limit(SKEW_MAX_KEYS)
+        .collect()
     )
+    bib_num_counts_df.unpersist()
+    return [(row.bib_num, row["count"] / total_count) for row in skewed_rows]
 
 
 def create_clean_title_udf():
-    """UDF to clean title text
+    """UDF to clean title text. See clean_title_text."""
+    return F.udf(clean_title_text)
+
+
+def clean_title_text(spl_title: str, gr_title: str) -> str:
+    """Cleans title text
 
     - Prefer title from Goodreads since it is well formatted
     - The SPL title includes author/illustrator information typically
@@ -800,24 +1978,26 @@ def create_clean_title_udf():
         - The only child : a novel / Andrew Pyper.
         - The great powers outage / William Boniface ; illustrations by Stephen Gilpin.
     """
-    def clean_title_text(spl_title, gr_title):
-        if gr_title:
-            return gr_title
+    if gr_title:
+        return gr_title
 
-        if not spl_title:  # Possible for title to be null
-            return None
-        try:
-            title, _ = spl_title.rsplit(" / ", 1)  # Naively split on first slash to the right
-            return title.strip()
-        except ValueError:
-            # There are cases where the title does not contain a slash
-            return spl_title
-
-    return F.udf(clean_title_text)
+    if not spl_title:  # Possible for title to be null
+        return None
+    try:
+        title, _ = spl_title.rsplit(" / ", 1)  # Naively split on first slash to the right
+        return title.strip()
+    except ValueError:
+        # There are cases where the title does not contain a slash
+        return spl_title
 
 
 def create_clean_publication_year_udf():
-    """UDF to clean publication year
+    """UDF to clean publication year. See clean_publication_year_text."""
+    return F.udf(clean_publication_year_text)
+
+
+def clean_publication_year_text(spl_publication_year: str, gr_publication_date: datetime.datetime) -> int:
+    """Cleans publication year
 
     - Prefer publication date from Goodreads since it is well formatted
     - The SPL data has inconsistent formatting of the year
@@ -830,35 +2010,40 @@ def create_clean_publication_year_udf():
       - 1991, c1988.
       - 2003, c1999.
     """
-    def clean_publication_year_text(spl_publication_year, gr_publication_date):
-        if gr_publication_date:
-            return gr_publication_date.year
-
-        if not spl_publication_year:  # Possible for publication year to be null
-            return None
+    if gr_publication_date:
+        return gr_publication_date.year
 
-        years = sorted([int(year) for year in re.findall(r"(\d{4})", spl_publication_year)])
-        return years[0] if years else None
+    if not spl_publication_year:  # Possible for publication year to be null
+        return None
 
-    return F.udf(clean_publication_year_text)
+    # The years are compared as numbers, since the text of other Unicode digits sorts after ASCII digits
+    years = PUBLICATION_YEAR_REGEX.findall(spl_publication_year)
+    return min(int(year) for year in years) if years else None
 
 
 def create_clean_publisher_udf():
-    """UDF to clean publisher text
+    """UDF to clean publisher text. See clean_publisher_text."""
+    return F.udf(clean_publisher_text)
+
+
+def clean_publisher_text(publisher: str) -> str:
+    """Cleans publisher text
 
     For some reason there's a trailing comma after many of the publishers
     in the SPL inventory data.
     """
-    def clean_publisher_text(publisher):
-        if not publisher:  # Possible for publisher to be null
-            return None
-        return publisher.strip().strip(",")
-
-    return F.udf(clean_publisher_text)
+    if not publisher:  # Possible for publisher to be null
+        return None
+    return publisher.strip().strip(",")
 
 
 def create_format_spl_author_udf():
-    """UDF to format SPL author
+    """UDF to format SPL author. See format_spl_author."""
+    return F.udf(format_spl_author)
+
+
+def format_spl_author(author: str) -> str:
+    """Formats SPL author
 
     Examples of SPL inventory authors format:
 
@@ -877,77 +2062,724 @@ def create_format_spl_author_udf():
     - If there is only 1 comma, we can try to swap the last name and first name
       if the strings are a reasonable length.
     """
-    def format_spl_author(author):
-        if author is None:
-            return author
-
-        author_no_years = re.sub(r", \d{4}-(\d{4})?$", "", author)
+    if author is None:
+        return author
 
-        # Handle case where a year suffix has been found.
-        #
-        # In this case we can be more confident about swapping the last/first names
-        if len(author_no_years) != len(author):
-            author_parts = author_no_years.split(", ")
-            if len(author_parts) == 2:
-                # Only swap last_name, first name when there are two parts
-                return "{} {}".format(author_parts[1], author_parts[0])
-
-            # We were able to remove the year, but did not find the expected number
-            # commas. This means that the author may have go by one name. Or this
-            # is an unknown format.
-            return author_no_years
+    author_no_years = SPL_AUTHOR_YEARS_REGEX.sub("", author)
 
-        # In the case where a year suffix has not been found, we'll be more careful.
-        # We'll only perform the swap if both name parts are under 36 characters.
-        author_parts = author.split(", ")
-        max_name_len = 36
-        if len(author_parts) == 2 and len(author_parts[0]) < max_name_len and len(author_parts[1]) < max_name_len:
+    # Handle case where a year suffix has been found.
+    #
+    # In this case we can be more confident about swapping the last/first names
+    if len(author_no_years) != len(author):
+        author_parts = author_no_years.split(", ")
+        if len(author_parts) == 2:
+            # Only swap last_name, first name when there are two parts
             return "{} {}".format(author_parts[1], author_parts[0])
 
-        return author
+        # We were able to remove the year, but did not find the expected number
+        # commas. This means that the author may have go by one name. Or this
+        # is an unknown format.
+        return author_no_years
 
-    return F.udf(format_spl_author)
+    # In the case where a year suffix has not been found, we'll be more careful.
+    # We'll only perform the swap if both name parts are under 36 characters.
+    author_parts = author.split(", ")
+    if (
+        len(author_parts) == 2 and
+        len(author_parts[0]) < SPL_AUTHOR_MAX_NAME_LEN and
+        len(author_parts[1]) < SPL_AUTHOR_MAX_NAME_LEN
+    ):
+        return "{} {}".format(author_parts[1], author_parts[0])
+
+    return author
 
 
 def create_normalize_text_udf():
-    """UDF to normalize text to reduce duplicates
+    """UDF to normalize text. See normalize_text."""
+    return F.udf(normalize_text)
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes text to reduce duplicates
 
     This is a naive approach to normalizing the text. Duplicates will be missed,
     but we will try to avoid false positives (incorrectly merging duplicates).
     """
-    def normalize_text(text):
-        if text is None:
-            return text
+    if text is None:
+        return text
 
-        # Lowercase
-        text = text.lower()
+    # Lowercase
+    text = text.lower()
 
-        # Remove text in parenthesis
-        text = re.sub(r"(\s*\(.+\)\s*)$", "", text)
+    # Remove text in parenthesis
+    text = NORMALIZE_TEXT_PARENTHESIS_REGEX.sub("", text)
 
-        # Remove punctuation and digits
-        text = re.sub(r"[\[\]<>{}|\\!\"#&()*+,./:;?@_-]", " ", text)
+    # Remove punctuation and digits
+    text = NORMALIZE_TEXT_PUNCTUATION_REGEX.sub(" ", text)
 
-        # Remove apostrophe (special case since we don't want a space here)
-        text = re.sub(r"'", "", text)
+    # Remove apostrophe (special case since we don't want a space here)
+    text = text.replace("'", "")
 
-        # Remove extra spaces
-        return re.sub(r"\s{2,}", " ", text).strip()
+    # Remove extra spaces
+    return NORMALIZE_TEXT_EXTRA_SPACES_REGEX.sub(" ", text).strip()
 
-    return F.udf(normalize_text)
+
+def create_text_cleaners(engine: str = DEFAULT_CLEANING_ENGINE) -> TextCleaners:
+    """Creates the text cleaning functions for the given engine
+
+    All engines produce the same output. The Python UDFs are the reference implementation. The
+    native engine is faster since rows do not need to be serialized to a Python worker. The pandas
+    engine still uses Python workers, but rows are sent in Arrow batches and processed with
+    vectorized pandas string functions.
+
+    Use check_cleaning_engines.py to verify that the engines are equivalent after making changes
+    and benchmark_cleaning_engines.py to compare their throughput.
+
+    Args:
+        engine: Engine to run the cleaning functions with. See CLEANING_ENGINES.
+
+    Returns:
+        Text cleaning functions
+    """
+    if engine == "udf":
+        return TextCleaners(
+            normalize_text=create_normalize_text_udf(),
+            format_spl_author=create_format_spl_author_udf(),
+            clean_title=create_clean_title_udf(),
+            clean_publication_year=create_clean_publication_year_udf(),
+            clean_publisher=create_clean_publisher_udf(),
+        )
+
+    if engine == "pandas":
+        return TextCleaners(
+            normalize_text=create_normalize_text_pandas_udf(),
+            format_spl_author=create_format_spl_author_pandas_udf(),
+            clean_title=create_clean_title_pandas_udf(),
+            clean_publication_year=create_clean_publication_year_pandas_udf(),
+            clean_publisher=create_clean_publisher_pandas_udf(),
+        )
+
+    if engine == "native":
+        return TextCleaners(
+            normalize_text=normalize_text_expr,
+            format_spl_author=format_spl_author_expr,
+            clean_title=clean_title_expr,
+            clean_publication_year=clean_publication_year_expr,
+            clean_publisher=clean_publisher_expr,
+        )
+
+    raise ValueError(f"Unknown cleaning engine: {engine}. Expected one of: {', '.join(CLEANING_ENGINES)}")
+
+
+def create_clean_title_pandas_udf():
+    """Pandas UDF version of create_clean_title_udf"""
+    # Pandas is only needed on the workers when the pandas engine is used
+    import pandas as pd
+
+    @F.pandas_udf(StringType())
+    def clean_title(spl_title: pd.Series, gr_title: pd.Series) -> pd.Series:
+        spl_title = to_python_strings(spl_title)
+        gr_title = to_python_strings(gr_title)
+
+        # Naively split on first slash to the right
+        title_parts = spl_title.str.rsplit(" / ", n=1)
+        titles = spl_title.where(title_parts.str.len() != 2, title_parts.str[0].str.strip())
+        titles = titles.where(spl_title.notna() & (spl_title != ""), None)
+        return gr_title.where(gr_title.notna() & (gr_title != ""), titles)
+
+    return clean_title
+
+
+def create_clean_publication_year_pandas_udf():
+    """Pandas UDF version of create_clean_publication_year_udf"""
+    import pandas as pd
+
+    @F.pandas_udf(IntegerType())
+    def clean_publication_year(spl_publication_year: pd.Series, gr_publication_date: pd.Series) -> pd.Series:
+        spl_publication_year = to_python_strings(spl_publication_year)
+
+        # Each four digit year is extracted into its own row with the original row number as the
+        # first level of the index. This lets us find the earliest year for each row with a groupby.
+        years = spl_publication_year.str.extractall(PUBLICATION_YEAR_PATTERN)[0].astype(int)
+        earliest_years = years.groupby(level=0).min().reindex(spl_publication_year.index)
+        return gr_publication_date.dt.year.where(gr_publication_date.notna(), earliest_years)
+
+    return clean_publication_year
+
+
+def create_clean_publisher_pandas_udf():
+    """Pandas UDF version of create_clean_publisher_udf"""
+    import pandas as pd
+
+    @F.pandas_udf(StringType())
+    def clean_publisher(publisher: pd.Series) -> pd.Series:
+        publisher = to_python_strings(publisher)
+        return publisher.str.strip().str.strip(",").where(publisher.notna() & (publisher != ""), None)
+
+    return clean_publisher
+
+
+def create_format_spl_author_pandas_udf():
+    """Pandas UDF version of create_format_spl_author_udf"""
+    import pandas as pd
+
+    def get_name_part(name_parts, index):
+        # If no row in the batch has the name part, pandas will return a float series of NaNs
+        return to_python_strings(name_parts.str[index])
+
+    def swap_name_parts(name_parts):
+        return get_name_part(name_parts, 1).str.cat(get_name_part(name_parts, 0), sep=" ")
+
+    @F.pandas_udf(StringType())
+    def format_spl_author(author: pd.Series) -> pd.Series:
+        author = to_python_strings(author)
+        author_no_years = author.str.replace(SPL_AUTHOR_YEARS_PATTERN, "", regex=True)
+        author_no_years_parts = author_no_years.str.split(", ")
+        author_parts = author.str.split(", ")
+
+        # Handle case where a year suffix has not been found. We'll only perform the swap if both
+        # name parts are under the max name length.
+        can_swap = (
+            (author_parts.str.len() == 2) &
+            (get_name_part(author_parts, 0).str.len() < SPL_AUTHOR_MAX_NAME_LEN) &
+            (get_name_part(author_parts, 1).str.len() < SPL_AUTHOR_MAX_NAME_LEN)
+        )
+        formatted = author.where(~can_swap, swap_name_parts(author_parts))
+
+        # Handle case where a year suffix has been found. Only swap when there are two parts.
+        formatted_no_years = author_no_years.where(
+            author_no_years_parts.str.len() != 2,
+            swap_name_parts(author_no_years_parts),
+        )
+        has_years = author_no_years.str.len() != author.str.len()
+        return formatted.where(~has_years, formatted_no_years)
+
+    return format_spl_author
+
+
+def create_normalize_text_pandas_udf():
+    """Pandas UDF version of create_normalize_text_udf"""
+    import pandas as pd
+
+    @F.pandas_udf(StringType())
+    def normalize_text(text: pd.Series) -> pd.Series:
+        return (
+            to_python_strings(text)
+            .str.lower()
+            .str.replace(NORMALIZE_TEXT_PARENTHESIS_PATTERN, "", regex=True)
+            .str.replace(NORMALIZE_TEXT_PUNCTUATION_PATTERN, " ", regex=True)
+            .str.replace("'", "", regex=False)
+            .str.replace(NORMALIZE_TEXT_EXTRA_SPACES_PATTERN, " ", regex=True)
+            .str.strip()
+        )
+
+    return normalize_text
+
+
+def to_python_strings(series):
+    """Converts a pandas series to Python string objects
+
+    Newer versions of pandas can infer an Arrow backed string dtype whose string functions do not
+    match the behavior of Python's str methods and re module.
+    """
+    return series.astype(object)
+
+
+def clean_title_expr(spl_title: Column, gr_title: Column) -> Column:
+    """Native Spark version of create_clean_title_udf"""
+    return (
+        F.when(gr_title.isNotNull() & (gr_title != ""), gr_title)
+        .when(spl_title.isNull() | (spl_title == ""), F.lit(None).cast(StringType()))
+        # The greedy match will capture everything before the last slash
+        .when(spl_title.contains(" / "), strip_whitespace_expr(F.regexp_extract(spl_title, r"(?s)^(.*) / ", 1)))
+        .otherwise(spl_title)
+    )
+
+
+def clean_publication_year_expr(spl_publication_year: Column, gr_publication_date: Column) -> Column:
+    """Native Spark version of create_clean_publication_year_udf
+
+    Only ASCII digits are treated as years. The Python version will also accept other Unicode
+    digits, which do not appear in the SPL data.
+    """
+    # There is no regexp_extract_all in Spark 3.0, so we replace each four digit year with
+    # itself and everything else with nothing. The years are delimited by commas, so we can
+    # split them into an array.
+    #
+    # Since the years all have four digits, string ordering is the same as numeric ordering.
+    years = F.array_remove(
+        F.split(F.regexp_replace(spl_publication_year, r"(?s)([0-9]{4})|.", "$1,"), ","),
+        "",
+    )
+    return (
+        F.when(gr_publication_date.isNotNull(), F.year(gr_publication_date))
+        .otherwise(F.array_min(years).cast(IntegerType()))
+    )
+
+
+def clean_publisher_expr(publisher: Column) -> Column:
+    """Native Spark version of create_clean_publisher_udf"""
+    return (
+        F.when(publisher.isNull() | (publisher == ""), F.lit(None).cast(StringType()))
+        .otherwise(F.regexp_replace(strip_whitespace_expr(publisher), r"^,+|,+\z", ""))
+    )
+
+
+def format_spl_author_expr(author: Column) -> Column:
+    """Native Spark version of create_format_spl_author_udf"""
+    # The (?d) flag makes "$" only match before a trailing "\n" like Python does
+    author_no_years = F.regexp_replace(author, r"(?dU), \d{4}-(\d{4})?$", "")
+    author_no_years_parts = F.split(author_no_years, ", ")
+    author_parts = F.split(author, ", ")
+    return (
+        # Handle case where a year suffix has been found.
+        F.when(
+            F.length(author_no_years) != F.length(author),
+            F.when(F.size(author_no_years_parts) == 2, swap_name_parts_expr(author_no_years_parts))
+            .otherwise(author_no_years),
+        )
+        # In the case where a year suffix has not been found, we'll be more careful.
+        .when(
+            (F.size(author_parts) == 2) &
+            (F.length(author_parts.getItem(0)) < SPL_AUTHOR_MAX_NAME_LEN) &
+            (F.length(author_parts.getItem(1)) < SPL_AUTHOR_MAX_NAME_LEN),
+            swap_name_parts_expr(author_parts),
+        )
+        .otherwise(author)
+    )
+
+
+def normalize_text_expr(text: Column) -> Column:
+    """Native Spark version of create_normalize_text_udf"""
+    # Lowercase
+    text = F.lower(text)
+
+    # Remove text in parenthesis
+    #
+    # The (?d) flag makes "." and "$" treat only "\n" as a line terminator like Python does
+    text = F.regexp_replace(text, rf"(?dU)({JAVA_WHITESPACE_PATTERN}*\(.+\){JAVA_WHITESPACE_PATTERN}*)$", "")
+
+    # Remove punctuation and digits
+    text = F.regexp_replace(text, NORMALIZE_TEXT_PUNCTUATION_PATTERN, " ")
+
+    # Remove apostrophe (special case since we don't want a space here)
+    text = F.regexp_replace(text, "'", "")
+
+    # Remove extra spaces
+    text = F.regexp_replace(text, rf"(?U){JAVA_WHITESPACE_PATTERN}{{2,}}", " ")
+    return strip_whitespace_expr(text)
+
+
+def strip_whitespace_expr(text: Column) -> Column:
+    """Strips leading and trailing whitespace the same way as Python's str.strip()
+
+    Spark's trim function only removes spaces.
+    """
+    return F.regexp_replace(text, rf"(?U)^{JAVA_WHITESPACE_PATTERN}+|{JAVA_WHITESPACE_PATTERN}+\z", "")
+
+
+def swap_name_parts_expr(name_parts: Column) -> Column:
+    """Swaps a [last name, first name] array into a "first name last name" string"""
+    return F.concat(name_parts.getItem(1), F.lit(" "), name_parts.getItem(0))
+
+
+def generate_id_expr(key: Column) -> Column:
+    """Generates a primary key ID from the natural key of a dimension
+
+    The ID is a 64-bit hash of the key, so the same key will always get the same ID. This means
+    the IDs can be generated in parallel, stay the same across runs, and can be generated for
+    bridge and fact tables without joining to the dimension table.
+
+    With a few hundred thousand keys per dimension, the chance of a hash collision is roughly
+    one in a billion. Run check_data_redshift.py to verify the IDs are unique.
+
+    Null keys will have a null ID.
+    """
+    return F.when(key.isNotNull(), F.xxhash64(key))
+
+
+def compact_key_expr(key: Column, name: str) -> Column:
+    """Converts a bib number or item barcode to its integer type in the compact schema
+
+    The key is matched before it is cast, since a cast of malformed text fails when Spark runs
+    with ANSI SQL mode.
+
+    Args:
+        key: Text key
+        name: Name of the key in COMPACT_KEY_TYPES
+
+    Returns:
+        Integer key, or null if the key does not match its pattern in COMPACT_KEY_PATTERNS. See
+        check_compact_keys.
+    """
+    return F.when(key.rlike(COMPACT_KEY_PATTERNS[name]), key.cast(COMPACT_KEY_TYPES[name]))
+
+
+def convert_compact_keys(df: DataFrame) -> DataFrame:
+    """Converts the bib number and item barcode columns of a table to the compact schema
+
+    Args:
+        df: Table with text keys
+
+    Returns:
+        Table with the same columns and integer keys. See compact_key_expr.
+    """
+    return df.select(*[
+        compact_key_expr(df[column], column).alias(column) if column in COMPACT_KEY_TYPES else df[column]
+        for column in df.columns
+    ])
+
+
+@instrument
+def check_compact_keys(df: DataFrame, table_name: str):
+    """Checks that the bib numbers and item barcodes of a table convert to integers in the compact schema
+
+    Nothing is checked in a dry run.
+
+    Args:
+        df: Table with text keys
+        table_name: Name of the table in the error
+
+    Raises:
+        ValueError: If any key does not convert. The error has the number of keys that did not
+            convert and examples of them.
+    """
+    if is_capturing_plans():
+        return
+
+    unconverted = {
+        column: df[column].isNotNull() & compact_key_expr(df[column], column).isNull()
+        for column in df.columns
+        if column in COMPACT_KEY_TYPES
+    }
+    counts_row = df.select(*[
+        F.count(F.when(is_unconverted, True)).alias(column)
+        for column, is_unconverted in unconverted.items()
+    ]).first()
+    counts = {column: counts_row[column] for column in unconverted if counts_row[column]}
+    if not counts:
+        return
+
+    lines = []
+    for column, count in counts.items():
+        examples = df.filter(unconverted[column]).select(df[column]).distinct().limit(MAX_UNCONVERTED_EXAMPLES)
+        lines.append(f"  {column}: {count}, e.g. " + ", ".join(repr(row[0]) for row in examples.collect()))
+    raise ValueError(
+        f"Keys of {table_name} that do not convert to integers in the compact schema:\n" + "\n".join(lines)
+        + "\nFix the source data or set compact_schema=false."
+    )
+
+
+@instrument
+def list_file_versions(spark: SparkSession, data_path: str) -> Dict[str, str]:
+    """Lists the files that match a data path with their size and modification time
+
+    Args:
+        spark: Spark session
+        data_path: Path to data files. Can include wildcards.
+
+    Returns:
+        Versions by fully qualified file path, sorted by path. The version of a file changes
+        when the file grows or is replaced.
+    """
+    return {
+        status.getPath().toString(): f"{status.getLen()}{PROCESSED_FILE_SEP}{status.getModificationTime()}"
+        for status in list_file_statuses(spark, data_path)
+    }
+
+
+@instrument
+def load_existing_parquet(spark: SparkSession, path: str) -> DataFrame:
+    """Loads a table that was exported by a previous run
+
+    Args:
+        spark: Spark session
+        path: Path to parquet data
+
+    Returns:
+        The exported table or None if the table has not been exported yet
+    """
+    if not path_exists(spark, path):
+        return None
+    return spark.read.parquet(path)
+
+
+@instrument
+def load_processed_files(spark: SparkSession, path: str) -> Dict[str, Set[str]]:
+    """Loads the list of data files that have already been processed
+
+    Each line has the path and version of a processed file. Lists written before the versions
+    were recorded only have the path.
+
+    Args:
+        spark: Spark session
+        path: Path to list of processed files
+
+    Returns:
+        Processed versions by fully qualified file path. The version is empty if it was not recorded.
+    """
+    if not path_exists(spark, path):
+        return {}
+    processed_files = {}
+    for row in spark.read.text(path).collect():
+        file_path, _, version = row.value.partition(PROCESSED_FILE_SEP)
+        processed_files.setdefault(file_path, set()).add(version)
+    return processed_files
+
+
+def is_processed(processed_files: Dict[str, Set[str]], path: str, version: str) -> bool:
+    """Checks if the current version of a data file has been processed
+
+    Args:
+        processed_files: Processed versions by file path. See load_processed_files.
+        path: Fully qualified file path
+        version: Current version of the file. See list_file_versions.
+
+    Returns:
+        True if the version was processed, or if the file was processed before versions were recorded
+    """
+    versions = processed_files.get(path, set())
+    return version in versions or "" in versions
+
+
+@instrument
+def output_processed_files(spark: SparkSession, file_versions: Dict[str, str], output_path: str, append: bool = False):
+    """Writes the list of data files that have been processed
+
+    Args:
+        spark: Spark session
+        file_versions: Versions by fully qualified file path. See list_file_versions.
+        output_path: Can be S3 bucket, HDFS, or local filepath
+        append: Add the files to the existing list instead of replacing it
+    """
+    if is_capturing_plans():
+        return
+    df = spark.createDataFrame(
+        [(f"{path}{PROCESSED_FILE_SEP}{version}",) for path, version in file_versions.items()],
+        "value STRING",
+    )
+    df.coalesce(1).write.mode("append" if append else "overwrite").text(output_path)
+
+
+def create_batch_id(file_versions: Dict[str, str]) -> str:
+    """Creates the ID of the batch of new rows of an incremental run
+
+    The ID is a hash of the processed file versions, so a failed run that is retried on the same
+    files writes to the same batch.
+
+    Args:
+        file_versions: Versions by fully qualified file path. See list_file_versions.
+
+    Returns:
+        Batch ID
+    """
+    text = "\n".join(f"{path}{PROCESSED_FILE_SEP}{version}" for path, version in sorted(file_versions.items()))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:BATCH_ID_LENGTH]
+
+
+def mark_batch_complete(spark: SparkSession, batch_paths: List[str]):
+    """Marks the tables of a batch of new rows as complete, so etl_redshift.py can load them
+
+    Args:
+        spark: Spark session
+        batch_paths: Paths to the tables of the batch
+    """
+    if is_capturing_plans():
+        return
+    for batch_path in batch_paths:
+        create_marker(spark, f"{batch_path}/{BATCH_COMPLETE_MARKER}")
+
+
+@instrument
+def append_parquet(spark: SparkSession, new_output_path: str, output_path: str, partition_by=None):
+    """Appends newly exported rows to an existing table
+
+    The new rows are written to their own path first, so that Redshift can load only the new
+    rows. Reading them back is cheaper than recomputing them.
+
+    Args:
+        spark: Spark session
+        new_output_path: Path to the new rows in parquet format
+        output_path: Path to the existing table in parquet format
+        partition_by: Optionally, columns the tables are partitioned by
+    """
+    if is_capturing_plans():
+        return
+    writer = spark.read.parquet(new_output_path).write.mode("append")
+    if partition_by:
+        writer = writer.partitionBy(*partition_by)
+    writer.parquet(output_path)
+
+
+def output_checkouts_parquet(df: DataFrame, output_path: str, write_options: WriteOptions, num_rows: int = None):
+    """Writes checkout data partitioned by the year and month of the checkout
+
+    Args:
+        df: Dataframe with a checkout_datetime column
+        output_path: Can be S3 bucket, HDFS, or local filepath
+        write_options: Target file and row group sizes
+        num_rows: Optionally, number of rows or an upper bound of it. See estimate_num_files.
+    """
+    df = df.select(
+        df["*"],
+        F.year(df.checkout_datetime).alias("checkout_year"),
+        F.month(df.checkout_datetime).alias("checkout_month"),
+    )
+    output_table(df, output_path, ["checkout_datetime"], write_options, CHECKOUT_PARTITION_COLUMNS, num_rows)
+
+
+@instrument
+def materialize(df: DataFrame, persist_mode: str) -> DataFrame:
+    """Materializes a dataframe that is used by several actions, so it is only computed once
+
+    Nothing is materialized in a dry run, so the captured plans show the full lineage.
+
+    Args:
+        df: Dataframe to materialize
+        persist_mode: See PERSIST_MODES
+
+    Returns:
+        Materialized dataframe. Call unpersist on it once it is no longer needed.
+    """
+    if persist_mode == "none" or is_capturing_plans():
+        return df
+    if persist_mode == "checkpoint":
+        # A checkpoint keeps the column IDs of the dataframe, so joining it back to dataframes from
+        # the same lineage fails as an ambiguous self join. Selecting the columns gives them new IDs.
+        return df.localCheckpoint(eager=True).toDF(*df.columns)
+
+    df = df.persist(PERSIST_STORAGE_LEVELS[persist_mode])
+    df.count()
+    return df
+
+
+@instrument
+def output_table(
+    df: DataFrame,
+    output_path: str,
+    sort_by: List[str],
+    write_options: WriteOptions,
+    partition_by: List[str] = None,
+    num_rows: int = None,
+):
+    """Writes a table in parquet format as sorted files of about the target size
+
+    The rows are range partitioned and sorted by the sort key, so each file and row group covers
+    a narrow range of the sort key. This lets readers skip files and row groups using the parquet
+    min/max statistics. The sort keys match the Redshift sort keys.
+
+    Unlike coalesce, the repartition is a shuffle, so the stages that compute the table keep
+    their full parallelism.
+
+    In a dry run, the plan of the table is captured instead of writing it. See plan_inspector.py.
+
+    Args:
+        df: Dataframe to write
+        output_path: Can be S3 bucket, HDFS, or local filepath
+        sort_by: Columns to sort the rows by
+        write_options: Target file and row group sizes
+        partition_by: Optionally, columns on dataframe to partition by
+        num_rows: Optionally, number of rows or an upper bound of it. See estimate_num_files.
+    """
+    if is_capturing_plans():
+        capture_plan(os.path.basename(output_path.rstrip("/")), df)
+        return
+
+    sort_by = (partition_by or []) + sort_by
+
+    num_files = estimate_num_files(df, write_options.target_file_size, num_rows)
+    output_parquet(
+        df.repartitionByRange(num_files, *sort_by).sortWithinPartitions(*sort_by),
+        output_path,
+        partition_by,
+        write_options.row_group_size,
+    )
+
+
+def estimate_num_files(df: DataFrame, target_file_size: int, num_rows: int = None) -> int:
+    """Estimates the number of files needed to write a dataframe in files of the target size
+
+    The size is estimated without running a job, see estimate_table_size. Only if Spark cannot
+    size the inputs of the table, the rows are counted and a sample of them is measured.
+
+    Args:
+        df: Dataframe to write
+        target_file_size: Target size of the files in bytes
+        num_rows: Optionally, number of rows or an upper bound of it, e.g. the count of the
+            materialized dataframe the table is built from
+
+    Returns:
+        Number of files to write
+    """
+    size_in_bytes = estimate_table_size(df, num_rows)
+    if size_in_bytes is None:
+        size_in_bytes = (df.count() if num_rows is None else num_rows) * estimate_row_size(df)
+    return max(1, math.ceil(size_in_bytes / target_file_size))
+
+
+def estimate_table_size(df: DataFrame, num_rows: int = None) -> Union[int, None]:
+    """Estimates the size of a dataframe from Spark's plan statistics
+
+    If the number of rows is known, from the caller or from the statistics, the size is the rows
+    times Spark's default size of a row of the schema. Otherwise it is Spark's size estimate,
+    capped by the size of the inputs of the plan, since Spark multiplies the sizes of joined
+    tables. The sizes are the sizes of the values before compression, so the files tend to be
+    smaller than the target size.
+
+    Args:
+        df: Dataframe
+        num_rows: Optionally, number of rows or an upper bound of it
+
+    Returns:
+        Size in bytes, or None if Spark cannot size the inputs
+    """
+    plan = df._jdf.queryExecution().optimizedPlan()
+    stats = plan.stats()
+    if num_rows is None and stats.rowCount().isDefined():
+        num_rows = int(str(stats.rowCount().get()))
+    if num_rows is not None:
+        return num_rows * df._jdf.schema().defaultSize()
+
+    leaves = plan.collectLeaves()
+    input_size = sum(int(str(leaves.apply(i).stats().sizeInBytes())) for i in range(leaves.size()))
+    if input_size >= UNKNOWN_SIZE_IN_BYTES:
+        return None
+    return min(int(str(stats.sizeInBytes())), input_size)
+
+
+def estimate_row_size(df: DataFrame) -> float:
+    """Estimates the average size of the rows of a dataframe from a sample of the rows
+
+    Args:
+        df: Dataframe
+
+    Returns:
+        Average row size in bytes. 0 if the dataframe is empty.
+    """
+    sample_df = df.limit(ROW_SIZE_SAMPLE_ROWS)
+    value_sizes = [
+        F.coalesce(F.length(sample_df[field.name]), F.lit(0))
+        if isinstance(field.dataType, (StringType, BinaryType))
+        else F.lit(FIXED_VALUE_SIZES.get(type(field.dataType), DEFAULT_VALUE_SIZE))
+        for field in sample_df.schema.fields
+    ]
+    return sample_df.select(F.avg(sum(value_sizes, F.lit(0)))).first()[0] or 0.0
 
 
-def output_parquet(df, output_path, partition_by=None):
+def output_parquet(df, output_path, partition_by=None, row_group_size=None):
     """Writes dataframe in parquet format
 
     Args:
         df: Dateframe to write
         output_path: Can be S3 bucket, HDFS, or local filepath
         partition_by: Optionally, columns on dateframe to partition by
+        row_group_size: Optionally, size of the parquet row groups in bytes
     """
     writer = df.write.mode("overwrite")
     if partition_by:
         writer = writer.partitionBy(*partition_by)
+    if row_group_size:
+        writer = writer.option("parquet.block.size", row_group_size)
     writer.parquet(output_path)
 
 
@@ -0,0 +1,526 @@
+"""
+Generates synthetic SPL, Goodreads, weather, and publisher map data for benchmarking the ETL.
+
+The files have the same layout as the raw data read by etl_spark.py:
+
+- SPL checkouts: One CSV per year with the MM/dd/yyyy hh:mm:ss a checkout timestamps
+- SPL inventory: Comma joined ISBNs and subjects, and SPL formatted authors and publication years
+- SPL data dictionary: Item type and collection codes
+- Goodreads: Including the padded "  num_pages" header
+- Weather: Whitespace delimited month, day, year, and temperature, with -99 for missing days
+- Publisher map: Raw SPL publisher to official publisher
+
+The rows are generated by Spark from hashes of the row numbers, so the same arguments always
+generate the same data and large scales can be generated on a cluster. Like the real data, a
+few popular books have far more checkouts than the rest, some checkouts are for books that are
+not in the inventory, and only some of the books can be linked to Goodreads.
+
+Example:
+    spark-submit generate_synthetic_data.py s3://bucket/synthetic/50M --num-checkouts 50M
+"""
+import argparse
+import calendar
+import csv
+import io
+import math
+import re
+import zlib
+from typing import List
+
+from pyspark.sql import SparkSession
+import pyspark.sql.functions as F
+from pyspark.sql.column import Column
+from pyspark.sql.dataframe import DataFrame
+
+from etl_spark import DEFAULT_WEATHER_STATION_ID, WEATHER_MISSING_TEMPERATURE, normalize_isbn_expr
+
+
+# Paths of the generated data relative to the output path. The checkouts are written as one
+# directory of CSV files per year.
+CHECKOUTS_PATH = "spl/checkouts"
+CHECKOUTS_FILE_PATTERN = "*/*.csv"
+INVENTORY_PATH = "spl/inventory"
+DATA_DICT_PATH = "spl/data_dictionary.csv"
+GOODREADS_PATH = "goodreads"
+WEATHER_PATH = f"weather/{DEFAULT_WEATHER_STATION_ID}.txt"
+PUBLISHERS_PATH = "publishers/publishers_map.csv"
+
+DEFAULT_NUM_CHECKOUTS = 1000000
+DEFAULT_START_YEAR = 2012
+DEFAULT_END_YEAR = 2017
+DEFAULT_SEED = 0
+
+# The real data has about 100 checkouts per book in the inventory and one inventory row per
+# book per library location
+CHECKOUTS_PER_BOOK = 100
+MIN_NUM_BOOKS = 1000
+INVENTORY_ROWS_PER_BOOK = 3
+
+# Checkouts of books that are not in the inventory
+ORPHAN_CHECKOUT_PERCENT = 2
+
+# Books that can be linked to Goodreads. The same number of Goodreads books do not match any book.
+GOODREADS_MATCH_PERCENT = 5
+
+# Checkouts are picked with u^SKEW_EXPONENT for a uniform u, so the books with the lowest bib
+# numbers are the most popular
+POPULARITY_SKEW_EXPONENT = 3
+
+# The checkouts are written in files of about this many rows
+CHECKOUTS_PER_FILE = 2000000
+
+MISSING_TEMPERATURE_PERCENT = 2
+
+BIB_NUM_OFFSET = 1000
+
+# Item type code, description, format group, format subgroup, and share of the books
+ITEM_TYPES = [
+    ("acbk", "Book: Adult/YA", "Print", "Book", 50),
+    ("jcbk", "Book: Juv", "Print", "Book", 25),
+    ("arbk", "Book: Ref", "Print", "Book", 5),
+    ("acdvd", "DVD: Adult/YA", "Media", "Video Disc", 10),
+    ("accd", "CD: Adult/YA", "Media", "Audio Disc", 5),
+    ("acmag", "Magazine: Adult/YA", "Print", "Periodical", 5),
+]
+ITEM_COLLECTIONS = [
+    ("nafic", "Adult Fiction"),
+    ("nanf", "Adult Nonfiction"),
+    ("ncfic", "Children's Fiction"),
+    ("nynf", "Teen Nonfiction"),
+]
+ITEM_LOCATIONS = ["cen", "bal", "qna", "nga", "dth", "lcy", "glk", "bea"]
+
+FIRST_NAMES = [
+    "Mary", "James", "Patricia", "John", "Jennifer", "Robert", "Linda", "Michael", "Elizabeth", "William",
+    "Barbara", "David", "Susan", "Richard", "Jessica", "Joseph", "Sarah", "Thomas", "Karen", "Charles",
+]
+LAST_NAMES = [
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+    "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+    "Lee", "Perez", "Thompson", "White", "Harris", "Sanchez", "Clark", "Ramirez", "Lewis", "Robinson",
+]
+CORPORATE_AUTHORS = [
+    "United States. Congress. House",
+    "United States. Maritime Commission",
+    "Seattle (Wash.). Office of Planning",
+    "Lonely Planet Publications (Firm)",
+    "Marvel Comics Group",
+]
+TITLE_WORDS = [
+    "river", "night", "garden", "stars", "city", "winter", "house", "secret", "ocean", "mountain",
+    "summer", "shadow", "island", "forest", "letters", "storm", "daughter", "kingdom", "road", "fire",
+]
+SUBTITLES = ["a novel", "a memoir", "stories", "a history", "a guide", "poems", "a mystery"]
+SUBJECTS = [
+    "Fiction", "Mystery fiction", "Detective and mystery stories", "Historical fiction", "Science fiction",
+    "Fantasy fiction", "Love stories", "Biographies", "History", "Cooking", "Travel", "Picture books",
+    "Graphic novels", "Seattle (Wash.) -- History", "Young adult fiction", "Humorous stories",
+]
+# Raw SPL publisher and official publisher. Raw publishers without an official publisher are
+# not in the publisher map.
+PUBLISHERS = [
+    ("Knopf,", "Alfred A. Knopf"),
+    ("Alfred A. Knopf,", "Alfred A. Knopf"),
+    ("Knopf : Distributed by Random House,", "Alfred A. Knopf"),
+    ("Random House,", "Random House"),
+    ("Random House, Inc.,", "Random House"),
+    ("Bloomsbury,", "Bloomsbury Publishing"),
+    ("Bloomsbury Pub.,", "Bloomsbury Publishing"),
+    ("Scholastic Press,", "Scholastic Corporation"),
+    ("Scholastic,", "Scholastic Corporation"),
+    ("HarperCollins,", "HarperCollins"),
+    ("Harper,", "HarperCollins"),
+    ("Little, Brown,", "Little, Brown and Company"),
+    ("Penguin Books,", "Penguin Books"),
+    ("Viking,", "Viking Press"),
+    ("Sasquatch Books,", None),
+    ("Seattle Public Library,", None),
+    ("Fantagraphics Books,", None),
+]
+LANGUAGE_CODES = ["eng", "eng", "eng", "en-US", "spa", "fre"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic input data for the ETL")
+    parser.add_argument("output_path", help="Path to write the data to. Can be S3, local, etc")
+    parser.add_argument(
+        "--num-checkouts",
+        type=parse_count,
+        default=DEFAULT_NUM_CHECKOUTS,
+        help="Number of checkouts, e.g. 1M, 50M, or 500M",
+    )
+    parser.add_argument("--start-year", type=int, default=DEFAULT_START_YEAR)
+    parser.add_argument("--end-year", type=int, default=DEFAULT_END_YEAR)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    args = parser.parse_args()
+
+    spark = SparkSession.builder.appName("SPL-Generate-Synthetic-Data").getOrCreate()
+    try:
+        generate_synthetic_data(spark, args.output_path, args.num_checkouts, args.start_year, args.end_year, args.seed)
+    finally:
+        spark.stop()
+
+
+def parse_count(text: str) -> int:
+    """Parses a count with an optional K or M suffix, e.g. 50M
+
+    Args:
+        text: Count
+
+    Returns:
+        Count as an integer
+    """
+    match = re.fullmatch(r"(\d+)([KkMm]?)", text.strip())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Invalid count: {text}")
+    multiplier = {"": 1, "k": 1000, "m": 1000000}[match.group(2).lower()]
+    return int(match.group(1)) * multiplier
+
+
+def generate_synthetic_data(
+    spark: SparkSession,
+    output_path: str,
+    num_checkouts: int,
+    start_year: int = DEFAULT_START_YEAR,
+    end_year: int = DEFAULT_END_YEAR,
+    seed: int = DEFAULT_SEED,
+):
+    """Generates all of the synthetic input data
+
+    Args:
+        spark: Spark session
+        output_path: Path to write the data to. Can be S3, local, etc
+        num_checkouts: Number of checkouts
+        start_year: First year of checkouts
+        end_year: Last year of checkouts
+        seed: Different seeds generate different data
+    """
+    output_path = output_path.rstrip("/")
+    num_books = max(MIN_NUM_BOOKS, num_checkouts // CHECKOUTS_PER_BOOK)
+    years = list(range(start_year, end_year + 1))
+
+    print(f"Generating {num_checkouts} checkouts of {num_books} books from {start_year} to {end_year}...")
+    books_df = generate_books(spark, 0, num_books, seed)
+
+    write_text_file(spark, f"{output_path}/{DATA_DICT_PATH}", generate_data_dict_csv())
+    write_csv(generate_inventory(books_df, seed), f"{output_path}/{INVENTORY_PATH}", max(1, num_books // 1000000))
+    write_csv(generate_goodreads(spark, books_df, num_books, seed), f"{output_path}/{GOODREADS_PATH}", 1)
+    write_text_file(spark, f"{output_path}/{WEATHER_PATH}", generate_weather_text(years, seed))
+    write_text_file(spark, f"{output_path}/{PUBLISHERS_PATH}", generate_publishers_map_csv())
+
+    checkouts_per_year = num_checkouts // len(years)
+    for i, year in enumerate(years):
+        # The last year gets the remainder, so the total is exactly num_checkouts
+        num_year_checkouts = checkouts_per_year + (num_checkouts % len(years) if i == len(years) - 1 else 0)
+        checkouts_df = generate_checkouts(spark, num_books, year, i * checkouts_per_year, num_year_checkouts, seed)
+        write_csv(
+            checkouts_df,
+            f"{output_path}/{CHECKOUTS_PATH}/Checkouts_By_Title_Data_Lens_{year}",
+            max(1, num_year_checkouts // CHECKOUTS_PER_FILE),
+        )
+
+
+def hash_expr(seed: int, salt: str, *columns: Column) -> Column:
+    """Hashes columns into a non-negative number that is different for each salt and seed"""
+    return F.abs(F.xxhash64(F.lit(seed), F.lit(salt), *columns))
+
+
+def pick_expr(values: List, seed: int, salt: str, *columns: Column) -> Column:
+    """Picks one of the values by the hash of the columns"""
+    index = (hash_expr(seed, salt, *columns) % len(values)).cast("int") + 1
+    return F.element_at(F.array(*[F.lit(value) for value in values]), index)
+
+
+def percent_expr(seed: int, salt: str, *columns: Column) -> Column:
+    """Uniform number from 0 to 99 from the hash of the columns"""
+    return hash_expr(seed, salt, *columns) % 100
+
+
+def item_type_expr(bib_num: Column, seed: int) -> Column:
+    """Item type of a book, weighted by the share of each item type"""
+    weighted_item_types = [code for code, _, _, _, share in ITEM_TYPES for _ in range(share)]
+    return pick_expr(weighted_item_types, seed, "item_type", bib_num)
+
+
+def generate_books(spark: SparkSession, first_book: int, num_books: int, seed: int) -> DataFrame:
+    """Generates one row per book with the attributes shared by its inventory rows
+
+    The attributes are generated from the bib number, so a book is the same in every dataset.
+
+    Args:
+        spark: Spark session
+        first_book: Index of the first book
+        num_books: Number of books
+        seed: Different seeds generate different books
+
+    Returns:
+        - Books dataframe
+        - Columns: bib_num, isbn_10, isbn_13, title, author, publication_year, publisher, subjects, item_type
+    """
+    ids_df = spark.range(first_book, first_book + num_books)
+    bib_num = (ids_df.id + BIB_NUM_OFFSET).cast("string")
+
+    first_name = pick_expr(FIRST_NAMES, seed, "first_name", bib_num)
+    last_name = pick_expr(LAST_NAMES, seed, "last_name", bib_num)
+    birth_year = (hash_expr(seed, "birth_year", bib_num) % 80 + 1900).cast("string")
+    author_format = percent_expr(seed, "author_format", bib_num)
+    author = (
+        # Personal names are formatted as last name, first name with optional years
+        F.when(author_format < 50, F.concat_ws(", ", last_name, first_name))
+        .when(author_format < 70, F.concat(last_name, F.lit(", "), first_name, F.lit(", "), birth_year, F.lit("-")))
+        .when(
+            author_format < 80,
+            F.concat(last_name, F.lit(", "), first_name, F.lit(", "), birth_year, F.lit("-"), (birth_year + 70).cast("int")),
+        )
+        .when(author_format < 90, pick_expr(CORPORATE_AUTHORS, seed, "corporate_author", bib_num))
+    )
+
+    title_words = F.concat_ws(
+        " ",
+        F.initcap(pick_expr(TITLE_WORDS, seed, "title_word_1", bib_num)),
+        pick_expr(["of the", "and the", "in the", "beyond the"], seed, "title_join", bib_num),
+        pick_expr(TITLE_WORDS, seed, "title_word_2", bib_num),
+    )
+    title = F.concat(
+        title_words,
+        F.lit(" : "),
+        pick_expr(SUBTITLES, seed, "subtitle", bib_num),
+        F.lit(" / "),
+        F.concat_ws(" ", first_name, last_name),
+        F.lit("."),
+    )
+
+    year = (hash_expr(seed, "publication_year", bib_num) % 60 + 1960).cast("string")
+    year_format = percent_expr(seed, "year_format", bib_num)
+    publication_year = (
+        F.when(year_format < 60, F.concat(year, F.lit(".")))
+        .when(year_format < 75, F.concat(F.lit("c"), year, F.lit(".")))
+        .when(year_format < 85, F.concat(F.lit("["), year, F.lit("]")))
+        .when(year_format < 95, F.concat(year, F.lit(", c"), (year - 2).cast("int"), F.lit(".")))
+    )
+
+    subjects = F.concat_ws(
+        ", ",
+        pick_expr(SUBJECTS, seed, "subject_1", bib_num),
+        F.when(percent_expr(seed, "subject_count", bib_num) < 60, pick_expr(SUBJECTS, seed, "subject_2", bib_num)),
+        F.when(percent_expr(seed, "subject_count", bib_num) < 20, pick_expr(SUBJECTS, seed, "subject_3", bib_num)),
+    )
+
+    # ISBN-10s use the bib number as the first nine digits. The inventory can list them as an
+    # ISBN-10, an ISBN-13, or both.
+    isbn_10 = F.concat(F.lpad(bib_num, 9, "0"), (hash_expr(seed, "isbn_check", bib_num) % 10).cast("string"))
+
+    return ids_df.select(
+        bib_num.alias("bib_num"),
+        isbn_10.alias("isbn_10"),
+        normalize_isbn_expr(isbn_10).alias("isbn_13"),
+        title.alias("title"),
+        author.alias("author"),
+        publication_year.alias("publication_year"),
+        pick_expr([publisher for publisher, _ in PUBLISHERS], seed, "publisher", bib_num).alias("publisher"),
+        subjects.alias("subjects"),
+        item_type_expr(bib_num, seed).alias("item_type"),
+    )
+
+
+def generate_inventory(books_df: DataFrame, seed: int) -> DataFrame:
+    """Generates the SPL inventory with a row for each location of a book
+
+    Returns:
+        Dataframe with the columns of the SPL inventory CSV
+    """
+    inventory_df = books_df.withColumn("copy", F.explode(F.sequence(F.lit(1), F.lit(INVENTORY_ROWS_PER_BOOK))))
+    isbn_format = percent_expr(seed, "isbn_format", inventory_df.bib_num)
+    isbns = (
+        F.when(isbn_format < 40, F.concat_ws(", ", inventory_df.isbn_13, inventory_df.isbn_10))
+        .when(isbn_format < 70, inventory_df.isbn_13)
+        .when(isbn_format < 95, inventory_df.isbn_10)
+    )
+    return inventory_df.select(
+        inventory_df.bib_num.alias("BibNum"),
+        inventory_df.title.alias("Title"),
+        inventory_df.author.alias("Author"),
+        isbns.alias("ISBN"),
+        inventory_df.publication_year.alias("PublicationYear"),
+        inventory_df.publisher.alias("Publisher"),
+        inventory_df.subjects.alias("Subjects"),
+        inventory_df.item_type.alias("ItemType"),
+        pick_expr([code for code, _ in ITEM_COLLECTIONS], seed, "collection", inventory_df.bib_num).alias("ItemCollection"),
+        pick_expr(["Floating", "NA"], seed, "floating", inventory_df.bib_num).alias("FloatingItem"),
+        pick_expr(ITEM_LOCATIONS, seed, "location", inventory_df.bib_num, inventory_df.copy).alias("ItemLocation"),
+        F.lit("09/01/2017").alias("ReportDate"),
+        (hash_expr(seed, "item_count", inventory_df.bib_num, inventory_df.copy) % 3 + 1).alias("ItemCount"),
+    )
+
+
+def generate_goodreads(spark: SparkSession, books_df: DataFrame, num_books: int, seed: int) -> DataFrame:
+    """Generates the Goodreads books for some of the SPL books and some other books
+
+    Returns:
+        Dataframe with the columns of the Goodreads CSV
+    """
+    matched_df = books_df.filter(percent_expr(seed, "goodreads", books_df.bib_num) < GOODREADS_MATCH_PERCENT)
+
+    # Books with bib numbers beyond the inventory and the orphan checkouts do not match any SPL book
+    other_books_df = generate_books(spark, 2 * num_books, num_books * GOODREADS_MATCH_PERCENT // 100, seed)
+
+    goodreads_books_df = matched_df.unionByName(other_books_df)
+    bib_num = goodreads_books_df.bib_num
+    co_author = F.concat_ws(
+        " ",
+        pick_expr(FIRST_NAMES, seed, "co_author_first_name", bib_num),
+        pick_expr(LAST_NAMES, seed, "co_author_last_name", bib_num),
+    )
+    authors = F.concat_ws(
+        "/",
+        F.concat_ws(
+            " ",
+            pick_expr(FIRST_NAMES, seed, "first_name", bib_num),
+            pick_expr(LAST_NAMES, seed, "last_name", bib_num),
+        ),
+        F.when(percent_expr(seed, "co_author", bib_num) < 15, co_author),
+    )
+    publication_date = F.concat_ws(
+        "/",
+        (hash_expr(seed, "gr_month", bib_num) % 12 + 1).cast("string"),
+        (hash_expr(seed, "gr_day", bib_num) % 28 + 1).cast("string"),
+        (hash_expr(seed, "publication_year", bib_num) % 60 + 1960).cast("string"),
+    )
+    ratings_count = hash_expr(seed, "ratings_count", bib_num) % 100000
+    return goodreads_books_df.select(
+        (bib_num.cast("int") - BIB_NUM_OFFSET + 1).alias("bookID"),
+        F.regexp_replace(goodreads_books_df.title, r" / .*$", "").alias("title"),
+        authors.alias("authors"),
+        F.round(hash_expr(seed, "rating", bib_num) % 300 / 100 + 2, 2).alias("average_rating"),
+        goodreads_books_df.isbn_10.alias("isbn"),
+        goodreads_books_df.isbn_13.alias("isbn13"),
+        pick_expr(LANGUAGE_CODES, seed, "language", bib_num).alias("language_code"),
+        (hash_expr(seed, "num_pages", bib_num) % 900 + 32).alias("  num_pages"),
+        ratings_count.alias("ratings_count"),
+        (ratings_count / 20).cast("int").alias("text_reviews_count"),
+        publication_date.alias("publication_date"),
+        F.regexp_replace(goodreads_books_df.publisher, r",$", "").alias("publisher"),
+    )
+
+
+def generate_checkouts(
+    spark: SparkSession,
+    num_books: int,
+    year: int,
+    first_id: int,
+    num_checkouts: int,
+    seed: int,
+) -> DataFrame:
+    """Generates the checkouts of a year
+
+    Popular books have far more checkouts than the rest, and some checkouts are of books that
+    are not in the inventory.
+
+    Returns:
+        Dataframe with the columns of the SPL checkouts CSV
+    """
+    ids_df = spark.range(first_id, first_id + num_checkouts, numPartitions=max(1, num_checkouts // CHECKOUTS_PER_FILE))
+    checkout_id = ids_df.id
+
+    uniform = hash_expr(seed, "popularity", checkout_id) % 1000000 / 1000000
+    book_index = F.floor(F.pow(uniform, POPULARITY_SKEW_EXPONENT) * num_books)
+    orphan_index = num_books + hash_expr(seed, "orphan", checkout_id) % num_books
+    bib_num = (
+        F.when(percent_expr(seed, "orphan_checkout", checkout_id) < ORPHAN_CHECKOUT_PERCENT, orphan_index)
+        .otherwise(book_index)
+        + BIB_NUM_OFFSET
+    ).cast("string")
+
+    # Checkouts are recorded to the minute
+    seconds_in_year = (366 if calendar.isleap(year) else 365) * 24 * 60 * 60
+    checkout_seconds = hash_expr(seed, "checkout_time", checkout_id) % (seconds_in_year // 60) * 60
+    checkout_datetime = F.to_timestamp(
+        F.from_unixtime(F.unix_timestamp(F.lit(f"{year}-01-01 00:00:00")) + checkout_seconds)
+    )
+
+    return ids_df.select(
+        bib_num.alias("BibNumber"),
+        F.concat(F.lit("0010"), F.lpad(bib_num, 9, "0")).alias("ItemBarcode"),
+        item_type_expr(bib_num, seed).alias("ItemType"),
+        pick_expr([code for code, _ in ITEM_COLLECTIONS], seed, "collection", bib_num).alias("Collection"),
+        F.lit(None).cast("string").alias("CallNumber"),
+        F.date_format(checkout_datetime, "MM/dd/yyyy hh:mm:ss a").alias("CheckoutDateTime"),
+    )
+
+
+def generate_data_dict_csv() -> str:
+    """Generates the SPL data dictionary with the item type and item collection codes"""
+    rows = [["Code", "Description", "Code Type", "Format Group", "Format Subgroup", "Category Group", "Category Subgroup"]]
+    rows += [
+        [code, description, "ItemType", format_group, format_subgroup, "", ""]
+        for code, description, format_group, format_subgroup, _ in ITEM_TYPES
+    ]
+    rows += [[code, description, "ItemCollection", "", "", "", ""] for code, description in ITEM_COLLECTIONS]
+    return to_csv(rows)
+
+
+def generate_publishers_map_csv() -> str:
+    """Generates the map of raw SPL publishers to official publishers"""
+    return to_csv([[publisher, official_publisher] for publisher, official_publisher in PUBLISHERS if official_publisher])
+
+
+def generate_weather_text(years: List[int], seed: int) -> str:
+    """Generates the daily temperatures of the weather station
+
+    Each line has the month, day, year, and average temperature padded with spaces. Some days
+    are missing the temperature.
+    """
+    lines = []
+    for year in years:
+        for month in range(1, 13):
+            for day in range(1, calendar.monthrange(year, month)[1] + 1):
+                # Seattle temperatures from about 40F in January to 65F in July, with some noise
+                day_hash = zlib.crc32(f"{seed}-{year}-{month}-{day}".encode("utf-8"))
+                temperature = 52.5 - 12.5 * math.cos(2 * math.pi * (month - 1) / 12) + day_hash % 100 / 10 - 5
+                if day_hash // 100 % 100 < MISSING_TEMPERATURE_PERCENT:
+                    temperature = WEATHER_MISSING_TEMPERATURE
+                lines.append(f"{month:4d}{day:4d}{year:6d}{temperature:6.1f}")
+    return "\n".join(lines) + "\n"
+
+
+def to_csv(rows: List[List[str]]) -> str:
+    """Formats rows as CSV text"""
+    text = io.StringIO()
+    csv.writer(text, lineterminator="\n").writerows(rows)
+    return text.getvalue()
+
+
+def write_csv(df: DataFrame, output_path: str, num_files: int):
+    """Writes a dataframe as CSV files with a header
+
+    Leading and trailing whitespace is kept, so the padded Goodreads header is written as is.
+    """
+    (
+        df.repartition(num_files)
+        .write
+        .mode("overwrite")
+        .option("header", "true")
+        .option("ignoreLeadingWhiteSpace", "false")
+        .option("ignoreTrailingWhiteSpace", "false")
+        .csv(output_path)
+    )
+
+
+def write_text_file(spark: SparkSession, output_path: str, text: str):
+    """Writes text to a single file
+
+    Args:
+        spark: Spark session
+        output_path: Path of the file. Can be S3, local, etc
+        text: Content of the file
+    """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(output_path)
+    stream = hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()).create(hadoop_path, True)
+    try:
+        stream.write(bytearray(text.encode("utf-8")))
+    finally:
+        stream.close()
+
+
+if __name__ == "__main__":
+    main()
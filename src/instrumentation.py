@@ -0,0 +1,322 @@
+"""
+Records where the time goes in an ETL run and compares the run reports of two runs.
+
+The ETL functions are wrapped with instrument, which records the wall time of each call. The
+Spark jobs started by a call are tagged with a job description that identifies the call. At the
+end of the run, the jobs and their stage metrics (shuffle read/write, spill, input and output
+records) are looked up in Spark's monitoring REST API and added to the calls in a JSON report.
+
+Comparing two reports, e.g. from two releases, flags the functions that got slower:
+
+    python instrumentation.py old-report.json new-report.json
+"""
+import argparse
+import functools
+import json
+import re
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List
+from urllib.request import urlopen
+
+from pyspark.sql import SparkSession
+
+
+# Stage metrics from the Spark monitoring REST API that are added to the report
+STAGE_METRICS = [
+    "executorRunTime",
+    "inputBytes",
+    "inputRecords",
+    "outputBytes",
+    "outputRecords",
+    "shuffleReadBytes",
+    "shuffleReadRecords",
+    "shuffleWriteBytes",
+    "shuffleWriteRecords",
+    "memoryBytesSpilled",
+    "diskBytesSpilled",
+]
+
+# Metrics that are compared between reports. Wall time is in seconds.
+COMPARED_METRICS = ["wall_time", "shuffleReadBytes", "shuffleWriteBytes", "diskBytesSpilled"]
+
+# Smallest value of each compared metric that is flagged as a regression, so that noise in small
+# values is ignored
+DEFAULT_REGRESSION_FLOORS = {
+    "wall_time": 1.0,
+    "shuffleReadBytes": 1024 * 1024,
+    "shuffleWriteBytes": 1024 * 1024,
+    "diskBytesSpilled": 1024 * 1024,
+}
+DEFAULT_REGRESSION_THRESHOLD = 0.2
+
+# The call ID is added to the end of the description of the Spark jobs started by the call
+JOB_DESCRIPTION_CALL_ID_PATTERN = r"#(\d+)$"
+
+_spark = None
+_calls = []
+_calls_lock = threading.Lock()
+_call_stack = threading.local()
+
+
+def enable_instrumentation(spark: SparkSession):
+    """Starts recording the calls of the instrumented functions
+
+    Args:
+        spark: Spark session that runs the jobs of the instrumented functions
+    """
+    global _spark
+    _spark = spark
+    with _calls_lock:
+        _calls.clear()
+
+
+def instrument(func: Callable) -> Callable:
+    """Records the wall time and Spark jobs of each call of a function
+
+    Does nothing until enable_instrumentation is called.
+
+    Args:
+        func: Function to instrument
+
+    Returns:
+        Instrumented function
+    """
+    @functools.wraps(func)
+    def instrumented(*args, **kwargs):
+        if _spark is None:
+            return func(*args, **kwargs)
+
+        sc = _spark.sparkContext
+        if not hasattr(_call_stack, "calls"):
+            _call_stack.calls = []
+        stack = _call_stack.calls
+        with _calls_lock:
+            call = {
+                "id": len(_calls),
+                "parent_id": stack[-1]["id"] if stack else None,
+                "function": func.__name__,
+                "stage": sc.getLocalProperty("spark.scheduler.pool"),
+            }
+            _calls.append(call)
+
+        previous_description = sc.getLocalProperty("spark.job.description")
+        sc.setJobDescription(f"{call['stage'] or 'main'}: {func.__name__} #{call['id']}")
+        stack.append(call)
+        call["start"] = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            call["end"] = time.time()
+            call["wall_time"] = call["end"] - call["start"]
+            stack.pop()
+            sc.setLocalProperty("spark.job.description", previous_description)
+
+    return instrumented
+
+
+def create_run_report(spark: SparkSession, status: str, settings: Dict[str, str] = None) -> Dict[str, Any]:
+    """Creates the report of the instrumented calls of the run
+
+    The job and stage metrics are only available when the Spark UI is enabled.
+
+    Args:
+        spark: Spark session
+        status: Status of the run, e.g. succeeded or failed
+        settings: Settings of the run
+
+    Returns:
+        Run report
+    """
+    sc = spark.sparkContext
+    with _calls_lock:
+        calls = [dict(call) for call in _calls]
+
+    jobs, stages = [], []
+    if sc.uiWebUrl:
+        api_url = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}"
+        with urlopen(f"{api_url}/jobs") as response:
+            jobs = json.load(response)
+        with urlopen(f"{api_url}/stages") as response:
+            stages = json.load(response)
+    else:
+        print("The Spark UI is disabled, so the run report does not include job and stage metrics.")
+
+    # Sum the attempts of each stage
+    stage_metrics = {}
+    for stage in stages:
+        metrics = stage_metrics.setdefault(stage["stageId"], dict.fromkeys(STAGE_METRICS, 0))
+        for metric in STAGE_METRICS:
+            metrics[metric] += stage.get(metric, 0)
+
+    calls_by_id = {call["id"]: call for call in calls}
+    for call in calls:
+        call["job_ids"], call["stage_ids"] = [], []
+        call["metrics"] = dict.fromkeys(STAGE_METRICS, 0)
+
+    # A stage that is reused by a later job is listed as skipped in that job, so each stage is
+    # attributed to the first job that lists it
+    attributed_stage_ids = set()
+    for job in sorted(jobs, key=lambda job: job["jobId"]):
+        match = re.search(JOB_DESCRIPTION_CALL_ID_PATTERN, job.get("description", ""))
+        call = calls_by_id.get(int(match.group(1))) if match else None
+        if call is None:
+            continue
+        call["job_ids"].append(job["jobId"])
+        for stage_id in job["stageIds"]:
+            if stage_id in attributed_stage_ids or stage_id not in stage_metrics:
+                continue
+            attributed_stage_ids.add(stage_id)
+            call["stage_ids"].append(stage_id)
+            for metric, value in stage_metrics[stage_id].items():
+                call["metrics"][metric] += value
+
+    # The total metrics of a call include the metrics of the calls it made
+    for call in calls:
+        call["total_metrics"] = dict(call["metrics"])
+    for call in sorted(calls, key=lambda call: call["id"], reverse=True):
+        parent = calls_by_id.get(call["parent_id"])
+        if parent is not None:
+            for metric, value in call["total_metrics"].items():
+                parent["total_metrics"][metric] += value
+
+    return {
+        "app_id": sc.applicationId,
+        "app_name": sc.appName,
+        "status": status,
+        "settings": settings or {},
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "calls": calls,
+    }
+
+
+def output_run_report(spark: SparkSession, report: Dict[str, Any], output_path: str) -> str:
+    """Writes the run report as a JSON file
+
+    Args:
+        spark: Spark session
+        report: Run report
+        output_path: Directory of the run reports. Can be S3 bucket, HDFS, or local filepath.
+
+    Returns:
+        Path of the report file
+    """
+    report_path = "{}/{}-{}.json".format(
+        output_path.rstrip("/"),
+        time.strftime("%Y%m%dT%H%M%SZ", time.gmtime()),
+        report["app_id"],
+    )
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(report_path)
+    stream = hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()).create(hadoop_path, True)
+    try:
+        stream.write(bytearray(json.dumps(report, indent=2).encode("utf-8")))
+    finally:
+        stream.close()
+    return report_path
+
+
+def summarize_calls(report: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    """Sums the metrics of the calls of each function
+
+    Args:
+        report: Run report
+
+    Returns:
+        Number of calls, wall time, and total metrics by function name
+    """
+    summary = {}
+    for call in report["calls"]:
+        function_summary = summary.setdefault(call["function"], {"calls": 0, "wall_time": 0.0})
+        function_summary["calls"] += 1
+        function_summary["wall_time"] += call.get("wall_time", 0.0)
+        for metric, value in call.get("total_metrics", {}).items():
+            function_summary[metric] = function_summary.get(metric, 0) + value
+    return summary
+
+
+def compare_run_reports(
+    old_report: Dict[str, Any],
+    new_report: Dict[str, Any],
+    threshold: float = DEFAULT_REGRESSION_THRESHOLD,
+) -> List[Dict[str, Any]]:
+    """Compares the metrics of each function between two run reports
+
+    Args:
+        old_report: Report of the baseline run
+        new_report: Report of the run to check
+        threshold: Relative increase of a metric that is flagged as a regression
+
+    Returns:
+        Comparison of each metric of each function, flagged if the metric regressed
+    """
+    old_summary = summarize_calls(old_report)
+    new_summary = summarize_calls(new_report)
+
+    rows = []
+    for function in sorted(old_summary.keys() | new_summary.keys()):
+        for metric in COMPARED_METRICS:
+            old_value = old_summary.get(function, {}).get(metric, 0)
+            new_value = new_summary.get(function, {}).get(metric, 0)
+            change = (new_value - old_value) / old_value if old_value else None
+            rows.append({
+                "function": function,
+                "metric": metric,
+                "old": old_value,
+                "new": new_value,
+                "change": change,
+                "regression": (
+                    new_value >= DEFAULT_REGRESSION_FLOORS[metric]
+                    and (change is None or change > threshold)
+                    and new_value > old_value
+                ),
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the run reports of two ETL runs")
+    parser.add_argument("old_report", help="Run report of the baseline run")
+    parser.add_argument("new_report", help="Run report of the run to check")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_REGRESSION_THRESHOLD,
+        help="Relative increase of a metric that is flagged as a regression",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Show all metrics instead of only the ones that changed by more than the threshold",
+    )
+    args = parser.parse_args()
+
+    with open(args.old_report) as f:
+        old_report = json.load(f)
+    with open(args.new_report) as f:
+        new_report = json.load(f)
+
+    rows = compare_run_reports(old_report, new_report, args.threshold)
+    if not args.all:
+        rows = [
+            row for row in rows
+            if row["regression"] or (row["change"] is not None and abs(row["change"]) > args.threshold)
+        ]
+
+    function_width = max([len("Function")] + [len(row["function"]) for row in rows])
+    print(f"{'Function':<{function_width}}  {'Metric':<18}  {'Old':>14}  {'New':>14}  {'Change':>8}")
+    for row in rows:
+        change = "new" if row["change"] is None else f"{row['change']:+.1%}"
+        flag = "  REGRESSION" if row["regression"] else ""
+        print(
+            f"{row['function']:<{function_width}}  {row['metric']:<18}  "
+            f"{row['old']:>14.1f}  {row['new']:>14.1f}  {change:>8}{flag}"
+        )
+
+    regressions = [row for row in rows if row["regression"]]
+    print(f"{len(regressions)} regressions with a threshold of {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Captures the physical plans of the ETL tables and flags expensive operators in them.
+
+In a dry run of etl_spark.py, every table is built but not written. Instead, the formatted
+physical plan of each table is captured, so a join that turns into a nested loop join, a
+cartesian product, or an extra shuffle can be found before running the ETL on the full data.
+Nothing is written or materialized. Only the small jobs that the plans depend on, such as
+counting the bib number lookups to pick the join strategies, are run. See etl_spark.main().
+
+The operator tree of each plan is stable across runs, so it can be compared with golden files.
+See check_plans.py.
+"""
+import os
+import re
+import threading
+from typing import Dict, List
+
+from pyspark.sql.dataframe import DataFrame
+
+
+# Operators that are flagged in the plans, with the reason they are flagged
+FLAGGED_OPERATORS = {
+    "BroadcastNestedLoopJoin": "nested loop join compares every pair of rows",
+    "CartesianProduct": "cartesian product joins every pair of rows",
+    "BatchEvalPython": "Python UDF sends every row to a Python worker",
+    "ArrowEvalPython": "pandas UDF sends every row to a Python worker",
+}
+
+# Shuffles of the rows between executors. Broadcast exchanges are not counted.
+SHUFFLE_EXCHANGE_PATTERN = r"(?<!Broadcast)(?<!Reused)Exchange\b"
+
+# The operator tree is the start of a formatted plan, up to the details of each operator
+PLAN_TREE_PATTERN = r"== Physical Plan ==\n(.*?)\n\n"
+
+_plans = {}
+_plans_lock = threading.Lock()
+_capturing = False
+
+
+def enable_plan_capture():
+    """Captures the plans of the tables instead of writing them"""
+    global _capturing
+    _capturing = True
+    with _plans_lock:
+        _plans.clear()
+
+
+def is_capturing_plans() -> bool:
+    """Checks if the plans of the tables are captured instead of writing the tables"""
+    return _capturing
+
+
+def capture_plan(name: str, df: DataFrame):
+    """Captures the formatted physical plan of a table
+
+    Args:
+        name: Name of the table
+        df: Dataframe of the table
+    """
+    plan = explain_plan(df)
+    with _plans_lock:
+        _plans[name] = plan
+
+
+def captured_plans() -> Dict[str, str]:
+    """Returns the captured plans by table name"""
+    with _plans_lock:
+        return dict(sorted(_plans.items()))
+
+
+def explain_plan(df: DataFrame) -> str:
+    """Explains the physical plan of a dataframe, like df.explain("formatted")
+
+    Args:
+        df: Dataframe
+
+    Returns:
+        Formatted physical plan
+    """
+    return df._sc._jvm.PythonSQLUtils.explainString(df._jdf.queryExecution(), "formatted")
+
+
+def extract_plan_tree(plan: str) -> str:
+    """Extracts the operator tree of a formatted plan
+
+    The details of the operators have expression IDs, file paths, and values that change between
+    runs, but the tree only changes when the plan changes.
+
+    Args:
+        plan: Formatted physical plan
+
+    Returns:
+        Operator tree without trailing whitespace
+    """
+    match = re.search(PLAN_TREE_PATTERN, plan, re.DOTALL)
+    tree = match.group(1) if match else plan
+    return "\n".join(line.rstrip() for line in tree.splitlines())
+
+
+def count_shuffles(plan: str) -> int:
+    """Counts the shuffle exchanges in a plan
+
+    Args:
+        plan: Formatted physical plan or operator tree
+
+    Returns:
+        Number of shuffle exchanges
+    """
+    return len(re.findall(SHUFFLE_EXCHANGE_PATTERN, extract_plan_tree(plan)))
+
+
+def find_plan_issues(plan: str) -> List[str]:
+    """Finds the flagged operators in a plan
+
+    Args:
+        plan: Formatted physical plan or operator tree
+
+    Returns:
+        Descriptions of the flagged operators
+    """
+    tree = extract_plan_tree(plan)
+    return [
+        f"{operator}: {reason}"
+        for operator, reason in FLAGGED_OPERATORS.items()
+        if re.search(rf"\b{operator}\b", tree)
+    ]
+
+
+def output_plans(plans: Dict[str, str], output_path: str):
+    """Writes each plan to a text file and prints the flagged operators
+
+    Args:
+        plans: Formatted physical plans by table name
+        output_path: Local directory for the plans
+    """
+    os.makedirs(output_path, exist_ok=True)
+    for name, plan in plans.items():
+        with open(os.path.join(output_path, f"{name}.txt"), "w") as f:
+            f.write(plan)
+
+    print(f"Wrote the plans of {len(plans)} tables to {output_path}")
+    for name, plan in plans.items():
+        issues = find_plan_issues(plan)
+        print(f"  {name}: {count_shuffles(plan)} shuffles{', ' if issues else ''}{'; '.join(issues)}")
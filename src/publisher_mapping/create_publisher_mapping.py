@@ -7,12 +7,20 @@ set up Elasticsearch on AWS.
 Instead we'll do this on a local Elasticsearch instance.
 """
 import configparser
+import os
+import sys
 
 from elasticsearch import Elasticsearch
 from fuzzywuzzy import process
 from pyspark.sql import SparkSession
 import pyspark.sql.functions as F
 
+# Share the SPL data loaders with the main ETL script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from etl_spark import filter_print_books, find_print_book_item_types, load_data_dict, parse_inventory_csv  # noqa: E402
+from staging import load_staged_data  # noqa: E402
+
 
 config = configparser.ConfigParser()
 config.read("../etl.cfg")
@@ -25,6 +33,9 @@ MATCH_THRESHOLD = 89
 SPL_DATA_DICT_PATH = config.get("spl", "data_dict_path")
 SPL_INVENTORY_PATH = config.get("spl", "inventory_path")
 
+# The staged copies of the SPL data are shared with etl_spark.py
+STAGING_PATH = config.get("main", "staging_path", fallback="")
+
 PUBLISHERS_PATH = "publishers_data"
 
 NUM_PARTITIONS = 6  # Number of partitions to use when processing publishers
@@ -33,33 +44,29 @@ NUM_PARTITIONS = 6  # Number of partitions to use when processing publishers
 def main():
     spark = SparkSession.builder.appName("SPL-Publishers").getOrCreate()
 
-    data_dict_df = spark.read.option("header", "true").csv(SPL_DATA_DICT_PATH)
-    all_inventory_df = spark.read.option("header", "true").csv(SPL_INVENTORY_PATH)
+    data_dict_df = load_data_dict(spark, SPL_DATA_DICT_PATH, STAGING_PATH)
+    all_inventory_df = load_staged_data(spark, "inventory", SPL_INVENTORY_PATH, parse_inventory_csv, STAGING_PATH)
 
-    raw_publishers_df = filter_book_publishers(all_inventory_df, data_dict_df)
+    raw_publishers_df = filter_book_publishers(all_inventory_df, find_print_book_item_types(data_dict_df))
     publishers_with_official_df = find_official_publishers(spark, raw_publishers_df)
 
     # Manually upload the output file to S3
     publishers_with_official_df.write.mode("overwrite").csv(PUBLISHERS_PATH)
 
 
-def filter_book_publishers(all_inventory_df, data_dict_df):
+def filter_book_publishers(all_inventory_df, print_book_item_types):
     """Filters inventory to unique publishers
 
     Args:
         all_inventory_df: SPL inventory data
-        data_dict_df: SPL data dictionary
+        print_book_item_types: ItemType codes of print books
 
     Returns:
         Unique publishers of print books
     """
     return (
-        all_inventory_df
-        .join(data_dict_df, data_dict_df.Code == all_inventory_df.ItemType)
-        .filter(data_dict_df["Code Type"] == "ItemType")
-        .filter(data_dict_df["Format Group"] == "Print")
-        .filter(data_dict_df["Format Subgroup"] == "Book")
-        .select(all_inventory_df.Publisher.alias("publisher"))
+        filter_print_books(all_inventory_df, print_book_item_types)
+        .select(all_inventory_df.raw_publisher.alias("publisher"))
         .distinct()
         .na.drop()
     )
@@ -77,17 +84,16 @@ def find_official_publishers(spark, raw_publishers_df):
     """
     matched_publishers_rdd = (
         raw_publishers_df
-        .coalesce(1)
-        # Since the number of publishers is a reasonable number, we can create a
-        # sequentially incrementing ID column by using one partition
-        .withColumn("id", F.monotonically_increasing_id())
+        # Hash the publisher to spread the publishers evenly across the processes without
+        # needing to move them all to one partition first
+        .withColumn("id", F.pmod(F.xxhash64(raw_publishers_df.publisher), F.lit(NUM_PARTITIONS)))
 
         # Use an RDD to batch process publishers since it will be more performant to
         # run elasticsearch queries with the same connection.
         .coalesce(NUM_PARTITIONS)
         .rdd
-        # Round robin dispatch publishers across the four processes
-        .map(lambda r: (r[1] % NUM_PARTITIONS, r[0]))
+        # Dispatch publishers across the processes
+        .map(lambda r: (r[1], r[0]))
         .groupByKey()
 
         .flatMap(query_official_publisher)
@@ -0,0 +1,382 @@
+"""
+Runs the ETL stages concurrently on one Spark session.
+
+Each stage is run in a thread as soon as the stages it depends on have finished. The stages
+are submitted to their own Spark FAIR scheduler pool, so the small jobs of one stage can use
+the executor cores left idle by another stage instead of waiting for it to finish. The total
+run time should approach the longest chain of dependent stages rather than the sum of the
+stages.
+
+The Spark session needs `spark.scheduler.mode=FAIR`. On Spark 3.0, PySpark only keeps the
+scheduler pool of each Python thread with `PYSPARK_PIN_THREAD=true`.
+
+Runs can be resumed. When a stage that writes outputs finishes, a success marker with a
+fingerprint of its inputs is written. On the next run, the stages whose marker matches their
+current fingerprint are skipped, so retrying a failed run only runs the stages that failed or
+have not run yet.
+"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, NamedTuple, Sequence, Set
+
+import pyspark
+from pyspark.sql import SparkSession
+
+from staging import STAGED_MARKER, list_file_statuses, path_exists
+
+
+DEFAULT_MAX_CONCURRENT_STAGES = 4
+
+# PySpark pins the Python threads to JVM threads by default from this version on
+PINNED_THREAD_DEFAULT_VERSION = (3, 2)
+
+
+class Stage(NamedTuple):
+    """Step of the ETL that is run by run_stages
+
+    The run function is called with the results of the finished stages, by stage name, and
+    returns the result of the stage.
+
+    Stages without outputs, such as loading the data shared by other stages, are only run when
+    a stage that depends on them is run. Stages with outputs that return a result used by other
+    stages set returns_result. When such a stage is skipped but a stage that depends on it is
+    run, its result is loaded from its outputs with the load function. Without a load function,
+    the stage is run again.
+
+    Stages whose result holds resources, such as a persisted dataframe, set release. It is called
+    with the result once all of the stages that depend on the stage have finished.
+    """
+    name: str
+    run: Callable[[Dict[str, Any]], Any]
+    depends_on: Sequence[str] = ()
+    inputs: Sequence[str] = ()
+    outputs: Sequence[str] = ()
+    returns_result: bool = False
+    load: Callable[[], Any] = None
+    release: Callable[[Any], None] = None
+
+
+def check_pinned_threads(max_concurrent_stages: int):
+    """Checks that PySpark pins threads when stages are run concurrently
+
+    Without pinned threads, the jobs of a stage can run in the scheduler pool and job group of
+    another stage, so they are attributed to the wrong stage and are not cancelled when a stage
+    fails. Call this before the Spark session is created.
+
+    Args:
+        max_concurrent_stages: Maximum number of stages to run at the same time
+
+    Raises:
+        ValueError: If stages are run concurrently without pinned threads
+    """
+    if max_concurrent_stages <= 1:
+        return
+    version = tuple(int(part) for part in pyspark.__version__.split(".")[:2])
+    default = "true" if version >= PINNED_THREAD_DEFAULT_VERSION else "false"
+    if os.environ.get("PYSPARK_PIN_THREAD", default).lower() != "true":
+        raise ValueError(
+            f"Running {max_concurrent_stages} stages concurrently on PySpark {pyspark.__version__} needs "
+            "PYSPARK_PIN_THREAD=true. Export it before running spark-submit, or set max_concurrent_stages=1."
+        )
+
+
+class StageTiming(NamedTuple):
+    """Start and end time of a stage in seconds since the epoch"""
+    name: str
+    start: float
+    end: float
+
+
+def run_stages(
+    spark: SparkSession,
+    stages: List[Stage],
+    max_concurrent_stages: int = DEFAULT_MAX_CONCURRENT_STAGES,
+    markers_path: str = None,
+    settings: Dict[str, str] = None,
+    only_stage: str = None,
+    from_stage: str = None,
+) -> Dict[str, Any]:
+    """Runs the stages that are not current concurrently while respecting their dependencies
+
+    If a stage fails, no more stages are started and the Spark jobs of the running stages are
+    cancelled before the error is raised.
+
+    Args:
+        spark: Spark session
+        stages: Stages to run
+        max_concurrent_stages: Maximum number of stages to run at the same time
+        markers_path: Path to store the success markers of the stages. If empty, all of the
+            stages are run.
+        settings: Settings that change the outputs of the stages. Changing them reruns the stages.
+        only_stage: Only run this stage, even if it is current
+        from_stage: Run this stage and the stages that depend on it, even if they are current
+
+    Returns:
+        Results of the stages by stage name
+    """
+    stages_by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        missing_names = set(stage.depends_on) - stages_by_name.keys()
+        if missing_names:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages: {', '.join(sorted(missing_names))}")
+    for stage_name in (only_stage, from_stage):
+        if stage_name and stage_name not in stages_by_name:
+            raise ValueError(f"Unknown stage: {stage_name}. Expected one of: {', '.join(stages_by_name)}")
+
+    fingerprints = fingerprint_stages(spark, stages, settings or {})
+
+    def is_current(stage: Stage) -> bool:
+        return (
+            bool(markers_path)
+            and bool(stage.outputs)
+            and load_marker_fingerprint(spark, markers_path, stage.name) == fingerprints[stage.name]
+            and all(path_exists(spark, path) for path in stage.outputs)
+        )
+
+    if only_stage:
+        run_names = {only_stage}
+    elif from_stage:
+        run_names = {from_stage} | find_dependent_stages(stages, from_stage)
+    else:
+        run_names = {stage.name for stage in stages if stage.outputs and not is_current(stage)}
+
+    # The stages that are run need the results of the stages they depend on. Going through the
+    # stages in reverse order finds the dependencies of the dependencies that need to be run.
+    load_names = set()
+    for stage in reversed(stages):
+        if stage.name not in run_names:
+            continue
+        for dependency_name in stage.depends_on:
+            dependency = stages_by_name[dependency_name]
+            if dependency_name in run_names or dependency_name in load_names:
+                continue
+            if dependency.outputs and is_current(dependency):
+                if dependency.returns_result and dependency.load:
+                    load_names.add(dependency_name)
+                elif dependency.returns_result:
+                    run_names.add(dependency_name)
+            else:
+                run_names.add(dependency_name)
+
+    for stage in stages:
+        if stage.outputs and stage.name not in run_names:
+            print(f"Skipping stage {stage.name}, its outputs are current")
+
+    stages_to_run = [stage for stage in stages if stage.name in run_names]
+    load_stages = [
+        stage._replace(run=lambda results, load=stage.load: load(), depends_on=(), outputs=(), release=None)
+        for stage in stages
+        if stage.name in load_names
+    ]
+    scheduled_names = run_names | load_names
+    scheduled_stages = [
+        stage._replace(depends_on=[name for name in stage.depends_on if name in scheduled_names])
+        for stage in load_stages + stages_to_run
+    ]
+
+    # Number of scheduled stages that still need the result of each stage
+    num_dependents = {stage.name: 0 for stage in scheduled_stages}
+    for stage in scheduled_stages:
+        for dependency_name in stage.depends_on:
+            num_dependents[dependency_name] += 1
+    releases = {stage.name: stage.release for stage in scheduled_stages if stage.release}
+
+    results = {}
+    timings = []
+    pending_stages = scheduled_stages
+    running_stages = {}
+    run_start = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_concurrent_stages) as executor:
+        try:
+            while pending_stages or running_stages:
+                for stage in [stage for stage in pending_stages if set(stage.depends_on) <= results.keys()]:
+                    pending_stages.remove(stage)
+                    running_stages[executor.submit(
+                        run_stage,
+                        spark,
+                        stage,
+                        results,
+                        timings,
+                        markers_path,
+                        fingerprints[stage.name],
+                    )] = stage
+
+                if not running_stages:
+                    raise ValueError(
+                        "Stages have circular dependencies: " + ", ".join(stage.name for stage in pending_stages)
+                    )
+
+                done, _ = wait(running_stages, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running_stages.pop(future)
+                    results[stage.name] = future.result()
+                    for name in stage.depends_on:
+                        num_dependents[name] -= 1
+                    # Results that no stage needs anymore are released, including results that no stage needed
+                    for name in [*stage.depends_on, stage.name]:
+                        if num_dependents[name] == 0 and name in releases:
+                            releases.pop(name)(results[name])
+        except BaseException:
+            for stage in running_stages.values():
+                spark.sparkContext.cancelJobGroup(stage.name)
+            raise
+        finally:
+            print_stage_report(run_start, timings)
+
+    return results
+
+
+def run_stage(
+    spark: SparkSession,
+    stage: Stage,
+    results: Dict[str, Any],
+    timings: List[StageTiming],
+    markers_path: str = None,
+    fingerprint: str = None,
+) -> Any:
+    """Runs a stage in the current thread
+
+    The Spark jobs of the stage are run in a scheduler pool named after the stage, and are
+    grouped so they can be cancelled together and found in the Spark UI.
+
+    Args:
+        spark: Spark session
+        stage: Stage to run
+        results: Results of the finished stages
+        timings: Timing of the stage is appended to this list
+        markers_path: Path to store the success marker of the stage. If empty, no marker is written.
+        fingerprint: Fingerprint of the stage inputs for the success marker
+
+    Returns:
+        Result of the stage
+    """
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", stage.name)
+    spark.sparkContext.setJobGroup(stage.name, f"Stage {stage.name}")
+
+    print(f"Starting stage {stage.name}...")
+    start = time.time()
+    try:
+        result = stage.run(results)
+        if markers_path and stage.outputs:
+            output_marker(spark, markers_path, stage, fingerprint)
+        return result
+    finally:
+        end = time.time()
+        timings.append(StageTiming(stage.name, start, end))
+        print(f"Finished stage {stage.name} in {end - start:.1f}s")
+
+
+def fingerprint_stages(spark: SparkSession, stages: List[Stage], settings: Dict[str, str]) -> Dict[str, str]:
+    """Fingerprints the inputs of the stages
+
+    The fingerprint of a stage covers the path, size, and modification time of its input files,
+    the settings, its outputs, and the fingerprints of the stages it depends on. Changing the
+    inputs of a stage therefore also changes the fingerprints of the stages that depend on it.
+
+    Args:
+        spark: Spark session
+        stages: Stages sorted so that each stage comes after the stages it depends on
+        settings: Settings that change the outputs of the stages
+
+    Returns:
+        Fingerprints by stage name
+    """
+    fingerprints = {}
+    for stage in stages:
+        missing_names = [name for name in stage.depends_on if name not in fingerprints]
+        if missing_names:
+            raise ValueError(f"Stage {stage.name} must come after the stages: {', '.join(missing_names)}")
+
+        stage_key = {
+            "inputs": [
+                [status.getPath().toString(), status.getLen(), status.getModificationTime()]
+                for status in list_file_statuses(spark, list(stage.inputs))
+            ],
+            "settings": settings,
+            "outputs": list(stage.outputs),
+            "depends_on": {name: fingerprints[name] for name in stage.depends_on},
+        }
+        fingerprints[stage.name] = hashlib.sha1(json.dumps(stage_key, sort_keys=True).encode("utf-8")).hexdigest()
+    return fingerprints
+
+
+def find_dependent_stages(stages: List[Stage], stage_name: str) -> Set[str]:
+    """Finds the stages that depend on a stage, directly or through other stages
+
+    Args:
+        stages: Stages sorted so that each stage comes after the stages it depends on
+        stage_name: Name of the stage
+
+    Returns:
+        Names of the dependent stages
+    """
+    dependent_names = set()
+    for stage in stages:
+        if set(stage.depends_on) & (dependent_names | {stage_name}):
+            dependent_names.add(stage.name)
+    return dependent_names
+
+
+def load_marker_fingerprint(spark: SparkSession, markers_path: str, stage_name: str) -> str:
+    """Loads the fingerprint from the success marker of a stage
+
+    Args:
+        spark: Spark session
+        markers_path: Path to the success markers
+        stage_name: Name of the stage
+
+    Returns:
+        Fingerprint of the inputs of the last successful run of the stage, or None if the stage
+        has not run successfully
+    """
+    marker_path = f"{markers_path.rstrip('/')}/{stage_name}"
+    if not path_exists(spark, f"{marker_path}/{STAGED_MARKER}"):
+        return None
+    marker = json.loads("".join(row.value for row in spark.read.text(marker_path).collect()))
+    return marker.get("fingerprint")
+
+
+def output_marker(spark: SparkSession, markers_path: str, stage: Stage, fingerprint: str):
+    """Writes the success marker of a stage
+
+    Args:
+        spark: Spark session
+        markers_path: Path to the success markers
+        stage: Stage that ran successfully
+        fingerprint: Fingerprint of the stage inputs
+    """
+    marker = {
+        "stage": stage.name,
+        "fingerprint": fingerprint,
+        "inputs": list(stage.inputs),
+        "outputs": list(stage.outputs),
+        "finished_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    df = spark.createDataFrame([(json.dumps(marker),)], "value STRING")
+    df.coalesce(1).write.mode("overwrite").text(f"{markers_path.rstrip('/')}/{stage.name}")
+
+
+def print_stage_report(run_start: float, timings: List[StageTiming]):
+    """Prints the start and end time of each stage relative to the start of the run
+
+    Args:
+        run_start: Start time of the run in seconds since the epoch
+        timings: Timings of the stages that have finished
+    """
+    rows = sorted(
+        [(timing.name, timing.start - run_start, timing.end - run_start) for timing in timings],
+        key=lambda row: row[1],
+    )
+    name_width = max([len("Stage")] + [len(row[0]) for row in rows])
+
+    print(f"{'Stage':<{name_width}}  {'Start':>8}  {'End':>8}  {'Duration':>8}")
+    for name, start, end in rows:
+        print(f"{name:<{name_width}}  {start:>8.1f}  {end:>8.1f}  {end - start:>8.1f}")
+
+    total_stage_time = sum(end - start for _, start, end in rows)
+    run_time = time.time() - run_start
+    print(f"Run time: {run_time:.1f}s, total stage time: {total_stage_time:.1f}s")
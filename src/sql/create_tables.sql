@@ -55,3 +55,8 @@ CREATE TABLE IF NOT EXISTS fact_spl_book_checkout (
     publisher_id BIGINT REFERENCES dim_publisher (id),
     id VARCHAR(32) PRIMARY KEY
 );
+
+CREATE TABLE IF NOT EXISTS etl_loaded_batch (
+    batch_id VARCHAR(16) PRIMARY KEY,
+    loaded_at TIMESTAMP WITHOUT TIME ZONE DEFAULT GETDATE()
+);
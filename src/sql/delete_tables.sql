@@ -1,3 +1,4 @@
+DROP TABLE IF EXISTS etl_loaded_batch;
 DROP TABLE IF EXISTS fact_spl_book_checkout;
 DROP TABLE IF EXISTS dim_publisher;
 DROP TABLE IF EXISTS dim_checkout_time;
@@ -0,0 +1,179 @@
+"""
+Stages raw CSV data as typed parquet, so the CSV files only need to be parsed once.
+
+Each source file is staged separately and is keyed by its path, size, modification time, and the
+schema of the parsed data. When a source file or the parsed schema changes, the file will be
+staged again on the next run. Adding a new checkout file only stages the new file.
+
+A dry run does not stage any files. It reads the staged copies of a data source if all of them
+are current, and parses the source files otherwise.
+"""
+import hashlib
+import os
+import re
+from typing import Callable, List, Optional, Union
+
+from pyspark.sql import SparkSession
+from pyspark.sql.dataframe import DataFrame
+
+from plan_inspector import is_capturing_plans
+
+
+# Spark writes this file once all of the parquet files have been written
+STAGED_MARKER = "_SUCCESS"
+
+# Length of the hash of the source path in the names of the staged copies
+SOURCE_PATH_HASH_LENGTH = 12
+
+
+def load_staged_data(
+    spark: SparkSession,
+    source_name: str,
+    data_path: Union[str, List[str]],
+    parse_data: Callable[[SparkSession, str], DataFrame],
+    staging_path: str = None,
+) -> DataFrame:
+    """Loads data from the staged copies of the source files
+
+    Source files that have not been staged yet, or have changed since they were staged, are
+    parsed and staged first.
+
+    Args:
+        spark: Spark session
+        source_name: Name of the data source. Used as the directory for the staged copies.
+        data_path: Path or list of paths to the source files. Can include wildcards.
+        parse_data: Parses a source file into a typed dataframe
+        staging_path: Path to store the staged copies. If empty, the source files are parsed
+            without staging them.
+
+    Returns:
+        Typed dataframe of the source data
+    """
+    statuses = list_file_statuses(spark, data_path)
+    if not staging_path or not statuses:
+        return parse_data(spark, data_path)
+
+    source_staging_path = "{}/{}".format(staging_path.rstrip("/"), source_name)
+    write = not is_capturing_plans()
+    staged_paths = [stage_file(spark, status, source_staging_path, parse_data, write) for status in statuses]
+    if None in staged_paths:
+        return parse_data(spark, data_path)
+    return spark.read.parquet(*staged_paths)
+
+
+def stage_file(
+    spark: SparkSession,
+    status,
+    staging_path: str,
+    parse_data: Callable[[SparkSession, str], DataFrame],
+    write: bool = True,
+) -> Optional[str]:
+    """Stages a source file in parquet format if it has not been staged yet
+
+    Args:
+        spark: Spark session
+        status: Hadoop file status of the source file
+        staging_path: Path to store the staged copies of the data source
+        parse_data: Parses a source file into a typed dataframe
+        write: Stage the file if it has not been staged yet
+
+    Returns:
+        Path to the staged copy, or None if the file has not been staged and write is False
+    """
+    source_path = status.getPath().toString()
+    df = parse_data(spark, source_path)
+    source_key = "{}|{}|{}|{}".format(
+        source_path,
+        status.getLen(),
+        status.getModificationTime(),
+        df.schema.simpleString(),
+    )
+
+    # The prefix identifies the source file, so that we can find its stale copies. The hash of the
+    # path keeps files with the same name in different directories apart.
+    file_name = re.sub(r"[^A-Za-z0-9_.-]", "_", os.path.basename(source_path))
+    prefix = "{}-{}".format(file_name, hash_text(source_path)[:SOURCE_PATH_HASH_LENGTH])
+    staged_path = "{}/{}-{}".format(staging_path, prefix, hash_text(source_key))
+
+    if not path_exists(spark, f"{staged_path}/{STAGED_MARKER}"):
+        if not write:
+            return None
+        print(f"Staging {source_path}...")
+        df.write.mode("overwrite").parquet(staged_path)
+        delete_stale_copies(spark, staging_path, file_name, prefix, staged_path)
+
+    return staged_path
+
+
+def hash_text(text: str) -> str:
+    """Hashes text into a hex digest that can be used in a path"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def delete_stale_copies(spark: SparkSession, staging_path: str, file_name: str, prefix: str, staged_path: str):
+    """Deletes the copies of a source file that were staged before it changed
+
+    Copies that were named by the file name only, before the prefix included the hash of the
+    source path, are deleted as well.
+
+    Args:
+        spark: Spark session
+        staging_path: Path to the staged copies of the data source
+        file_name: File name of the source file
+        prefix: Prefix of the copies of the source file
+        staged_path: Path to the current copy of the source file
+    """
+    current_path = spark._jvm.org.apache.hadoop.fs.Path(staged_path)
+    fs = current_path.getFileSystem(spark._jsc.hadoopConfiguration())
+    legacy_name_pattern = re.compile(r"{}-[0-9a-f]{{40}}".format(re.escape(file_name)))
+    for status in list_file_statuses(spark, f"{staging_path}/{file_name}-*", include_dirs=True):
+        name = status.getPath().getName()
+        is_stale = name.startswith(f"{prefix}-") or legacy_name_pattern.fullmatch(name)
+        if is_stale and name != current_path.getName():
+            fs.delete(status.getPath(), True)
+
+
+def list_file_statuses(spark: SparkSession, data_path: Union[str, List[str]], include_dirs: bool = False) -> List:
+    """Lists the files that match a data path
+
+    Args:
+        spark: Spark session
+        data_path: Path or list of paths. Can include wildcards.
+        include_dirs: Include directories that match the path
+
+    Returns:
+        Hadoop file statuses sorted by path
+    """
+    data_paths = [data_path] if isinstance(data_path, str) else data_path
+
+    statuses = []
+    for path in data_paths:
+        hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+        fs = hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration())
+        statuses.extend(status for status in fs.globStatus(hadoop_path) or [] if include_dirs or status.isFile())
+    return sorted(statuses, key=lambda status: status.getPath().toString())
+
+
+def path_exists(spark: SparkSession, path: str) -> bool:
+    """Checks if a path exists
+
+    Args:
+        spark: Spark session
+        path: Can be S3 bucket, HDFS, or local filepath
+
+    Returns:
+        True if the path exists
+    """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()).exists(hadoop_path)
+
+
+def create_marker(spark: SparkSession, path: str):
+    """Creates an empty marker file, replacing it if it exists
+
+    Args:
+        spark: Spark session
+        path: Can be S3 bucket, HDFS, or local filepath
+    """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()).create(hadoop_path, True).close()
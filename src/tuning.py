@@ -0,0 +1,193 @@
+"""
+Derives the Spark settings of an ETL run from the size of its input data.
+
+Spark's defaults suit neither a laptop sample nor the full checkouts data: 200 shuffle
+partitions are mostly empty tasks on a sample and too few for the full data, and the 10MB
+broadcast threshold is far below what the executors can hold. The settings here are derived
+from the number of bytes the run is about to read and the cores and memory of the session:
+
+- Shuffle partitions: About SHUFFLE_PARTITION_INPUT_BYTES of input per partition, at least one
+  per core. Adaptive query execution coalesces the partitions that turn out to be small.
+- Adaptive query execution: Enabled, with an advisory partition size and skewed partition
+  threshold that shrink with the input, so a sample still uses every core.
+- Broadcast threshold: A share of the executor memory
+- Input split size: Small inputs are split so every core reads part of them
+- Write parallelism: The target parquet file size shrinks for inputs that are too small to fill
+  a file per core. Only used when target_file_size_mb is not set in etl.cfg.
+- Kryo serialization: Set when the session is created, since it cannot be changed afterwards
+
+Any Spark setting, including the derived ones, can be overridden in the [spark] section of
+etl.cfg. The chosen settings are printed at the start of the run and added to the run report.
+"""
+import math
+from typing import Dict, List
+
+from pyspark.sql import SparkSession
+
+from staging import list_file_statuses
+
+
+MB = 1024 * 1024
+
+# Settings that have to be set before the Spark session is created
+STATIC_SETTINGS = {
+    "spark.serializer": "org.apache.spark.serializer.KryoSerializer",
+}
+
+SHUFFLE_PARTITION_INPUT_BYTES = 64 * MB
+MAX_SHUFFLE_PARTITIONS = 4000
+
+MIN_ADVISORY_PARTITION_BYTES = 1 * MB
+MAX_ADVISORY_PARTITION_BYTES = 64 * MB
+
+# A partition is skewed if it is this many times larger than the advisory partition size
+SKEWED_PARTITION_FACTOR = 4
+MIN_SKEWED_PARTITION_BYTES = 16 * MB
+MAX_SKEWED_PARTITION_BYTES = 256 * MB
+
+# Broadcast tables are held in memory by every executor
+BROADCAST_EXECUTOR_MEMORY_SHARE = 1 / 64
+MIN_BROADCAST_BYTES = 10 * MB
+MAX_BROADCAST_BYTES = 256 * MB
+DEFAULT_EXECUTOR_MEMORY = "1g"
+
+MIN_SPLIT_BYTES = 4 * MB
+MAX_SPLIT_BYTES = 128 * MB
+
+MIN_TARGET_FILE_SIZE = 16 * MB
+
+
+def create_session_builder(app_name: str, overrides: Dict[str, str] = None) -> SparkSession.Builder:
+    """Creates a Spark session builder with the settings that cannot be changed later
+
+    Args:
+        app_name: Name of the Spark application
+        overrides: Spark settings from etl.cfg
+
+    Returns:
+        Spark session builder
+    """
+    builder = SparkSession.builder.appName(app_name)
+    for key, value in {**STATIC_SETTINGS, **(overrides or {})}.items():
+        builder = builder.config(key, value)
+    return builder
+
+
+def measure_input_size(spark: SparkSession, data_paths: List[str]) -> int:
+    """Measures the size of the input files of a run
+
+    Args:
+        spark: Spark session
+        data_paths: Paths to the input files. Can include wildcards.
+
+    Returns:
+        Total size in bytes
+    """
+    return sum(status.getLen() for status in list_file_statuses(spark, data_paths))
+
+
+def derive_settings(input_bytes: int, num_cores: int, executor_memory_bytes: int, target_file_size: int) -> Dict[str, int]:
+    """Derives the Spark settings and write parallelism from the input size
+
+    Args:
+        input_bytes: Size of the input files
+        num_cores: Number of cores of the executors
+        executor_memory_bytes: Memory of each executor
+        target_file_size: Largest target size of the parquet files
+
+    Returns:
+        Setting values by name. The spark.* settings are Spark settings. target_file_size is
+        the target size of the parquet files.
+    """
+    bytes_per_core = math.ceil(input_bytes / num_cores)
+
+    shuffle_partitions = max(num_cores, math.ceil(input_bytes / SHUFFLE_PARTITION_INPUT_BYTES))
+    # Whole waves of tasks keep every core busy until the end of a stage
+    shuffle_partitions = min(MAX_SHUFFLE_PARTITIONS, math.ceil(shuffle_partitions / num_cores) * num_cores)
+
+    advisory_partition_bytes = clamp(
+        math.ceil(input_bytes / shuffle_partitions),
+        MIN_ADVISORY_PARTITION_BYTES,
+        MAX_ADVISORY_PARTITION_BYTES,
+    )
+
+    return {
+        "spark.sql.shuffle.partitions": shuffle_partitions,
+        "spark.sql.adaptive.enabled": "true",
+        "spark.sql.adaptive.coalescePartitions.enabled": "true",
+        "spark.sql.adaptive.advisoryPartitionSizeInBytes": advisory_partition_bytes,
+        "spark.sql.adaptive.skewJoin.enabled": "true",
+        "spark.sql.adaptive.skewJoin.skewedPartitionFactor": SKEWED_PARTITION_FACTOR,
+        "spark.sql.adaptive.skewJoin.skewedPartitionThresholdInBytes": clamp(
+            advisory_partition_bytes * SKEWED_PARTITION_FACTOR,
+            MIN_SKEWED_PARTITION_BYTES,
+            MAX_SKEWED_PARTITION_BYTES,
+        ),
+        "spark.sql.autoBroadcastJoinThreshold": clamp(
+            int(executor_memory_bytes * BROADCAST_EXECUTOR_MEMORY_SHARE),
+            MIN_BROADCAST_BYTES,
+            MAX_BROADCAST_BYTES,
+        ),
+        "spark.sql.files.maxPartitionBytes": clamp(bytes_per_core, MIN_SPLIT_BYTES, MAX_SPLIT_BYTES),
+        "target_file_size": clamp(bytes_per_core, min(MIN_TARGET_FILE_SIZE, target_file_size), target_file_size),
+    }
+
+
+def tune_session(
+    spark: SparkSession,
+    data_paths: List[str],
+    overrides: Dict[str, str],
+    target_file_size: int,
+) -> Dict[str, str]:
+    """Sets the Spark settings derived from the size of the input data
+
+    Args:
+        spark: Spark session created with create_session_builder
+        data_paths: Paths to the input files of the run. Can include wildcards.
+        overrides: Settings from etl.cfg. These are used instead of the derived settings.
+        target_file_size: Largest target size of the parquet files
+
+    Returns:
+        Chosen setting values by name, including the input size and target_file_size
+    """
+    sc = spark.sparkContext
+    input_bytes = measure_input_size(spark, data_paths)
+    executor_memory = sc.getConf().get("spark.executor.memory", DEFAULT_EXECUTOR_MEMORY)
+    executor_memory_bytes = spark._jvm.org.apache.spark.network.util.JavaUtils.byteStringAsBytes(executor_memory)
+
+    derived_settings = derive_settings(input_bytes, sc.defaultParallelism, executor_memory_bytes, target_file_size)
+
+    settings = {"input_bytes": str(input_bytes), "num_cores": str(sc.defaultParallelism)}
+    sources = {"input_bytes": "measured", "num_cores": "measured"}
+    for key, value in derived_settings.items():
+        settings[key], sources[key] = str(value), "derived"
+    for key in STATIC_SETTINGS:
+        settings[key], sources[key] = sc.getConf().get(key, ""), "static"
+    for key, value in overrides.items():
+        settings[key], sources[key] = value, "etl.cfg"
+
+    # The other settings were set by create_session_builder
+    for key, value in settings.items():
+        if key.startswith("spark.") and spark.conf.isModifiable(key):
+            spark.conf.set(key, value)
+
+    print_settings(settings, sources)
+    return settings
+
+
+def print_settings(settings: Dict[str, str], sources: Dict[str, str]):
+    """Prints the chosen settings and where they came from
+
+    Args:
+        settings: Setting values by name
+        sources: Sources of the settings by name, e.g. derived or etl.cfg
+    """
+    key_width = max(len(key) for key in settings)
+    print("Spark settings:")
+    for key, value in settings.items():
+        print(f"  {key:<{key_width}}  {value:>12}  ({sources[key]})")
+
+
+def clamp(value: int, min_value: int, max_value: int) -> int:
+    """Limits a value to a range"""
+    return max(min_value, min(max_value, value))